@@ -0,0 +1,214 @@
+"""
+The test_match_users workload (users of both positions signing up and joining the
+waiting room all at once, and getting matched) against the database in --db-uri, to
+compare the SQLite mode (see data/sqlite.py) with Postgres, and Postgres's matching
+strategies with each other:
+
+    python benchmarks/matching.py --db-uri sqlite+aiosqlite:////tmp/matching.db
+    python benchmarks/matching.py --db-uri postgresql+asyncpg://localhost/scratch \\
+        --strategy skip-locked --users 500 5000
+    python benchmarks/matching.py --db-uri postgresql+asyncpg://localhost/scratch \\
+        --strategy optimistic --users 500 5000
+
+Socket events go straight to the waiting room namespace, so the numbers are just the
+handlers and the database. The schema is created if it's missing, and users are added
+to whatever is already there. Users leave the waiting room after each run, so later
+runs can't match with them.
+
+Conflicts are matches rolled back because a user's match_version changed, and skips
+are users who didn't try to match because another transaction had them locked (only
+with SKIP LOCKED).
+
+Needs the same environment as the server (OPENAI_API_KEY, TEMPLATES_DIR, etc.).
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List
+
+from fastapi_async_sqlalchemy import SQLAlchemyMiddleware, db
+from sqlalchemy import update
+
+
+class BenchmarkNamespace:
+    """
+    Stands in for the socket server: session data is kept in memory, and the time
+    each session is told it's matched is recorded.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.sessions = {}
+        self.matched_at: Dict[str, float] = {}
+
+    def install(self) -> None:
+        async def save_session(session_id, session, namespace=None):
+            self.sessions[session_id] = session
+
+        async def emit(event, data=None, to=None, **_kwargs):
+            if event == "matched_with":
+                self.matched_at[to] = time.perf_counter()
+
+        self.namespace.save_session = save_session
+        self.namespace.emit = emit
+
+
+class MessageCounter(logging.Handler):
+    def __init__(self, *messages: str):
+        super().__init__()
+        self.messages = messages
+        self.counts = Counter()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = record.getMessage()
+        for counted in self.messages:
+            if message.startswith(counted):
+                self.counts[counted] += 1
+
+
+CONFLICT = "User attempted to match but version integrity check failed"
+SKIP = "User is already matched or being matched"
+
+
+async def join(namespace, access, position, response_id) -> float:
+    from depolarizing_chatroom.auth_tokens import auth_tokens
+    from depolarizing_chatroom.data.crud import UserIdentity
+
+    start = time.perf_counter()
+    async with db():
+        async with access.commit_after():
+            user = await access.process_signup(response_id, position)
+        token = auth_tokens.issue(UserIdentity(user.id, user.position))
+    await namespace.trigger_event(
+        "connect", response_id, {}, {"token": token, "page": "waiting"}
+    )
+    return start
+
+
+def percentile(values: List[float], percent: int) -> float:
+    return sorted(values)[int((len(values) - 1) * percent / 100)]
+
+
+async def run(
+    namespace, notifications, benchmark: BenchmarkNamespace, users: int
+) -> None:
+    from depolarizing_chatroom.data import models
+    from depolarizing_chatroom.data.crud import access
+    from depolarizing_chatroom.logger import logger
+
+    counter = MessageCounter(CONFLICT, SKIP)
+    logger.addHandler(counter)
+    prefix = f"matching-{uuid.uuid4().hex[:8]}-"
+    positions = [models.UserPosition.SUPPORT, models.UserPosition.OPPOSE] * (users // 2)
+    random.shuffle(positions)
+    response_ids = [f"{prefix}{i}" for i in range(len(positions))]
+
+    start = time.perf_counter()
+    joined_at = dict(
+        zip(
+            response_ids,
+            await asyncio.gather(
+                *[
+                    join(namespace, access, position, response_id)
+                    for response_id, position in zip(response_ids, positions)
+                ]
+            ),
+        )
+    )
+    # Let retries set off by notifications finish too
+    # noinspection PyProtectedMember
+    while tasks := notifications._tasks:
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    logger.removeHandler(counter)
+
+    times_to_match = [
+        benchmark.matched_at[response_id] - joined
+        for response_id, joined in joined_at.items()
+        if response_id in benchmark.matched_at
+    ]
+    matches = len(times_to_match) // 2
+    attempts = matches + counter.counts[CONFLICT]
+    print(f"  {len(positions)} users joined and were matched in {elapsed:.2f}s")
+    print(
+        f"  {matches} matches, {counter.counts[CONFLICT]} conflicts "
+        f"({counter.counts[CONFLICT] / max(attempts, 1):.1%} of attempts), "
+        f"{counter.counts[SKIP]} skips"
+    )
+    if times_to_match:
+        print(
+            f"  time to match p50 {percentile(times_to_match, 50) * 1e3:.1f}ms, "
+            f"p99 {percentile(times_to_match, 99) * 1e3:.1f}ms"
+        )
+
+    async with db():
+        async with access.commit_after():
+            await db.session.execute(
+                update(models.User)
+                .where(models.User.response_id.startswith(prefix))
+                .values(waiting_session_id=None)
+                .execution_options(synchronize_session=False)
+            )
+
+
+async def main(db_uri: str, strategy: str, user_counts: List[int]) -> None:
+    # The server sets up its engines and reads settings when it's imported
+    os.environ["DB_URI"] = db_uri
+    os.environ["MATCH_SKIP_LOCKED"] = "1" if strategy == "skip-locked" else "0"
+    from depolarizing_chatroom import server
+    from depolarizing_chatroom.constants import SOCKET_NAMESPACE_WAITING_ROOM
+    from depolarizing_chatroom.data.crud import create_missing_schema
+    from depolarizing_chatroom.data.pool import pool_stats
+
+    # The app only sets up sessions when it gets its first request
+    SQLAlchemyMiddleware(
+        None, custom_engine=server.engine, session_args=server.session_args
+    )
+    try:
+        async with (server.writer_engine or server.engine).begin() as connection:
+            await connection.run_sync(create_missing_schema)
+
+        # noinspection PyProtectedMember
+        namespace = server.socket_manager._sio.namespace_handlers[
+            SOCKET_NAMESPACE_WAITING_ROOM
+        ]
+        benchmark = BenchmarkNamespace(namespace)
+        benchmark.install()
+
+        print(f"{db_uri} ({strategy})")
+        for users in user_counts:
+            await run(namespace, server.notifications, benchmark, users)
+
+        for name, engine in (
+            ("primary", server.engine),
+            ("writer", server.writer_engine),
+        ):
+            if engine is not None and (stats := pool_stats(engine)) is not None:
+                print(
+                    f"  {name} pool: {stats.checkouts} checkouts, mean wait "
+                    f"{stats.mean_checkout_seconds * 1e3:.1f}ms, max wait "
+                    f"{stats.max_checkout_seconds * 1e3:.1f}ms, "
+                    f"{stats.checkout_timeouts} timeouts"
+                )
+    finally:
+        await server.engine.dispose()
+        if server.writer_engine is not None:
+            await server.writer_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db-uri", required=True)
+    # Only makes a difference on Postgres
+    parser.add_argument(
+        "--strategy", choices=["skip-locked", "optimistic"], default="skip-locked"
+    )
+    parser.add_argument("--users", type=int, nargs="+", default=[500])
+    args = parser.parse_args()
+    asyncio.run(main(args.db_uri, args.strategy, args.users))
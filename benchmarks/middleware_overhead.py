@@ -0,0 +1,122 @@
+"""
+Per-request overhead of giving HTTP requests database sessions, with the
+BaseHTTPMiddleware wrapper we used to use and with DatabaseSessionMiddleware.
+
+Requests are sent straight to the ASGI app, so the numbers are just the app and its
+middleware. Sessions are never used, so no connections are opened.
+
+    python benchmarks/middleware_overhead.py [--requests N]
+"""
+
+import argparse
+import asyncio
+import time
+from typing import List, Type
+
+from fastapi import FastAPI
+from fastapi_async_sqlalchemy import SQLAlchemyMiddleware
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from depolarizing_chatroom.middleware import DatabaseSessionMiddleware
+
+
+class RouteIgnoringMiddlewareWrapper(BaseHTTPMiddleware):
+    # What server.py used before DatabaseSessionMiddleware
+
+    def __init__(
+        self,
+        app,
+        wrapped_middleware_class: Type[BaseHTTPMiddleware],
+        *,
+        ignore_routes: List[str],
+        **kwargs,
+    ):
+        super().__init__(app)
+        self._middleware = wrapped_middleware_class(app, **kwargs)
+        self._ignore_routes = ignore_routes
+
+    async def dispatch(self, request, call_next):
+        if any(request.url.path.startswith(route) for route in self._ignore_routes):
+            return await call_next(request)
+        return await self._middleware.dispatch(request, call_next)
+
+
+def create_app(middleware: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    engine = create_async_engine("sqlite+aiosqlite://")
+    if middleware == "before":
+        app.add_middleware(
+            RouteIgnoringMiddlewareWrapper,
+            wrapped_middleware_class=SQLAlchemyMiddleware,
+            ignore_routes=["/ws/"],
+            custom_engine=engine,
+        )
+    elif middleware == "after":
+        app.add_middleware(
+            DatabaseSessionMiddleware, ignore_prefixes=["/ws/"], custom_engine=engine
+        )
+    return app
+
+
+async def request(app: FastAPI, path: str) -> None:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 1234),
+        "server": ("localhost", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(_message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def time_requests(app: FastAPI, path: str, requests: int) -> float:
+    # Warm up (this also builds the middleware stack)
+    for _ in range(100):
+        await request(app, path)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await request(app, path)
+    return (time.perf_counter() - start) / requests
+
+
+async def main(requests: int) -> None:
+    # /ws/ paths aren't routed, so they're compared with a 404 without middleware
+    paths = ("/ping", "/ws/ping")
+    baselines = {}
+    for path in paths:
+        baselines[path] = await time_requests(create_app("none"), path, requests)
+        print(f"{'none':>6} {path:<9} {baselines[path] * 1e6:7.1f} µs/request")
+    for middleware in ("before", "after"):
+        app = create_app(middleware)
+        for path in paths:
+            per_request = await time_requests(app, path, requests)
+            print(
+                f"{middleware:>6} {path:<9} {per_request * 1e6:7.1f} µs/request "
+                f"(+{(per_request - baselines[path]) * 1e6:.1f} µs)"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    asyncio.run(main(parser.parse_args().requests))
@@ -0,0 +1,85 @@
+import os
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from .constants import AUTH_TOKEN_MAX_AGE, RESPONSE_IDS_GRACE_PERIOD
+from .data.crud import UserIdentity
+from .data.models import UserPosition
+from .logger import logger
+
+
+class AuthTokenService:
+    """
+    Issues and verifies signed auth tokens, so requests and socket connects can be
+    authenticated without looking users up. Tokens only carry things about a user that
+    never change, so they never go stale; anything else has to come from the
+    database.
+
+    Tokens are signed with the last of `secret_keys` and verified against all of them,
+    so keys can be rotated by appending a new key and dropping old ones once tokens
+    signed with them have expired.
+
+    Clients that logged in before we issued tokens authenticate with their raw
+    response ID, which is only accepted until `response_ids_accepted_until`, and never
+    if it isn't given.
+    """
+
+    def __init__(
+        self,
+        secret_keys: List[str],
+        max_age: int,
+        response_ids_accepted_until: Optional[datetime] = None,
+    ):
+        self._serializer = URLSafeTimedSerializer(secret_keys, salt="auth-token")
+        self._max_age = max_age
+        self._response_ids_accepted_until = response_ids_accepted_until
+
+    def accepts_response_ids(self) -> bool:
+        return (
+            self._response_ids_accepted_until is not None
+            and datetime.now(timezone.utc) < self._response_ids_accepted_until
+        )
+
+    def issue(self, identity: UserIdentity) -> str:
+        return self._serializer.dumps(
+            {"id": identity.id, "position": identity.position.value}
+        )
+
+    def verify(self, token: str) -> Optional[UserIdentity]:
+        """
+        Returns None if the token is invalid or has expired.
+        """
+        try:
+            payload = self._serializer.loads(token, max_age=self._max_age)
+            return UserIdentity(payload["id"], UserPosition(payload["position"]))
+        except (BadSignature, KeyError, TypeError, ValueError):
+            return None
+
+
+def secret_keys_from_env() -> List[str]:
+    if not (secret_key := os.getenv("SECRET_KEY")):
+        logger.warning("SECRET_KEY isn't set, auth tokens can be forged")
+        secret_key = "default-secret"
+    # Comma-separated keys that tokens may still be signed with, oldest first
+    old_secret_keys = [
+        key for key in os.getenv("OLD_SECRET_KEYS", "").split(",") if key.strip()
+    ]
+    return [*old_secret_keys, secret_key]
+
+
+def response_ids_accepted_until_from_env() -> datetime:
+    # An ISO 8601 date or time (UTC unless it says otherwise) until which raw response
+    # IDs are accepted as credentials. Without one, they're accepted for a grace period
+    # after starting, so clients that stored them before a deploy can still connect,
+    # but that restarts with every restart.
+    if not (until := os.getenv("ACCEPT_RESPONSE_IDS_UNTIL")):
+        return datetime.now(timezone.utc) + timedelta(seconds=RESPONSE_IDS_GRACE_PERIOD)
+    until = datetime.fromisoformat(until)
+    return until if until.tzinfo else until.replace(tzinfo=timezone.utc)
+
+
+auth_tokens = AuthTokenService(
+    secret_keys_from_env(), AUTH_TOKEN_MAX_AGE, response_ids_accepted_until_from_env()
+)
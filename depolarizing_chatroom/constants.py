@@ -7,7 +7,32 @@ REQUIRED_REPHRASINGS = 4
 MAX_REPHRASING_ATTEMPTS = 10
 SOCKET_NAMESPACE_CHATROOM = "/chatroom"
 SOCKET_NAMESPACE_WAITING_ROOM = "/waiting-room"
+SOCKET_NAMESPACE_DASHBOARD = "/dashboard"
 WAITING_ROOM_TIMEOUT = 5 * 60  # 5 minutes
+# How long to wait before trying to time a user out again after an error
+WAITING_ROOM_TIMEOUT_RETRY_DELAY = 30  # seconds
+USER_IDENTITY_CACHE_TTL = 60  # 1 minute
+USER_IDENTITY_CACHE_MAX_SIZE = 10000
+AUTH_TOKEN_MAX_AGE = 2 * 24 * 60 * 60  # 2 days
+# How long after starting raw response IDs are still accepted as credentials, unless
+# ACCEPT_RESPONSE_IDS_UNTIL says otherwise
+RESPONSE_IDS_GRACE_PERIOD = 2 * 24 * 60 * 60  # 2 days
+STATS_SNAPSHOT_INTERVAL = 2  # seconds
+STATS_MAX_UPDATES_PER_SECOND = 4
+STATS_HISTORY_SIZE = 600
+STATS_RECONCILE_INTERVAL = 30  # seconds
+# Per worker, for transcripts of active chatrooms (see data/transcripts.py)
+TRANSCRIPT_CACHE_MAX_BYTES = int(
+    os.getenv("TRANSCRIPT_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+)
+# Completions per strategy that template editors can stream at once
+TEMPLATE_COMPLETIONS_MAX_N = 5
+# Claim partners with SELECT ... FOR UPDATE SKIP LOCKED on Postgres, instead of only
+# relying on match_version to catch conflicts
+MATCH_SKIP_LOCKED = os.getenv("MATCH_SKIP_LOCKED", "1") != "0"
+# When everyone a user could match with is locked by other matches
+MATCH_ATTEMPTS = 5
+MATCH_RETRY_DELAY = 0.05  # seconds, at most
 POST_CHAT_URL = (
     f'{os.environ["POST_CHAT_URL"]}?RESPONDENT_ID={{respondent_id}}&treatment={{treatment}}&position={{position}}'
     if "POST_CHAT_URL" in os.environ
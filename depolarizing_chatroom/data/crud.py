@@ -1,27 +1,288 @@
 import os
 import random
+import time
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, TypeVar, Union
 
 from fastapi_async_sqlalchemy import db
-from sqlalchemy import and_
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy import (
+    and_,
+    bindparam,
+    event,
+    func,
+    inspect,
+    literal_column,
+    text,
+    union_all,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
-
+from sqlalchemy.orm import Session, aliased, selectinload
+from sqlalchemy.schema import CreateColumn
+
+from ..constants import (
+    TRANSCRIPT_CACHE_MAX_BYTES,
+    USER_IDENTITY_CACHE_MAX_SIZE,
+    USER_IDENTITY_CACHE_TTL,
+)
+from ..notifications import NotificationBus
 from . import models
 from .database import Base
 from .models import UserPosition
+from .snapshots import ChatroomSnapshot, UserSnapshot
+from .template_cache import LRUCache
+from .transcripts import (
+    Transcript,
+    TranscriptCache,
+    TranscriptCacheStats,
+    TranscriptMessage,
+)
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class UserIdentity:
+    id: int
+    position: UserPosition
+
+
+class UserIdentityCache:
+    """
+    User identities by response ID. A user's ID and position never change, so the
+    only way an entry can go stale is if its user is deleted or recreated, which is
+    what the TTL is for. Each process has its own cache, which keeps up to maxsize
+    identities, dropping the least recently used.
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self._ttl = ttl
+        # Expiry time and identity by response ID
+        self._identities: LRUCache[str, Tuple[float, UserIdentity]] = LRUCache(maxsize)
+
+    def get(self, response_id: str) -> Optional[UserIdentity]:
+        if (entry := self._identities.get(response_id)) is None:
+            return None
+        expires, identity = entry
+        if expires < time.monotonic():
+            self._identities.pop(response_id, None)
+            return None
+        return identity
+
+    def set(self, response_id: str, identity: UserIdentity) -> None:
+        self._identities[response_id] = (time.monotonic() + self._ttl, identity)
+
+    def invalidate(self, response_id: str) -> None:
+        self._identities.pop(response_id, None)
+
+
+@dataclass(frozen=True)
+class OnlineUserCounts:
+    unmatched: int
+    prechat: int
+    in_chatroom: int
+
+    @property
+    def total(self) -> int:
+        return self.unmatched + self.prechat + self.in_chatroom
+
+
+@dataclass
+class UnitOfWork:
+    """
+    Writes made in DataAccess.unit_of_work(), which are committed together when it
+    ends.
+    """
+
+    commits: int = 0
+    # Whether anything's been written since the last commit
+    pending: bool = False
+
+
+# The unit of work we're in, if any
+_unit_of_work: ContextVar[Optional[UnitOfWork]] = ContextVar(
+    "_unit_of_work", default=None
+)
+
+
+# Where a session keeps the messages it changed, until they're committed and can be
+# written to cached transcripts
+_TRANSCRIPT_CHANGES = "transcript_changes"
+
+
+_TRANSCRIPT_COLUMNS = {
+    "id",
+    "seq",
+    "sender_id",
+    "final_body",
+    "word_count",
+    "has_rephrasings",
+}
+
+
+@event.listens_for(Session, "after_commit")
+def _write_transcript_changes(session: Session) -> None:
+    for transcripts, chatroom_id, message in session.info.pop(_TRANSCRIPT_CHANGES, ()):
+        # Loading expired columns would start another transaction, so just drop the
+        # transcript
+        if _TRANSCRIPT_COLUMNS & inspect(message).unloaded:
+            transcripts.forget(chatroom_id)
+        else:
+            transcripts.write(chatroom_id, message)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_transcript_changes(session: Session, transaction) -> None:
+    # Anything left wasn't committed. Savepoints end inside their transaction.
+    if transaction.parent is None:
+        session.info.pop(_TRANSCRIPT_CHANGES, None)
+
+
+def _swap_view_messages(
+    chatroom: Union[models.Chatroom, ChatroomSnapshot], messages: List[T]
+) -> List[T]:
+    # Swap first two messages if chatroom.swap_view_messages is true
+    if chatroom.swap_view_messages and len(messages) >= 2:
+        messages[0], messages[1] = (
+            messages[1],
+            messages[0],
+        )
+    return messages
+
+
+@dataclass(frozen=True)
+class TransactionStats:
+    commits: int
+    # Read-only blocks that would have committed if they'd used commit_after
+    commits_avoided: int
 
 
 class DataAccess:
+    def __init__(self):
+        self._user_identities = UserIdentityCache(
+            USER_IDENTITY_CACHE_TTL, USER_IDENTITY_CACHE_MAX_SIZE
+        )
+        self._transcripts = TranscriptCache(TRANSCRIPT_CACHE_MAX_BYTES)
+        self._replica_engine: Optional[AsyncEngine] = None
+        self._commits = 0
+        self._commits_avoided = 0
+
+    def use_replica(self, engine: AsyncEngine) -> None:
+        """
+        Send reads in read_only(replica=True) blocks to this engine.
+        """
+        self._replica_engine = engine
+
+    def share_transcript_changes(self, bus: NotificationBus) -> None:
+        """
+        Keep cached transcripts in step with other workers over this bus.
+        """
+        self._transcripts.share_changes(bus)
+
     @asynccontextmanager
     async def commit_after(self) -> None:
+        """
+        Commit after the block. In a unit of work, the commit is left to the end of
+        the unit.
+        """
         try:
             yield
         finally:
-            await db.session.commit()
+            if _unit_of_work.get() is None:
+                await self.commit()
+
+    @asynccontextmanager
+    async def unit_of_work(self) -> AsyncIterator[UnitOfWork]:
+        """
+        Collect every write made in the block, including in commit_after blocks, and
+        commit them once at the end. Nothing is committed if the block raises.
+
+        Anything that other sessions have to see before the block ends (like a user
+        they might match with, or anything a client will act on once we emit to it)
+        has to be committed explicitly with commit(). So should writes that would
+        otherwise be left uncommitted during a slow call, since they keep a
+        connection checked out.
+        """
+        unit = UnitOfWork()
+        token = _unit_of_work.set(unit)
+        try:
+            yield unit
+            if unit.pending or self._has_changes():
+                await self.commit()
+        finally:
+            _unit_of_work.reset(token)
+
+    async def commit(self) -> None:
+        committing = db.session.in_transaction() or self._has_changes()
+        await db.session.commit()
+        if committing:
+            self._count_commit()
+
+    @asynccontextmanager
+    async def transaction(self) -> None:
+        """
+        An explicit transaction, committed at the end of the block or rolled back if
+        it raises. There can't already be a transaction running.
+        """
+        async with db.session.begin():
+            yield
+        self._count_commit()
+
+    async def flush(self) -> None:
+        """
+        Send pending changes to the database without committing them, e.g. to get
+        generated IDs.
+        """
+        if self._has_changes():
+            self._wrote()
+        await db.session.flush()
+
+    def _wrote(self) -> None:
+        if (unit := _unit_of_work.get()) is not None:
+            unit.pending = True
+
+    def _count_commit(self) -> None:
+        self._commits += 1
+        if (unit := _unit_of_work.get()) is not None:
+            unit.commits += 1
+            unit.pending = False
+
+    @asynccontextmanager
+    async def read_only(self, *, replica: bool = False) -> None:
+        """
+        For blocks that only read. Unlike commit_after, this doesn't commit, which
+        would only cost a round trip.
+
+        With replica=True, the block gets its own session on the replica, if there is
+        one. Replicas can lag behind, so only use it for reads that don't have to see
+        the latest writes. Objects loaded from the replica are detached after the
+        block, so anything needed from them has to be loaded eagerly.
+
+        :raises RuntimeError: if anything was added, changed or deleted in the block
+        """
+        if replica and self._replica_engine is not None:
+            async with db(session_args={"bind": self._replica_engine}):
+                yield
+                self._check_unchanged(False)
+        else:
+            had_changes = self._has_changes()
+            yield
+            self._check_unchanged(had_changes)
+        self._commits_avoided += 1
+
+    def _has_changes(self) -> bool:
+        return bool(db.session.new or db.session.dirty or db.session.deleted)
+
+    def _check_unchanged(self, had_changes: bool) -> None:
+        if not had_changes and self._has_changes():
+            raise RuntimeError("Objects were changed in a read-only block")
+
+    def transaction_stats(self) -> TransactionStats:
+        return TransactionStats(self._commits, self._commits_avoided)
 
     @property
     def session(self) -> AsyncSession:
@@ -36,6 +297,7 @@ class DataAccess:
 
     def add(self, obj: Base) -> None:
         db.session.add(obj)
+        self._wrote()
 
     def create_chatroom(self) -> models.Chatroom:
         self.add(
@@ -43,6 +305,17 @@ class DataAccess:
         )
         return chatroom
 
+    async def chatroom(self, id) -> Optional[models.Chatroom]:
+        self._check_explicit_transaction()
+        return await db.session.get(models.Chatroom, id)
+
+    async def update_chatroom(self, id, **values) -> None:
+        self._check_explicit_transaction()
+        await db.session.execute(
+            update(models.Chatroom).where(models.Chatroom.id == id).values(**values)
+        )
+        self._wrote()
+
     async def message(self, id) -> Optional[models.Message]:
         self._check_explicit_transaction()
         return await db.session.get(
@@ -52,48 +325,122 @@ class DataAccess:
                 selectinload(models.Message.rephrasings),
                 selectinload(models.Message.user),
                 selectinload(models.Message.chatroom),
-                selectinload(models.Message.accepted_rephrasing),
             ],
         )
 
     async def chatroom_messages(
         self,
-        chatroom: models.Chatroom,
+        chatroom: Union[models.Chatroom, ChatroomSnapshot],
         select_users: bool = False,
         select_rephrasings: bool = False,
+        after_seq: Optional[int] = None,
     ) -> List[models.Message]:
+        """
+        The chatroom's messages in order, or only the ones after after_seq if it's
+        given.
+        """
         self._check_explicit_transaction()
         statement = (
             select(models.Message)
             .filter_by(chatroom_id=chatroom.id)
-            .order_by(models.Message.send_time.asc())
-            .options(selectinload(models.Message.accepted_rephrasing))
+            .order_by(models.Message.seq.asc())
         )
+        if after_seq is not None:
+            statement = statement.where(models.Message.seq > after_seq)
         if select_users:
             statement = statement.options(selectinload(models.Message.user))
         if select_rephrasings:
             statement = statement.options(selectinload(models.Message.rephrasings))
         response = await db.session.execute(statement)
         messages = response.scalars().all()
-        # Swap first two messages if chatroom.swap_view_messages is true
-        if chatroom.swap_view_messages and len(messages) >= 2:
-            messages[0], messages[1] = (
-                messages[1],
-                messages[0],
-            )
+        if after_seq is None:
+            _swap_view_messages(chatroom, messages)
         return messages
 
-    def add_message(self, chatroom_id, sender_id, message_body) -> models.Message:
+    async def chatroom_transcript(
+        self,
+        chatroom: Union[models.Chatroom, ChatroomSnapshot],
+        after_seq: Optional[int] = None,
+    ) -> List[TranscriptMessage]:
+        """
+        Like chatroom_messages, but from this worker's cache of transcripts if it can
+        be.
+        """
+        transcript = await self._transcripts.get(
+            chatroom.id, lambda: self._load_transcript(chatroom.id)
+        )
+        if after_seq is not None:
+            # Sequence numbers start at 1 and don't skip any
+            return transcript.messages[max(after_seq, 0) :]
+        return _swap_view_messages(chatroom, list(transcript.messages))
+
+    async def _load_transcript(self, chatroom_id) -> Transcript:
+        self._check_explicit_transaction()
+        users = await db.session.execute(
+            select(models.User.id, models.User.position).filter_by(
+                chatroom_id=chatroom_id
+            )
+        )
+        messages = await db.session.execute(
+            select(
+                models.Message.id,
+                models.Message.seq,
+                models.Message.sender_id,
+                models.Message.final_body,
+                models.Message.word_count,
+                models.Message.has_rephrasings,
+            )
+            .filter_by(chatroom_id=chatroom_id)
+            .order_by(models.Message.seq.asc())
+        )
+        return Transcript.of(dict(users.all()), messages.all())
+
+    def _transcript_changed(self, message: models.Message) -> None:
+        db.session.info.setdefault(_TRANSCRIPT_CHANGES, []).append(
+            (self._transcripts, message.chatroom_id, message)
+        )
+
+    def forget_transcript(self, chatroom_id) -> None:
+        """
+        Drop the chatroom's cached transcript, in every worker.
+        """
+        self._transcripts.forget(chatroom_id)
+
+    def transcript_stats(self) -> TranscriptCacheStats:
+        return self._transcripts.stats()
+
+    async def add_message(self, chatroom_id, sender_id, message_body) -> models.Message:
+        # Taking the chatroom's next sequence number locks its row until the
+        # transaction ends, so its messages are numbered in the order they're committed
+        await self.update_chatroom(
+            chatroom_id, message_seq=models.Chatroom.message_seq + 1
+        )
+        seq = await db.session.execute(
+            select(models.Chatroom.message_seq).filter_by(id=chatroom_id)
+        )
         self.add(
             message := models.Message(
                 chatroom_id=chatroom_id,
                 sender_id=sender_id,
                 body=message_body,
                 send_time=datetime.now(),
+                seq=seq.scalar_one(),
             )
         )
+        message.set_final_body(message_body)
+        self._transcript_changed(message)
         return message
 
+    def set_final_body(self, message: models.Message, body: str) -> None:
+        message.set_final_body(body)
+        self._transcript_changed(message)
+        self._wrote()
+
+    def mark_rephrased(self, message: models.Message) -> None:
+        message.has_rephrasings = True
+        self._transcript_changed(message)
+        self._wrote()
+
     async def rephrasing(self, id) -> Optional[models.Rephrasing]:
         self._check_explicit_transaction()
         return await self.session.get(models.Rephrasing, id)
@@ -106,19 +453,33 @@ class DataAccess:
         )
         return rephrasing
 
-    async def user(self, id) -> Optional[models.User]:
+    async def user(
+        self, id, *, select_chatroom: bool = True, select_messages: bool = True
+    ) -> Optional[models.User]:
         self._check_explicit_transaction()
-        return await db.session.get(
-            models.User,
-            id,
-            options=[
-                # I don't know if it's a good practice to use selectinload here, but we
-                # use these attributes all over the place and they're not particularly
-                # large, so I think it's fine.
-                selectinload(models.User.chatroom),
-                selectinload(models.User.messages),
-            ],
+        # I don't know if it's a good practice to use selectinload here, but we use
+        # these attributes all over the place and they're not particularly large, so I
+        # think it's fine.
+        options = []
+        if select_chatroom:
+            options.append(selectinload(models.User.chatroom))
+        if select_messages:
+            options.append(selectinload(models.User.messages))
+        return await db.session.get(models.User, id, options=options)
+
+    async def update_user(self, id, *conditions, **values) -> bool:
+        """
+        Update a user without loading them, if they meet any conditions given. Values
+        can be SQL expressions. Returns whether the user was updated.
+        """
+        self._check_explicit_transaction()
+        result = await db.session.execute(
+            update(models.User)
+            .where(models.User.id == id, *conditions)
+            .values(**values)
         )
+        self._wrote()
+        return result.rowcount == 1
 
     async def users_in_waiting_room(
         self,
@@ -150,25 +511,96 @@ class DataAccess:
         )
         return users.scalars().all()
 
+    @staticmethod
+    def _users_to_match_with(user: Union[models.User, UserSnapshot]):
+        return select(models.User).filter(
+            models.User.id != user.id,
+            models.User.waiting_session_id.isnot(None),
+            models.User.found_match_time.is_(None),
+            models.User.position == user.match_with,
+        )
+
     async def random_user_to_match_with(
         self, user: models.User
     ) -> Optional[models.User]:
         self._check_explicit_transaction()
-        user_query = (
+        user_query = self._users_to_match_with(user).order_by(
+            models.User.started_waiting_time.asc()
+        )
+        user = await db.session.execute(user_query)
+        results = user.scalars().all()
+        if not results:
+            return None
+        return random.choice(results)
+
+    async def lock_user_to_match(
+        self, id, *, skip_locked=True
+    ) -> Optional[models.User]:
+        """
+        Lock a waiting, unmatched user until the end of the transaction. If another
+        transaction already has them locked (i.e. is matching them), they're skipped,
+        unless skip_locked is False, in which case this waits for that transaction and
+        returns None if it matched them. Only for databases that support SKIP LOCKED,
+        like Postgres.
+        """
+        self._check_explicit_transaction()
+        user = await db.session.execute(
             select(models.User)
             .filter(
-                models.User.id != user.id,
+                models.User.id == id,
                 models.User.waiting_session_id.isnot(None),
                 models.User.found_match_time.is_(None),
-                models.User.position == user.match_with,
             )
+            .with_for_update(skip_locked=skip_locked)
+            # We've likely loaded this user already, before locking them
+            .execution_options(populate_existing=True)
+        )
+        return user.scalar()
+
+    async def claim_user_to_match_with(
+        self, user: Union[models.User, UserSnapshot]
+    ) -> Optional[models.User]:
+        """
+        Like random_user_to_match_with, but locks the user it returns until the end of
+        the transaction. Users who have waited longest are matched first. Users that
+        other transactions have locked are skipped.
+        """
+        self._check_explicit_transaction()
+        match_user = await db.session.execute(
+            self._users_to_match_with(user)
             .order_by(models.User.started_waiting_time.asc())
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .execution_options(populate_existing=True)
         )
-        user = await db.session.execute(user_query)
-        results = user.scalars().all()
-        if not results:
-            return None
-        return random.choice(results)
+        return match_user.scalar()
+
+    async def has_user_to_match_with(
+        self, user: Union[models.User, UserSnapshot]
+    ) -> bool:
+        """
+        Whether there's any user to match with, including ones other transactions
+        have locked.
+        """
+        self._check_explicit_transaction()
+        result = await db.session.execute(
+            self._users_to_match_with(user).with_only_columns(models.User.id).limit(1)
+        )
+        return result.scalar() is not None
+
+    async def is_waiting_to_match(self, id) -> bool:
+        """
+        Whether a user is still waiting and unmatched, without locking them.
+        """
+        self._check_explicit_transaction()
+        result = await db.session.execute(
+            select(models.User.id).filter(
+                models.User.id == id,
+                models.User.waiting_session_id.isnot(None),
+                models.User.found_match_time.is_(None),
+            )
+        )
+        return result.scalar() is not None
 
     async def users_in_chatroom(
         self, *, position: UserPosition = None, filter_ids: List[int] = None
@@ -185,6 +617,64 @@ class DataAccess:
         users = await db.session.execute(user_query.where(and_(*filters)))
         return users.scalars().all()
 
+    async def online_user_counts(self) -> Dict[UserPosition, OnlineUserCounts]:
+        """
+        Counts of users in the waiting room (matched and unmatched) and in chatrooms
+        by position, in one statement. These agree with the lengths of what
+        users_in_waiting_room and users_in_chatroom return.
+        """
+        self._check_explicit_transaction()
+        # Grouping the waiting room and chatrooms separately means each half is
+        # counted from its own partial index, instead of the whole table being
+        # scanned for users in either
+        waiting_room_counts = (
+            select(
+                models.User.position,
+                func.count().filter(models.User.found_match_time.is_(None)),
+                func.count().filter(models.User.found_match_time.isnot(None)),
+                literal_column("0"),
+            )
+            .where(models.User.waiting_session_id.isnot(None))
+            .group_by(models.User.position)
+        )
+        chatroom_counts = (
+            select(
+                models.User.position,
+                literal_column("0"),
+                literal_column("0"),
+                func.count(),
+            )
+            .where(models.User.chatroom_session_id.isnot(None))
+            .group_by(models.User.position)
+        )
+        counts = {position: [0, 0, 0] for position in UserPosition}
+        for position, *position_counts in await db.session.execute(
+            union_all(waiting_room_counts, chatroom_counts)
+        ):
+            position = UserPosition(position)
+            counts[position] = [
+                count + more for count, more in zip(counts[position], position_counts)
+            ]
+        return {
+            position: OnlineUserCounts(*position_counts)
+            for position, position_counts in counts.items()
+        }
+
+    async def chatroom_has_sessions(self, chatroom_id) -> bool:
+        """
+        Whether either of the chatroom's users is connected to it.
+        """
+        self._check_explicit_transaction()
+        connected = await db.session.execute(
+            select(
+                select(models.User.id)
+                .filter_by(chatroom_id=chatroom_id)
+                .filter(models.User.chatroom_session_id.is_not(None))
+                .exists()
+            )
+        )
+        return connected.scalar()
+
     async def other_user_in_chatroom(
         self, chatroom_id, user_id
     ) -> Optional[models.User]:
@@ -210,6 +700,27 @@ class DataAccess:
         )
         return user.scalar_one_or_none()
 
+    async def user_identity(self, response_id) -> Optional[UserIdentity]:
+        """
+        Just enough to authenticate a user, without loading the user.
+        """
+        if identity := self._user_identities.get(response_id):
+            return identity
+        self._check_explicit_transaction()
+        row = (
+            await db.session.execute(
+                select(models.User.id, models.User.position).filter_by(
+                    response_id=response_id
+                )
+            )
+        ).one_or_none()
+        if row is None:
+            # Don't cache this, since the user could sign up in another process
+            return None
+        identity = UserIdentity(row.id, row.position)
+        self._user_identities.set(response_id, identity)
+        return identity
+
     async def process_login(self, response_id) -> Optional[models.User]:
         self._check_explicit_transaction()
         # TODO: This isn't really that useful other than for providing an API
@@ -225,6 +736,7 @@ class DataAccess:
         user = models.User(response_id=response_id, position=position)
 
         self.add(user)
+        self._user_identities.invalidate(response_id)
 
         return user
 
@@ -252,5 +764,141 @@ async def build_prod_database(force=False) -> None:
         await connection.run_sync(models.Base.metadata.create_all)
 
 
+def create_missing_schema(connection) -> None:
+    # create_all only creates columns and indexes along with their tables, so add
+    # columns and create indexes added to existing tables separately
+    models.Base.metadata.create_all(connection)
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table in models.Base.metadata.tables.values():
+        existing_columns = {
+            column["name"] for column in inspector.get_columns(table.name)
+        }
+        for column in table.columns:
+            if column.name not in existing_columns:
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN "
+                        f"{CreateColumn(column).compile(dialect=connection.dialect)}"
+                    )
+                )
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def backfill_final_bodies(connection) -> None:
+    """
+    Set final_body, word_count and has_rephrasings on messages sent before they were
+    added to the messages table.
+    """
+    messages = models.Message.__table__
+    rephrasing = aliased(models.Rephrasing)
+    has_rephrasings = (
+        select(models.Rephrasing.id)
+        .where(models.Rephrasing.message_id == models.Message.id)
+        .exists()
+    )
+    rows = connection.execute(
+        select(
+            models.Message.id,
+            models.Message.body,
+            models.Message.edited_body,
+            rephrasing.body,
+            rephrasing.edited_body,
+            has_rephrasings,
+        )
+        .outerjoin(rephrasing, rephrasing.id == models.Message.accepted_rephrasing_id)
+        .where(models.Message.final_body.is_(None))
+    ).all()
+    if not rows:
+        return
+
+    values = []
+    for message_id, body, edited_body, *accepted_rephrasing, rephrased in rows:
+        rephrasing_body, rephrasing_edited_body = accepted_rephrasing
+        if rephrasing_body is not None:
+            final_body = rephrasing_edited_body or rephrasing_body
+        else:
+            final_body = edited_body or body
+        values.append(
+            {
+                "message_id": message_id,
+                "new_final_body": final_body,
+                "new_word_count": len(final_body.split()),
+                "new_has_rephrasings": rephrased,
+            }
+        )
+    connection.execute(
+        update(messages)
+        .where(messages.c.id == bindparam("message_id"))
+        .values(
+            final_body=bindparam("new_final_body"),
+            word_count=bindparam("new_word_count"),
+            has_rephrasings=bindparam("new_has_rephrasings"),
+        ),
+        values,
+    )
+
+
+def backfill_message_seqs(connection) -> None:
+    """
+    Number messages sent before messages had sequence numbers in the order they were
+    sent, and set each chatroom's last sequence number.
+    """
+    messages = models.Message.__table__
+    chatrooms = models.Chatroom.__table__
+    rows = connection.execute(
+        select(messages.c.id, messages.c.chatroom_id)
+        .where(messages.c.seq.is_(None))
+        .order_by(messages.c.chatroom_id, messages.c.send_time, messages.c.id)
+    ).all()
+    if rows:
+        last_seqs = dict(
+            connection.execute(
+                select(messages.c.chatroom_id, func.max(messages.c.seq)).group_by(
+                    messages.c.chatroom_id
+                )
+            ).all()
+        )
+        values = []
+        for message_id, chatroom_id in rows:
+            last_seqs[chatroom_id] = (last_seqs.get(chatroom_id) or 0) + 1
+            values.append({"message_id": message_id, "new_seq": last_seqs[chatroom_id]})
+        connection.execute(
+            update(messages)
+            .where(messages.c.id == bindparam("message_id"))
+            .values(seq=bindparam("new_seq")),
+            values,
+        )
+
+    connection.execute(
+        update(chatrooms)
+        .where(chatrooms.c.message_seq.is_(None))
+        .values(
+            message_seq=func.coalesce(
+                select(func.max(messages.c.seq))
+                .where(messages.c.chatroom_id == chatrooms.c.id)
+                .scalar_subquery(),
+                0,
+            )
+        )
+    )
+
+
+async def migrate_database() -> None:
+    """
+    Bring an existing database up to date with the models by adding any tables,
+    columns and indexes it doesn't have, and filling in the denormalized message
+    columns and message sequence numbers. Creating the unique index on
+    users.response_id fails if there are already users with duplicate response IDs.
+    """
+    SQLALCHEMY_DATABASE_URL = os.getenv("DB_URI") or "sqlite+aiosqlite:///"
+    engine = create_async_engine(SQLALCHEMY_DATABASE_URL, future=True, echo=True)
+    async with engine.begin() as connection:
+        await connection.run_sync(create_missing_schema)
+        await connection.run_sync(backfill_final_bodies)
+        await connection.run_sync(backfill_message_seqs)
+
+
 # Using the magic of contextvars
 access: DataAccess = DataAccess()
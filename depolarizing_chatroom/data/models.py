@@ -8,6 +8,7 @@ from sqlalchemy import (
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
@@ -33,6 +34,8 @@ class Chatroom(Base):
     # This is a really hacky way of making the initial view messages show up in a random
     # order
     swap_view_messages = Column(Boolean, default=False)
+    # The sequence number of the chatroom's last message (see Message.seq)
+    message_seq = Column(Integer, default=0)
 
     # Relationships (one-to-many with users, one-to-many with messages)
     users = relationship("User", back_populates="chatroom")
@@ -48,6 +51,11 @@ class Rephrasing(Base):
     edited_body = Column(Text)
     strategy = Column(Text)
 
+    __table_args__ = (
+        # Loading a message's rephrasings
+        Index("ix_rephrasings_message_id", message_id),
+    )
+
     # Relationship (many-to-one with messages)
     message = relationship(
         "Message",
@@ -72,6 +80,22 @@ class Message(Base):
     edited_body = Column(Text)
     send_time = Column(DateTime, nullable=False)
     accepted_rephrasing_id = Column(Integer, ForeignKey("rephrasings.id"))
+    # Numbers the chatroom's messages from 1, in the order they were committed, so
+    # clients can ask for the messages after the last one they saw
+    seq = Column(Integer)
+    # Kept up to date when the message is sent and when its sender responds to
+    # rephrasings, so reading chat history doesn't have to load rephrasings or count
+    # words (see set_final_body)
+    final_body = Column(Text)
+    word_count = Column(Integer)
+    has_rephrasings = Column(Boolean, default=False)
+
+    __table_args__ = (
+        # A chatroom's messages, in order, from any point (DataAccess.chatroom_messages)
+        Index("ix_messages_chatroom_id_seq", chatroom_id, seq, unique=True),
+        # A user's messages, in order (User.messages)
+        Index("ix_messages_sender_id_send_time", sender_id, send_time),
+    )
 
     # Relationships (one-to-many with rephrasings, many-to-one with chatroom,
     # many-to-one with user)
@@ -90,12 +114,13 @@ class Message(Base):
     chatroom = relationship("Chatroom", back_populates="messages")
     user = relationship("User", back_populates="messages")
 
-    @property
-    def selected_body(self) -> str:
-        if not (rephrasing := self.accepted_rephrasing):
-            return self.edited_body or self.body
-
-        return rephrasing.selected_body
+    def set_final_body(self, body: str) -> None:
+        """
+        Set the body shown in the chatroom (the edited body, or the accepted
+        rephrasing's), and its word count (just counting by spaces).
+        """
+        self.final_body = body
+        self.word_count = len(body.split())
 
 
 class UserPosition(str, enum.Enum):
@@ -126,6 +151,11 @@ class UserEvent(Base):
     event_time = Column(DateTime, nullable=False)
     event_data = Column(JSON)
 
+    __table_args__ = (
+        # A user's events, in order (User.events)
+        Index("ix_user_events_user_id_event_time", user_id, event_time),
+    )
+
     # Relationships (many-to-one with users)
     user = relationship("User", back_populates="events")
 
@@ -171,6 +201,32 @@ class User(Base):
     # Reason provided by user for leaving chat early
     leave_reason = Column(Text)
 
+    __table_args__ = (
+        # Looking up users by response ID happens on every authenticated request
+        Index("ix_users_response_id", response_id, unique=True),
+        # Users waiting for a match, or matched and waiting to enter the chatroom, in
+        # the order they started waiting (DataAccess.users_in_waiting_room and
+        # DataAccess.random_user_to_match_with)
+        Index(
+            "ix_users_waiting_room",
+            position,
+            found_match_time,
+            started_waiting_time,
+            postgresql_where=waiting_session_id.isnot(None),
+            sqlite_where=waiting_session_id.isnot(None),
+        ),
+        # Users in chatrooms (DataAccess.users_in_chatroom)
+        Index(
+            "ix_users_in_chatroom",
+            position,
+            postgresql_where=chatroom_session_id.isnot(None),
+            sqlite_where=chatroom_session_id.isnot(None),
+        ),
+        # The users in a chatroom (Chatroom.users and
+        # DataAccess.other_user_in_chatroom)
+        Index("ix_users_chatroom_id", chatroom_id),
+    )
+
     # Relationships (many-to-one with chatrooms, one-to-many with messages, one-to-many
     # with events)
     chatroom = relationship("Chatroom", back_populates="users")
@@ -230,3 +286,13 @@ class User(Base):
             if NO_CHAT_URL
             else None
         )
+
+
+class UserTemplate(Base):
+    __tablename__ = "user_templates"
+
+    # Template editor documents aren't tied to users in the users table
+    user_id = Column(String, primary_key=True)
+    data = Column(JSON, nullable=False)
+    # Optimistic concurrency control for saves
+    version = Column(Integer, nullable=False)
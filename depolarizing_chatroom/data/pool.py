@@ -0,0 +1,162 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Postgres allows 100 connections by default and reserves 3 of them for superusers.
+# Leave some more for migrations and psql.
+DEFAULT_CONNECTION_BUDGET = 90
+# The share of each worker's connections that only open under load
+OVERFLOW_SHARE = 0.2
+
+
+class CheckoutMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.checkouts += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Keeps track of how long it takes to check connections out, which includes waiting
+    for one to be checked in when the pool is exhausted, and how often that times
+    out.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_metrics = CheckoutMetrics()
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            self.checkout_metrics.timeouts += 1
+            raise
+        finally:
+            self.checkout_metrics.record(time.perf_counter() - start)
+
+
+@dataclass(frozen=True)
+class PoolSettings:
+    """
+    Per-worker pool settings. Each worker gets an equal share of the connections the
+    whole deployment is allowed to open.
+    """
+
+    pool_size: int
+    max_overflow: int
+    # Seconds to wait for a connection before giving up
+    timeout: float
+    pre_ping: bool
+    # Seconds before connections are replaced, or -1 to keep them
+    recycle: int
+
+    @classmethod
+    def for_workers(
+        cls,
+        workers: int,
+        connection_budget: int = DEFAULT_CONNECTION_BUDGET,
+        *,
+        extra_connections: int = 0,
+        timeout: float = 30,
+        pre_ping: bool = False,
+        recycle: int = -1,
+    ) -> "PoolSettings":
+        """
+        :param extra_connections: connections each worker opens outside its pool,
+            which come out of its share
+        :raises ValueError: if the budget doesn't leave every worker a connection
+        """
+        if (connections := connection_budget // workers - extra_connections) < 1:
+            raise ValueError(
+                f"A budget of {connection_budget} connections isn't enough for "
+                f"{workers} workers"
+            )
+        max_overflow = int(connections * OVERFLOW_SHARE)
+        return cls(connections - max_overflow, max_overflow, timeout, pre_ping, recycle)
+
+    @classmethod
+    def from_env(cls) -> "PoolSettings":
+        """
+        Settings for the number of workers in WEB_CONCURRENCY (which gunicorn also
+        reads), within a budget of DB_CONNECTION_BUDGET connections. With
+        DB_NOTIFICATIONS set to 1, each worker also keeps a connection open to listen
+        on (see notifications.py), which comes out of the budget. DB_POOL_SIZE and
+        DB_MAX_OVERFLOW override the calculated sizes.
+        """
+        settings = cls.for_workers(
+            int(os.getenv("WEB_CONCURRENCY") or 1),
+            int(os.getenv("DB_CONNECTION_BUDGET") or DEFAULT_CONNECTION_BUDGET),
+            extra_connections=1 if os.getenv("DB_NOTIFICATIONS") == "1" else 0,
+            timeout=float(os.getenv("DB_POOL_TIMEOUT") or 30),
+            pre_ping=os.getenv("DB_POOL_PRE_PING", "0") == "1",
+            recycle=int(os.getenv("DB_POOL_RECYCLE") or -1),
+        )
+        return cls(
+            int(os.getenv("DB_POOL_SIZE") or settings.pool_size),
+            int(os.getenv("DB_MAX_OVERFLOW") or settings.max_overflow),
+            settings.timeout,
+            settings.pre_ping,
+            settings.recycle,
+        )
+
+    def engine_args(self, url: str) -> Dict[str, Any]:
+        # SQLite doesn't get a connection queue by default, so there's nothing to size
+        # (see data/sqlite.py for SQLite files)
+        if make_url(url).get_backend_name() == "sqlite":
+            return dict(pool_pre_ping=self.pre_ping, pool_recycle=self.recycle)
+        return self.queue_pool_args()
+
+    def queue_pool_args(self) -> Dict[str, Any]:
+        return dict(
+            poolclass=InstrumentedQueuePool,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=self.timeout,
+            pool_pre_ping=self.pre_ping,
+            pool_recycle=self.recycle,
+        )
+
+
+@dataclass(frozen=True)
+class PoolStats:
+    size: int
+    checked_out: int
+    # Connections open beyond size
+    overflow: int
+    checkouts: int
+    checkout_timeouts: int
+    mean_checkout_seconds: float
+    max_checkout_seconds: float
+
+
+def pool_stats(engine: AsyncEngine) -> Optional[PoolStats]:
+    """
+    Returns None if the engine's pool isn't instrumented.
+    """
+    if not isinstance(pool := engine.sync_engine.pool, InstrumentedQueuePool):
+        return None
+    metrics = pool.checkout_metrics
+    return PoolStats(
+        pool.size(),
+        pool.checkedout(),
+        max(pool.overflow(), 0),
+        metrics.checkouts,
+        metrics.timeouts,
+        metrics.total_seconds / metrics.checkouts if metrics.checkouts else 0.0,
+        metrics.max_seconds,
+    )
@@ -0,0 +1,166 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from ..logger import format_parameterized_log_message, logger
+
+# Running the same statement this many times in one scope is probably an N+1 query
+REPEATED_STATEMENT_THRESHOLD = 5
+
+
+class QueryBudgetExceededError(AssertionError):
+    pass
+
+
+class QueryScope:
+    """
+    The statements run while handling one thing, like an HTTP request or a socket
+    event. Statements are counted by their SQL, so running the same statement with
+    different parameters counts as repeating it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.statements: Counter = Counter()
+        self.seconds = 0.0
+
+    @property
+    def statement_count(self) -> int:
+        return sum(self.statements.values())
+
+    def repeated_statements(
+        self, threshold: int = REPEATED_STATEMENT_THRESHOLD
+    ) -> Dict[str, int]:
+        return {
+            statement: count
+            for statement, count in self.statements.items()
+            if count >= threshold
+        }
+
+
+@dataclass(frozen=True)
+class QueryStats:
+    calls: int
+    statements: int
+    max_statements: int
+    seconds: float
+    # Calls with repeated statements (see QueryScope.repeated_statements)
+    repeated_statement_calls: int
+
+
+class QueryStatsRegistry:
+    """
+    Totals for every scope name seen by this process.
+    """
+
+    def __init__(self):
+        self._stats: Dict[str, QueryStats] = {}
+        self._lock = Lock()
+
+    def record(self, scope: QueryScope) -> None:
+        with self._lock:
+            stats = self._stats.get(scope.name, QueryStats(0, 0, 0, 0.0, 0))
+            self._stats[scope.name] = QueryStats(
+                stats.calls + 1,
+                stats.statements + scope.statement_count,
+                max(stats.max_statements, scope.statement_count),
+                stats.seconds + scope.seconds,
+                stats.repeated_statement_calls + bool(scope.repeated_statements()),
+            )
+
+    def stats(self) -> Dict[str, QueryStats]:
+        with self._lock:
+            return dict(self._stats)
+
+
+_current_scopes: ContextVar[List[QueryScope]] = ContextVar(
+    "_current_scopes", default=[]
+)
+_listening = False
+query_stats = QueryStatsRegistry()
+
+
+def _before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _many):
+    if _current_scopes.get():
+        conn.info.setdefault("query_start_times", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, _cursor, statement, _parameters, _context, _many):
+    if not (scopes := _current_scopes.get()):
+        return
+    seconds = time.perf_counter() - conn.info["query_start_times"].pop()
+    for scope in scopes:
+        scope.statements[statement] += 1
+        scope.seconds += seconds
+
+
+def _listen() -> None:
+    # Every engine, including ones that only tests create
+    global _listening
+    if not _listening:
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _listening = True
+
+
+@contextmanager
+def query_scope(name: str, *, record: bool = True) -> Iterator[QueryScope]:
+    """
+    Count the statements run in the block, including in any scopes inside it. Unless
+    record is False, the scope is added to query_stats under its name when the block
+    ends (it can be renamed before then), and repeated statements are logged.
+    """
+    _listen()
+    scope = QueryScope(name)
+    token = _current_scopes.set([*_current_scopes.get(), scope])
+    try:
+        yield scope
+    finally:
+        _current_scopes.reset(token)
+    if not record:
+        return
+    query_stats.record(scope)
+    for statement, count in scope.repeated_statements().items():
+        logger.warning(
+            format_parameterized_log_message(
+                "Statement repeated, possibly an N+1 query",
+                scope=scope.name,
+                count=count,
+                statement=" ".join(statement.split()),
+            )
+        )
+
+
+@contextmanager
+def query_budget(
+    max_statements: int, *, max_repeats: Optional[int] = None
+) -> Iterator[QueryScope]:
+    """
+    For tests: fail if the block runs more than max_statements statements, or runs
+    any statement more than max_repeats times.
+
+    :raises QueryBudgetExceededError:
+    """
+    with query_scope("query budget", record=False) as scope:
+        yield scope
+    if scope.statement_count > max_statements:
+        raise QueryBudgetExceededError(
+            f"{scope.statement_count} statements run, expected at most "
+            f"{max_statements}:\n\n" + "\n\n".join(scope.statements)
+        )
+    if max_repeats is not None and (
+        repeated := scope.repeated_statements(max_repeats + 1)
+    ):
+        raise QueryBudgetExceededError(
+            "Statements repeated:\n\n"
+            + "\n\n".join(
+                f"{count} times: {statement}" for statement, count in repeated.items()
+            )
+        )
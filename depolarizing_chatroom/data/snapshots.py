@@ -0,0 +1,51 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from . import models
+from .models import UserPosition, UserTreatment
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """
+    A user's state at some point, detached from any database session. Socket sessions
+    keep these between events instead of loading users for every event.
+    """
+
+    id: int
+    position: UserPosition
+    treatment: Optional[UserTreatment]
+    chatroom_id: Optional[int]
+
+    @classmethod
+    def of(cls, user: models.User) -> "UserSnapshot":
+        return cls(user.id, user.position, user.treatment, user.chatroom_id)
+
+    # These match the properties of the same names on User
+
+    @property
+    def match_with(self) -> UserPosition:
+        return (
+            UserPosition.SUPPORT
+            if self.position == UserPosition.OPPOSE
+            else UserPosition.OPPOSE
+        )
+
+    @property
+    def receives_rephrasings(self) -> bool:
+        return self.treatment is UserTreatment.TREATED
+
+    @property
+    def in_control_conversation(self) -> bool:
+        return self.treatment is UserTreatment.CONTROL
+
+
+@dataclass(frozen=True)
+class ChatroomSnapshot:
+    id: int
+    limit_reached: bool
+    swap_view_messages: bool
+
+    @classmethod
+    def of(cls, chatroom: models.Chatroom) -> "ChatroomSnapshot":
+        return cls(chatroom.id, chatroom.limit_reached, chatroom.swap_view_messages)
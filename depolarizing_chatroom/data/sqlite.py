@@ -0,0 +1,117 @@
+from dataclasses import dataclass
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.orm import Session
+
+from .pool import PoolSettings
+
+SQLITE_PRAGMAS = {
+    # Readers don't block the writer, and the writer doesn't block readers
+    "journal_mode": "WAL",
+    # With WAL, commits are only synced at checkpoints. Losing power can lose the last
+    # few commits, but can't corrupt the database.
+    "synchronous": "NORMAL",
+    # Negative sizes are in KiB, so 64MB per connection
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    # In milliseconds. Other processes' writes are waited for instead of failing
+    # straight away with "database is locked".
+    "busy_timeout": 5000,
+}
+
+
+def is_sqlite_file(url: str) -> bool:
+    """
+    Whether the URL is for an SQLite database in a file, rather than in memory.
+    """
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database not in (
+        None,
+        "",
+        ":memory:",
+    )
+
+
+def _set_pragmas(dbapi_connection, _connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+class SQLiteSession(Session):
+    """
+    Reads through the reader engine until the transaction writes anything, then goes
+    through the writer engine until the transaction ends. The writer only has one
+    connection, so transactions that write take turns instead of fighting over
+    SQLite's write lock, while reads run concurrently.
+
+    Use through SQLiteEngines.session_args.
+    """
+
+    reader: Engine
+    writer: Engine
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        bind = super().get_bind(mapper, clause, **kwargs)
+        # Sessions bound to another engine, like a replica, aren't routed
+        if bind is not self.reader:
+            return bind
+        if (
+            self.info.get("writing")
+            or self._flushing
+            or (clause is not None and clause.is_dml)
+        ):
+            self.info["writing"] = True
+            return self.writer
+        return self.reader
+
+
+@event.listens_for(SQLiteSession, "after_transaction_end")
+def _stop_writing(session: SQLiteSession, transaction) -> None:
+    # Savepoints end inside their transaction
+    if transaction.parent is None:
+        session.info.pop("writing", None)
+
+
+@dataclass(frozen=True)
+class SQLiteEngines:
+    reader: AsyncEngine
+    writer: AsyncEngine
+
+    @property
+    def session_args(self) -> Dict[str, Any]:
+        """
+        Arguments for sessions bound to the reader, to make them send writes to the
+        writer.
+        """
+        session_class = type(
+            "SQLiteSession",
+            (SQLiteSession,),
+            {"reader": self.reader.sync_engine, "writer": self.writer.sync_engine},
+        )
+        return {"sync_session_class": session_class}
+
+    async def dispose(self) -> None:
+        await self.reader.dispose()
+        await self.writer.dispose()
+
+
+def create_sqlite_engines(url: str, pool_settings: PoolSettings) -> SQLiteEngines:
+    """
+    Engines for an SQLite file in WAL mode. The reader pool is sized like any other
+    pool, and the writer pool has a single connection, so waiting to write is waiting
+    to check it out (and times out the same way).
+    """
+    pool_args = pool_settings.queue_pool_args()
+    engines = SQLiteEngines(
+        create_async_engine(url, **pool_args),
+        create_async_engine(url, **{**pool_args, "pool_size": 1, "max_overflow": 0}),
+    )
+    for engine in (engines.reader, engines.writer):
+        event.listen(engine.sync_engine, "connect", _set_pragmas)
+    return engines
@@ -1,14 +1,32 @@
+import copy
+import hashlib
 import html
 import json
-from dataclasses import dataclass
+import marshal
+from dataclasses import asdict, dataclass, field
 from functools import partial
+from itertools import chain
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Set, Union
+from threading import Lock
+from types import CodeType
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    List,
+    MutableMapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import jinja2
 import jinja2.defaults
 import jinja2.nodes
 
+from .template_graph import TemplateDependencyGraph
+
 DEFAULT_JINJA_NAMES = set(
     {
         **jinja2.defaults.DEFAULT_FILTERS,
@@ -17,6 +35,44 @@ DEFAULT_JINJA_NAMES = set(
     }
 )
 
+# Default names that can give a different result each time a template is rendered, so
+# output that uses them can't be pre-rendered
+NONDETERMINISTIC_JINJA_NAMES = {"random", "lipsum"}
+
+# Nodes that can make one part of a template depend on names defined in another part.
+# We don't split templates that use any of these into segments.
+SCOPE_DEPENDENT_NODES = (
+    jinja2.nodes.Assign,
+    jinja2.nodes.AssignBlock,
+    jinja2.nodes.Block,
+    jinja2.nodes.CallBlock,
+    jinja2.nodes.Extends,
+    jinja2.nodes.FromImport,
+    jinja2.nodes.Import,
+    jinja2.nodes.Include,
+    jinja2.nodes.Macro,
+)
+
+
+@dataclass
+class TemplateSegment:
+    """
+    A run of top-level template output. Segments that are data-independent are
+    rendered once when their template manager is created (see `text`); everything else
+    is compiled once and rendered with `data` on each call to `TemplateManager.render`.
+    """
+
+    # Not available for segments loaded from a PrecompiledTemplateManager
+    node: Optional[jinja2.nodes.Template]
+    static_names: Set[str]
+    data_independent: bool
+    compiled: Optional[jinja2.Template] = None
+    # Python source generated by Jinja for `compiled`, and the bytecode it compiles to
+    source: Optional[str] = None
+    code: Optional[CodeType] = None
+    # Pre-rendered, unescaped output of a data-independent segment
+    text: Optional[str] = None
+
 
 @dataclass
 class PromptTemplate:
@@ -24,6 +80,91 @@ class PromptTemplate:
     default_names: Set[str]
     static_names: Set[str]
     filter_names: Set[str]
+    # These are filled in by TemplateManager once it knows how templates depend on
+    # each other
+    segments: List[TemplateSegment] = field(default_factory=list)
+    # Templates this template uses by name (directly or not) that have to be rendered
+    # before it, in order
+    render_plan: List[str] = field(default_factory=list)
+    data_independent: bool = False
+    # Not available for templates loaded from a PrecompiledTemplateManager
+    source: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class CompiledSegment:
+    """
+    What compiling a segment produces that can be shared between template managers:
+    everything but the jinja2.Template, which belongs to a manager's environment.
+    """
+
+    source: str
+    code: CodeType
+
+
+@dataclass(frozen=True)
+class PrecompiledSegment:
+    static_names: FrozenSet[str]
+    data_independent: bool
+    # Either source is set, or text is
+    source: Optional[str]
+    text: Optional[str]
+    # Marshalled bytecode for source. This can only be loaded by the same version of
+    # Python that created it.
+    code: Optional[bytes] = None
+
+    def load(self, environment: jinja2.Environment) -> TemplateSegment:
+        code = None
+        if self.code is not None:
+            code = marshal.loads(self.code)
+        elif self.source is not None:
+            code = compile_template_source(self.source)
+        return TemplateSegment(
+            None,
+            set(self.static_names),
+            self.data_independent,
+            template_from_code(environment, code) if code is not None else None,
+            self.source,
+            code,
+            self.text,
+        )
+
+
+@dataclass(frozen=True)
+class PrecompiledTemplate:
+    default_names: FrozenSet[str]
+    static_names: FrozenSet[str]
+    filter_names: FrozenSet[str]
+    segments: Tuple[PrecompiledSegment, ...]
+    render_plan: Tuple[str, ...]
+    data_independent: bool
+
+    def load(self, environment: jinja2.Environment) -> PromptTemplate:
+        return PromptTemplate(
+            None,
+            set(self.default_names),
+            set(self.static_names),
+            set(self.filter_names),
+            [segment.load(environment) for segment in self.segments],
+            list(self.render_plan),
+            self.data_independent,
+        )
+
+
+@dataclass(frozen=True)
+class PrecompiledTemplateManager:
+    """
+    A picklable form of a TemplateManager, for rendering in other processes (see
+    `render_precompiled`) or for loading quickly (see `template_bundle`). Templates
+    are stored as the Python source that Jinja compiles them to and its bytecode, so
+    loading one doesn't parse or compile anything.
+    """
+
+    # Hash of everything below, used to load each precompiled manager once per process
+    key: str
+    root: PrecompiledTemplate
+    templates: Dict[str, PrecompiledTemplate]
+    constants: Dict[str, str]
 
 
 class UndefinedTemplateNameError(Exception):
@@ -64,6 +205,23 @@ class HorribleConfusingListWrapperThatMakesTemplateAccessPatternWork:
             raise TypeError(f"Index must be int or slice, not {type(index)}")
 
 
+def create_environment() -> jinja2.Environment:
+    return jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+
+
+def compile_template_source(source: str) -> CodeType:
+    return compile(source, "<template>", "exec")
+
+
+def template_from_code(
+    environment: jinja2.Environment, code: CodeType
+) -> jinja2.Template:
+    # This is what Environment.from_string does once it has compiled a template
+    return environment.template_class.from_code(
+        environment, code, environment.make_globals(None)
+    )
+
+
 def listify(fn, value):
     # run fn on value if it is a string, or run it over each element of value if it
     # is a list
@@ -72,14 +230,98 @@ def listify(fn, value):
     return fn(value)
 
 
+def is_data_independent(node: jinja2.nodes.Node, constant_names: Set[str]) -> bool:
+    # Filters that name other templates are fine here: a template used as a filter
+    # is rendered with the filtered value as its data, so its output depends only on
+    # that value. Names are only fine if they're for templates that have a constant
+    # value—sub-templates used by name are rendered with the same data as the
+    # template that uses them.
+    for n in chain([node], node.find_all((jinja2.nodes.Name, jinja2.nodes.Filter))):
+        if not isinstance(n, (jinja2.nodes.Name, jinja2.nodes.Filter)):
+            continue
+        if n.name in NONDETERMINISTIC_JINJA_NAMES:
+            return False
+        if (
+            isinstance(n, jinja2.nodes.Name)
+            and n.name not in DEFAULT_JINJA_NAMES
+            and n.name not in constant_names
+        ):
+            return False
+    return True
+
+
+def split_segments(
+    parsed_template: jinja2.nodes.Template,
+    default_names: Set[str],
+    constant_names: Set[str],
+) -> List[TemplateSegment]:
+    """
+    Split a template's top-level output into maximal runs that either do or don't
+    depend on `data`. `constant_names` are the templates whose output doesn't.
+    """
+    if next(parsed_template.find_all(SCOPE_DEPENDENT_NODES), None) is not None:
+        items = [(node, False) for node in parsed_template.body]
+    else:
+        items = []
+        for node in parsed_template.body:
+            # Output nodes hold literal template data and {{ expressions }} side by
+            # side, so split them up to find where the data-dependent parts are
+            children = node.nodes if isinstance(node, jinja2.nodes.Output) else [node]
+            items.extend(
+                (child, is_data_independent(child, constant_names))
+                for child in children
+            )
+
+    runs = []
+    for item, data_independent in items:
+        if not runs or runs[-1][1] != data_independent:
+            runs.append(([], data_independent))
+        body = runs[-1][0]
+        if isinstance(item, jinja2.nodes.Stmt):
+            body.append(item)
+        elif body and isinstance(body[-1], jinja2.nodes.Output):
+            body[-1].nodes.append(item)
+        else:
+            body.append(jinja2.nodes.Output([item], lineno=item.lineno))
+
+    segments = []
+    for body, data_independent in runs:
+        node = jinja2.nodes.Template(body, lineno=1)
+        names = {n.name for n in node.find_all(jinja2.nodes.Name)} - default_names
+        segments.append(TemplateSegment(node, names, data_independent))
+    return segments
+
+
 class TemplateManager:
+    """
+    Nothing in here changes during a render, so a template manager can be rendered
+    from multiple threads at once. It can't be pickled, though; use `precompiled()` to
+    render in other processes.
+    """
+
     _root: PromptTemplate
     _templates: Dict[str, PromptTemplate]
-    _filters: Dict[str, Callable[..., Any]]
     _errors: Dict[str, str]
-
-    def __init__(self, root: str, templates: Dict[str, str]):
-        self._environment = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+    _precompiled: Optional[PrecompiledTemplateManager]
+
+    def __init__(
+        self,
+        root: str,
+        templates: Dict[str, str],
+        parse_cache: Optional[MutableMapping[str, PromptTemplate]] = None,
+        compile_cache: Optional[MutableMapping[str, CompiledSegment]] = None,
+    ):
+        """
+        :param parse_cache: parsed templates by source, to share between managers
+        :param compile_cache: compiled segments by `_compile_key`, to share between
+            managers
+        """
+        self._environment = create_environment()
+        self._parse_cache = parse_cache
+        self._compile_cache = compile_cache
+        self._precompiled = None
+        # Rendered output of every template that doesn't depend on data
+        self._constants = {}
 
         self._templates, self._errors = self._parse_templates_caught(templates)
 
@@ -89,41 +331,280 @@ class TemplateManager:
             self._root = None
             self._errors["root"] = str(e)
 
-    def _render_template(self, template: PromptTemplate, data: Any):
-        # TODO: Set this up so it preserves the environments we create and just subs in
-        #  the new data. Would really like it if I could just collapse the environments
-        #  into each other. Just flatten them. Seems like I could. I'd just have to
-        #  figure out what parts of things I could pre-compute. I wonder how I could
-        #  apply operations to things.
-        #  We really only need to get operations on `data` working. But this seems like
-        #  more work than I can justify.
+        self._bind_filters()
+        self._compile_templates()
+
+    @classmethod
+    def from_precompiled(
+        cls, precompiled: PrecompiledTemplateManager
+    ) -> "TemplateManager":
+        template_manager = cls.__new__(cls)
+        template_manager._environment = create_environment()
+        template_manager._parse_cache = None
+        template_manager._compile_cache = None
+        template_manager._precompiled = precompiled
+        template_manager._constants = precompiled.constants
+        template_manager._errors = {}
+        template_manager._root = precompiled.root.load(template_manager._environment)
+        template_manager._templates = {
+            name: template.load(template_manager._environment)
+            for name, template in precompiled.templates.items()
+        }
+        template_manager._bind_filters()
+        return template_manager
+
+    def _all_templates(self) -> Dict[str, PromptTemplate]:
+        return {"root": self._root, **self._templates}
+
+    def _compile_templates(self) -> None:
+        templates = self._all_templates()
+        graph = TemplateDependencyGraph(
+            {
+                name: template.static_names if template else set()
+                for name, template in templates.items()
+            },
+            {
+                name: template.filter_names if template else set()
+                for name, template in templates.items()
+            },
+        )
+        self._errors.update(graph.errors)
+        # Rendering anything with errors could recurse forever
+        prerender = not self._errors
+
+        self._constants = {}
+        compile_keys = {}
+        # Work through templates in dependency order, so by the time we get to a
+        # template we know which templates it uses are constant and every template it
+        # uses as a filter is compiled
+        for name in graph.order:
+            if (template := templates[name]) is None:
+                continue
+            compile_key = None
+            if self._compile_cache is not None:
+                compile_key = self._compile_key(
+                    template,
+                    (template.static_names | template.filter_names) & templates.keys(),
+                    compile_keys,
+                )
+            template.segments = split_segments(
+                template.template, template.default_names, set(self._constants)
+            )
+            # Filters have to be bound before this: Jinja checks that every filter a
+            # template uses exists when it compiles the template.
+            try:
+                for index, segment in enumerate(template.segments):
+                    self._compile_segment(
+                        template, index, segment, templates.keys(), compile_keys
+                    )
+            except jinja2.TemplateSyntaxError as e:
+                self._errors.setdefault(name, str(e))
+                continue
+            if compile_key is not None:
+                compile_keys[name] = compile_key
+
+            template.render_plan = [
+                dependency
+                for dependency in graph.static_closure(name)
+                if dependency not in self._constants
+            ]
+
+            if not prerender:
+                continue
+
+            for segment in template.segments:
+                if not segment.data_independent:
+                    continue
+                try:
+                    segment.text = self._render_segment(segment, None, self._constants)
+                except Exception:
+                    # Leave the segment to be rendered (and fail) at render time, just
+                    # like it would without pre-rendering
+                    pass
+
+            template.data_independent = all(
+                segment.text is not None for segment in template.segments
+            )
+            if template.data_independent and template is not self._root:
+                self._constants[name] = "".join(
+                    segment.text for segment in template.segments
+                )
+
+    def _compile_key(
+        self,
+        template: PromptTemplate,
+        dependencies: Set[str],
+        compile_keys: Dict[str, str],
+        *parts: Any,
+    ) -> Optional[str]:
+        """
+        A key for compiling (part of) a template, or None if it can't be shared. Besides
+        its source, that depends on which templates it uses are constant, and on the
+        templates it depends on (by their keys): Jinja folds constant expressions when
+        it compiles, so `{{ "text"|other_template }}` compiles to other_template's
+        output.
+        """
+        if template.source is None:
+            return None
+        if any(dependency not in compile_keys for dependency in dependencies):
+            # Dependencies that failed to compile or are part of a cycle
+            return None
+        return hashlib.sha256(
+            json.dumps(
+                [
+                    template.source,
+                    sorted(template.static_names & self._constants.keys()),
+                    sorted(
+                        [dependency, compile_keys[dependency]]
+                        for dependency in dependencies
+                    ),
+                    *parts,
+                ]
+            ).encode()
+        ).hexdigest()
+
+    def _compile_segment(
+        self,
+        template: PromptTemplate,
+        index: int,
+        segment: TemplateSegment,
+        template_names: Set[str],
+        compile_keys: Dict[str, str],
+    ) -> None:
+        """
+        :raises TemplateSyntaxError: if Jinja can't compile the segment
+        """
+        # Names a segment uses are only looked up when it's rendered, so only the
+        # templates it uses as filters can change what it compiles to
+        filter_names = {
+            node.name for node in segment.node.find_all(jinja2.nodes.Filter)
+        }
+        compile_key = None
+        if self._compile_cache is not None:
+            compile_key = self._compile_key(
+                template, filter_names & template_names, compile_keys, index
+            )
+        if compile_key is not None and (
+            compiled := self._compile_cache.get(compile_key)
+        ):
+            segment.source = compiled.source
+            segment.code = compiled.code
+        else:
+            node = segment.node
+            if self._parse_cache is not None:
+                # Parsed templates are shared, and compiling can modify them (Jinja
+                # folds constant expressions, which can call our filters). Every node
+                # refers to the environment it was parsed in, so point the copies at
+                # ours instead of copying the other manager's environment.
+                node = copy.deepcopy(
+                    node, {id(template.template.environment): self._environment}
+                )
+            segment.source = self._environment.compile(node, raw=True)
+            segment.code = compile_template_source(segment.source)
+            if compile_key is not None:
+                self._compile_cache[compile_key] = CompiledSegment(
+                    segment.source, segment.code
+                )
+        segment.compiled = template_from_code(self._environment, segment.code)
+
+    @staticmethod
+    def _render_segment(
+        segment: TemplateSegment, data: Any, values: Dict[str, str]
+    ) -> str:
+        if segment.text is not None:
+            return segment.text
 
         static_templates = {}
 
-        for sub_template_name in template.static_names:
-            if sub_template_name not in self._templates:
+        for sub_template_name in segment.static_names:
+            if sub_template_name not in values:
                 raise UndefinedTemplateNameError(sub_template_name)
-            sub_template = self._templates[sub_template_name]
-            static_templates[sub_template_name] = self._render_template(
-                sub_template, data
-            )
+            static_templates[sub_template_name] = values[sub_template_name]
 
-        return html.unescape(
-            self._environment.from_string(template.template).render(
-                **static_templates, data=data
-            )
+        return html.unescape(segment.compiled.render(**static_templates, data=data))
+
+    def _render_template(self, template: PromptTemplate, data: Any):
+        # Every template used by name is rendered with the same data, so render each
+        # of them once, in the order the template's render plan says to
+        values = dict(self._constants)
+        for name in template.render_plan:
+            values[name] = self._render_segments(self._templates[name], data, values)
+        return self._render_segments(template, data, values)
+
+    def _render_segments(
+        self, template: PromptTemplate, data: Any, values: Dict[str, str]
+    ) -> str:
+        # Note that segments are unescaped separately, so an HTML entity split across
+        # two segments won't be unescaped
+        return "".join(
+            self._render_segment(segment, data, values) for segment in template.segments
         )
 
     def render(self, data: Any):
-        self._build_filters()
         return self._render_template(self._root, data)
 
-    def _filter_render_fn(self, template: PromptTemplate):
-        return partial(listify, partial(self._render_template, template))
+    def _render_named_template(self, name: str, data: Any):
+        return self._render_template(self._templates[name], data)
+
+    def _filter_render_fn(self, name: str):
+        # Templates are looked up by name when the filter is called, so filters only
+        # need to be bound once
+        return partial(listify, partial(self._render_named_template, name))
+
+    def _bind_filters(self):
+        for name in self._templates:
+            self._environment.filters[name] = self._filter_render_fn(name)
+
+    def precompiled(self) -> PrecompiledTemplateManager:
+        if self._errors:
+            raise TemplateLoadingError(self._errors)
+        if self._precompiled is None:
+            self._precompiled = self._precompile()
+        return self._precompiled
+
+    def _precompile(self) -> PrecompiledTemplateManager:
+        def precompile_template(template: PromptTemplate) -> PrecompiledTemplate:
+            return PrecompiledTemplate(
+                frozenset(template.default_names),
+                frozenset(template.static_names),
+                frozenset(template.filter_names),
+                tuple(
+                    PrecompiledSegment(
+                        frozenset(segment.static_names),
+                        segment.data_independent,
+                        segment.source if segment.text is None else None,
+                        segment.text,
+                        # Only marshalled here, since most managers are never
+                        # precompiled
+                        marshal.dumps(segment.code) if segment.text is None else None,
+                    )
+                    for segment in template.segments
+                ),
+                tuple(template.render_plan),
+                template.data_independent,
+            )
 
-    def _build_filters(self):
-        for name, template_ in self._templates.items():
-            self._environment.filters[name] = self._filter_render_fn(template_)
+        root = precompile_template(self._root)
+        templates = {
+            name: precompile_template(template)
+            for name, template in self._templates.items()
+        }
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    asdict(root),
+                    {k: asdict(v) for k, v in templates.items()},
+                    self._constants,
+                ],
+                default=lambda value: (
+                    value.hex() if isinstance(value, bytes) else sorted(value)
+                ),
+                sort_keys=True,
+            ).encode()
+        )
+        return PrecompiledTemplateManager(
+            key.hexdigest(), root, templates, dict(self._constants)
+        )
 
     @staticmethod
     def parse_template(
@@ -144,11 +625,28 @@ class TemplateManager:
         static_names -= default_names
         filter_names -= default_names
         return PromptTemplate(
-            parsed_template, default_names, static_names, filter_names
+            parsed_template,
+            default_names,
+            static_names,
+            filter_names,
+            source=template,
         )
 
     def _parse_template(self, template: str) -> PromptTemplate:
-        return self.parse_template(template, self._environment)
+        if self._parse_cache is None:
+            return self.parse_template(template, self._environment)
+        if (parsed_template := self._parse_cache.get(template)) is None:
+            parsed_template = self.parse_template(template, self._environment)
+            self._parse_cache[template] = parsed_template
+        # Managers share the parsed template itself (see _compile_segment), but we
+        # fill in segments and the render plan
+        return PromptTemplate(
+            parsed_template.template,
+            set(parsed_template.default_names),
+            set(parsed_template.static_names),
+            set(parsed_template.filter_names),
+            source=template,
+        )
 
     def _parse_templates_caught(self, templates: Dict[str, str]):
         errors = {}
@@ -165,8 +663,12 @@ class TemplateManager:
     def template(self, name: str) -> PromptTemplate:
         return self._templates[name]
 
+    # Note that set_template and set_root aren't safe to call while rendering
     def set_template(self, name: str, template: str):
         self._templates[name] = self._parse_template(template)
+        self._environment.filters[name] = self._filter_render_fn(name)
+        self._precompiled = None
+        self._compile_templates()
 
     @property
     def root(self) -> PromptTemplate:
@@ -174,12 +676,53 @@ class TemplateManager:
 
     def set_root(self, template: str):
         self._root = self._parse_template(template)
+        self._precompiled = None
+        self._compile_templates()
 
     @property
     def errors(self) -> Dict[str, Optional[str]]:
         return self._errors
 
 
+class PrecompiledTemplateNotLoadedError(Exception):
+    """
+    Raised by render_precompiled when it's only given a key this process hasn't
+    loaded.
+    """
+
+
+# The latest precompiled template manager loaded in this process for each template
+# name, with its key. Older versions (say, from before a reload) are dropped.
+_loaded_precompiled_templates: Dict[str, Tuple[str, TemplateManager]] = {}
+_loaded_precompiled_templates_lock = Lock()
+
+
+def render_precompiled(
+    name: str,
+    key: str,
+    data: Any,
+    precompiled: Optional[PrecompiledTemplateManager] = None,
+) -> str:
+    """
+    Render a precompiled template manager. This is meant to be run in a
+    ProcessPoolExecutor; each process loads a given precompiled manager only once, so
+    after that callers can pass just its name and key instead of pickling it again.
+
+    :raises PrecompiledTemplateNotLoadedError: if precompiled isn't given and this
+        process hasn't loaded it
+    """
+    with _loaded_precompiled_templates_lock:
+        loaded_key, template_manager = _loaded_precompiled_templates.get(
+            name, (None, None)
+        )
+        if loaded_key != key:
+            if precompiled is None:
+                raise PrecompiledTemplateNotLoadedError(name, key)
+            template_manager = TemplateManager.from_precompiled(precompiled)
+            _loaded_precompiled_templates[name] = (key, template_manager)
+    return template_manager.render(data)
+
+
 def load_template_from_from_file(file) -> TemplateManager:
     with open(file) as f:
         data = json.load(f)
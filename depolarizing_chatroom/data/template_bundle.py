@@ -0,0 +1,173 @@
+import hashlib
+import hmac
+import os
+import pickle
+import sys
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import jinja2
+
+from ..logger import format_parameterized_log_message, logger
+from .template import (
+    PrecompiledTemplateManager,
+    TemplateManager,
+    load_template_from_from_file,
+)
+
+# Bump this whenever the precompiled template classes change
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_FILENAME = ".templates.bundle"
+# Bundles are pickles, so they're signed and only unpickled if the signature matches
+SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+
+def bundle_compatibility_key() -> str:
+    # Bundles hold marshalled bytecode, which only the same version of Python can
+    # load, compiled from code generated by a specific version of Jinja
+    return (
+        f"{BUNDLE_FORMAT_VERSION}:{sys.implementation.cache_tag}:{jinja2.__version__}"
+    )
+
+
+@dataclass
+class TemplateBundle:
+    compatibility_key: str
+    # Hash of each template file's contents and its precompiled template manager, by
+    # template name
+    templates: Dict[str, Tuple[str, PrecompiledTemplateManager]]
+
+
+def default_bundle_path(directory) -> Path:
+    return Path(directory) / BUNDLE_FILENAME
+
+
+def template_file_hash(file) -> str:
+    with open(file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _bundle_signature(payload: bytes, secret_key: str) -> bytes:
+    return hmac.new(
+        f"template-bundle:{secret_key}".encode(), payload, hashlib.sha256
+    ).digest()
+
+
+def read_template_bundle(path, secret_key: Optional[str]) -> Optional[TemplateBundle]:
+    """
+    Returns None if there's no usable bundle at path, including if it isn't signed
+    with secret_key.
+    """
+    if not secret_key:
+        return None
+    try:
+        with open(path, "rb") as f:
+            signature = f.read(SIGNATURE_SIZE)
+            payload = f.read()
+    except FileNotFoundError:
+        return None
+
+    if not hmac.compare_digest(signature, _bundle_signature(payload, secret_key)):
+        logger.warning(
+            format_parameterized_log_message(
+                "Ignoring template bundle with a bad signature", path=os.fspath(path)
+            )
+        )
+        return None
+    try:
+        bundle = pickle.loads(payload)
+    except Exception:
+        # A bundle written by an older version of this code just means loading
+        # templates the slow way
+        logger.warning(
+            format_parameterized_log_message(
+                "Ignoring unreadable template bundle", path=os.fspath(path)
+            )
+        )
+        return None
+
+    if (
+        not isinstance(bundle, TemplateBundle)
+        or bundle.compatibility_key != bundle_compatibility_key()
+    ):
+        return None
+    return bundle
+
+
+def write_template_bundle(path, bundle: TemplateBundle, secret_key: str) -> None:
+    path = Path(path)
+    payload = pickle.dumps(bundle, protocol=pickle.HIGHEST_PROTOCOL)
+    # Write to a temporary file and rename it so other processes never read a partly
+    # written bundle
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=path.parent, prefix=path.name, delete=False
+    ) as f:
+        f.write(_bundle_signature(payload, secret_key))
+        f.write(payload)
+    os.replace(f.name, path)
+
+
+def build_template_bundle(directory) -> TemplateBundle:
+    """
+    :raises TemplateLoadingError: if any template fails to load
+    """
+    return TemplateBundle(
+        bundle_compatibility_key(),
+        {
+            file.stem: (
+                template_file_hash(file),
+                load_template_from_from_file(file).precompiled(),
+            )
+            for file in sorted(Path(directory).glob("*.json"))
+        },
+    )
+
+
+def load_templates_from_bundle(
+    directory, bundle_path=None, secret_key: Optional[str] = None
+) -> Dict[str, TemplateManager]:
+    """
+    Load templates like `load_templates_from_directory`, but take any template whose
+    file hasn't changed from a precompiled bundle signed with secret_key instead of
+    parsing and compiling it. The bundle is only ever read here; build it before
+    starting workers (see run.sh).
+
+    :raises TemplateLoadingError: if any template fails to load
+    """
+    bundle_path = bundle_path or default_bundle_path(directory)
+    bundle = read_template_bundle(bundle_path, secret_key)
+    bundled_templates = bundle.templates if bundle else {}
+
+    templates = {}
+    for file in sorted(Path(directory).glob("*.json")):
+        bundled = bundled_templates.get(file.stem)
+        if bundled and bundled[0] == template_file_hash(file):
+            templates[file.stem] = TemplateManager.from_precompiled(bundled[1])
+        else:
+            templates[file.stem] = load_template_from_from_file(file)
+    return templates
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Precompile a directory of templates into a bundle that loads "
+        "quickly at startup"
+    )
+    parser.add_argument("directory", help="Directory of template JSON files")
+    parser.add_argument(
+        "--output",
+        help=f"Bundle path (defaults to {BUNDLE_FILENAME} in the templates directory)",
+    )
+    args = parser.parse_args()
+
+    if not (bundle_secret_key := os.getenv("SECRET_KEY")):
+        sys.exit("SECRET_KEY must be set to sign the bundle")
+    write_template_bundle(
+        args.output or default_bundle_path(args.directory),
+        build_template_bundle(args.directory),
+        bundle_secret_key,
+    )
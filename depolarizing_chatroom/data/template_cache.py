@@ -0,0 +1,123 @@
+import hashlib
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, Generic, Iterator, MutableMapping, TypeVar
+
+from .template import CompiledSegment, PromptTemplate, TemplateManager
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    size: int
+    maxsize: int
+    hits: int
+    misses: int
+    hit_rate: float
+
+
+class LRUCache(MutableMapping[K, V], Generic[K, V]):
+    """
+    A bounded mapping that drops its least recently used entries and counts how many
+    lookups it could answer. It can be used from multiple threads.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._entries: "OrderedDict[K, V]" = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def __getitem__(self, key: K) -> V:
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self._misses += 1
+                raise
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def __setitem__(self, key: K, value: V) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def __delitem__(self, key: K) -> None:
+        with self._lock:
+            del self._entries[key]
+
+    def __iter__(self) -> Iterator[K]:
+        with self._lock:
+            return iter(list(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return CacheStats(
+                len(self._entries),
+                self._maxsize,
+                self._hits,
+                self._misses,
+                self._hits / lookups if lookups else 0.0,
+            )
+
+
+class TemplateManagerCache:
+    """
+    Template managers by the content of their templates. Parsed templates and compiled
+    segments of templates are cached by their source too, so a manager that differs
+    from one we've seen by a single template only has to parse and compile that
+    template, and recompile the parts of other templates that use it as a filter.
+
+    Cached managers are shared, so don't call `set_template` or `set_root` on them.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 64,
+        parsed_maxsize: int = 1024,
+        compiled_maxsize: int = 4096,
+    ):
+        self._managers: LRUCache[str, TemplateManager] = LRUCache(maxsize)
+        self._parsed_templates: LRUCache[str, PromptTemplate] = LRUCache(parsed_maxsize)
+        self._compiled_segments: LRUCache[str, CompiledSegment] = LRUCache(
+            compiled_maxsize
+        )
+
+    @staticmethod
+    def key(root: str, templates: Dict[str, str]) -> str:
+        return hashlib.sha256(
+            json.dumps([root, templates], sort_keys=True).encode()
+        ).hexdigest()
+
+    def get(self, root: str, templates: Dict[str, str]) -> TemplateManager:
+        key = self.key(root, templates)
+        if (template_manager := self._managers.get(key)) is None:
+            # Two threads might both build the same manager here, which is harmless
+            template_manager = TemplateManager(
+                root,
+                templates,
+                parse_cache=self._parsed_templates,
+                compile_cache=self._compiled_segments,
+            )
+            self._managers[key] = template_manager
+        return template_manager
+
+    def stats(self) -> Dict[str, CacheStats]:
+        return {
+            "managers": self._managers.stats(),
+            "parsed_templates": self._parsed_templates.stats(),
+            "compiled_segments": self._compiled_segments.stats(),
+        }
@@ -0,0 +1,107 @@
+from typing import Dict, List, Set
+
+
+class TemplateDependencyGraph:
+    """
+    Dependencies between the templates in a TemplateManager. A template depends on the
+    templates it uses by name, which are rendered with the same data it is, and on the
+    templates it uses as filters, which are rendered with whatever value is filtered.
+    """
+
+    def __init__(
+        self,
+        static_dependencies: Dict[str, Set[str]],
+        filter_dependencies: Dict[str, Set[str]],
+        root: str = "root",
+    ):
+        self._static_dependencies = static_dependencies
+        self._filter_dependencies = filter_dependencies
+        self._root = root
+        self._errors: Dict[str, str] = {}
+        self._check_undefined()
+        self._order = self._topological_order()
+        self._static_closures = {
+            name: self._static_closure(name) for name in self._order
+        }
+
+    def _dependencies(self, name: str) -> Set[str]:
+        return self._static_dependencies.get(
+            name, set()
+        ) | self._filter_dependencies.get(name, set())
+
+    def _check_undefined(self) -> None:
+        for name in self._static_dependencies.keys() | self._filter_dependencies.keys():
+            # The root template can't be used by other templates
+            undefined = {
+                dependency
+                for dependency in self._dependencies(name)
+                if dependency == self._root
+                or dependency not in self._static_dependencies
+            }
+            if undefined:
+                self._errors[name] = "Undefined template name(s): " + ", ".join(
+                    repr(dependency) for dependency in sorted(undefined)
+                )
+
+    def _topological_order(self) -> List[str]:
+        order = []
+        # Templates we're still visiting the dependencies of, in the order we started
+        # visiting them. Finding one of these again means we've found a cycle.
+        visiting = []
+        visited = set()
+
+        def visit(name: str) -> None:
+            visiting.append(name)
+            for dependency in sorted(self._dependencies(name)):
+                if dependency not in self._static_dependencies:
+                    # Already reported as undefined
+                    continue
+                if dependency in visiting:
+                    cycle = visiting[visiting.index(dependency) :] + [dependency]
+                    self._errors.setdefault(
+                        name, "Template dependency cycle: " + " -> ".join(cycle)
+                    )
+                    continue
+                if dependency not in visited:
+                    visit(dependency)
+            visiting.pop()
+            visited.add(name)
+            order.append(name)
+
+        for name in sorted(self._static_dependencies):
+            if name not in visited:
+                visit(name)
+        return order
+
+    def _static_closure(self, name: str) -> List[str]:
+        closure = set()
+        stack = [name]
+        while stack:
+            for dependency in self._static_dependencies.get(stack.pop(), set()):
+                if (
+                    dependency in self._static_dependencies
+                    and dependency not in closure
+                ):
+                    closure.add(dependency)
+                    stack.append(dependency)
+        closure.discard(name)
+        return [n for n in self._order if n in closure]
+
+    @property
+    def errors(self) -> Dict[str, str]:
+        return self._errors
+
+    @property
+    def order(self) -> List[str]:
+        """
+        Every template, each after the templates it depends on. Templates in a cycle
+        are still included, but in no particular order relative to each other.
+        """
+        return self._order
+
+    def static_closure(self, name: str) -> List[str]:
+        """
+        Every template that has to be rendered with the same data as `name` to render
+        it, in the order they have to be rendered.
+        """
+        return self._static_closures[name]
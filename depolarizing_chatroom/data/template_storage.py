@@ -0,0 +1,237 @@
+import asyncio
+import copy
+import fcntl
+import json
+import os
+import re
+import tempfile
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from fastapi_async_sqlalchemy import db
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+
+from . import models
+
+TemplateData = Dict[str, Any]
+
+
+class TemplateVersionConflictError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class TemplateDocument:
+    data: TemplateData
+    # Starts at 1 and goes up by one on every save. Users who have never saved a
+    # template get the default template at version 0.
+    version: int
+
+
+class TemplateStorage(ABC):
+    """
+    Per-user template editor documents. Saves are compare-and-set: they only succeed
+    if the document is still at the version the caller last read.
+    """
+
+    def __init__(self, default_template_path="template.json"):
+        self._default_template_path = default_template_path
+        self._default_template: Optional[TemplateData] = None
+
+    async def _default_document(self) -> TemplateDocument:
+        if self._default_template is None:
+
+            def load_default_template() -> TemplateData:
+                with open(self._default_template_path) as f:
+                    return json.load(f)["default"]
+
+            self._default_template = await asyncio.get_running_loop().run_in_executor(
+                None, load_default_template
+            )
+        return TemplateDocument(copy.deepcopy(self._default_template), 0)
+
+    @abstractmethod
+    async def get(self, user_id: str) -> TemplateDocument:
+        pass
+
+    @abstractmethod
+    async def save(
+        self, user_id: str, data: TemplateData, *, expected_version: int
+    ) -> TemplateDocument:
+        """
+        :raises TemplateVersionConflictError: if the stored document isn't at
+            expected_version
+        """
+        pass
+
+    async def update(
+        self,
+        user_id: str,
+        update_data: Callable[[TemplateData], TemplateData],
+        *,
+        expected_version: Optional[int] = None,
+        attempts: int = 5,
+    ) -> TemplateDocument:
+        """
+        Read, update and save a document. If expected_version isn't given, a save that
+        loses a race is retried from a fresh read.
+
+        :raises TemplateVersionConflictError: if the document isn't at
+            expected_version, or we kept losing races
+        """
+        for _ in range(attempts):
+            document = await self.get(user_id)
+            if expected_version is not None and document.version != expected_version:
+                raise TemplateVersionConflictError(user_id)
+            try:
+                return await self.save(
+                    user_id,
+                    update_data(document.data),
+                    expected_version=document.version,
+                )
+            except TemplateVersionConflictError:
+                if expected_version is not None:
+                    raise
+        raise TemplateVersionConflictError(user_id)
+
+
+class FileTemplateStorage(TemplateStorage):
+    """
+    Stores each user's document as a JSON file in a directory, caching documents in
+    memory until their files change. Files are written to a temporary file and
+    renamed into place, under a lock so saves from other processes can't interleave.
+    """
+
+    def __init__(self, directory=".", **kwargs):
+        super().__init__(**kwargs)
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        # Documents by path, along with the (mtime, size) of the file they were read
+        # from
+        self._cache: Dict[Path, Tuple[Tuple[int, int], TemplateDocument]] = {}
+
+    def _filepath(self, user_id: str) -> Path:
+        filename = re.sub(r"[\W_]+", "", user_id).lower() + ".json"
+        return self._directory / filename
+
+    @staticmethod
+    def _file_stat(filepath: Path) -> Optional[Tuple[int, int]]:
+        try:
+            stat = filepath.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self, filepath: Path, use_cache=True) -> Optional[TemplateDocument]:
+        if (file_stat := self._file_stat(filepath)) is None:
+            return None
+        if (
+            use_cache
+            and (cached := self._cache.get(filepath))
+            and cached[0] == file_stat
+        ):
+            return cached[1]
+        with open(filepath) as f:
+            stored = json.load(f)
+        if "version" in stored and "template" in stored:
+            document = TemplateDocument(stored["template"], stored["version"])
+        else:
+            # Saved before documents were versioned
+            document = TemplateDocument(stored, 1)
+        self._cache[filepath] = (file_stat, document)
+        return document
+
+    def _write(
+        self, filepath: Path, data: TemplateData, expected_version: int
+    ) -> TemplateDocument:
+        with open(filepath.with_suffix(".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process's save can leave the file with the same mtime (at the
+            # filesystem's resolution) and size as the one we cached, so check the
+            # version we're replacing on disk
+            current = self._read(filepath, use_cache=False)
+            if (current.version if current else 0) != expected_version:
+                raise TemplateVersionConflictError(str(filepath))
+
+            document = TemplateDocument(data, expected_version + 1)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=filepath.parent, prefix=filepath.name, delete=False
+            ) as f:
+                json.dump({"version": document.version, "template": data}, f)
+            os.replace(f.name, filepath)
+            self._cache[filepath] = (self._file_stat(filepath), document)
+        return document
+
+    async def get(self, user_id: str) -> TemplateDocument:
+        document = await asyncio.get_running_loop().run_in_executor(
+            None, self._read, self._filepath(user_id)
+        )
+        if document is None:
+            return await self._default_document()
+        # Callers are free to modify what they get back
+        return TemplateDocument(copy.deepcopy(document.data), document.version)
+
+    async def save(
+        self, user_id: str, data: TemplateData, *, expected_version: int
+    ) -> TemplateDocument:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._write, self._filepath(user_id), data, expected_version
+        )
+
+
+class DatabaseTemplateStorage(TemplateStorage):
+    """
+    Stores documents in the user_templates table. This has to be used inside a
+    database session (like the one every HTTP request gets).
+    """
+
+    async def get(self, user_id: str) -> TemplateDocument:
+        user_template = await db.session.get(models.UserTemplate, user_id)
+        if user_template is None:
+            return await self._default_document()
+        # Don't hand out the instance's own JSON
+        document = TemplateDocument(
+            copy.deepcopy(user_template.data), user_template.version
+        )
+        db.session.expunge(user_template)
+        return document
+
+    async def save(
+        self, user_id: str, data: TemplateData, *, expected_version: int
+    ) -> TemplateDocument:
+        try:
+            if expected_version == 0:
+                await db.session.execute(
+                    insert(models.UserTemplate).values(
+                        user_id=user_id, data=data, version=1
+                    )
+                )
+            else:
+                result = await db.session.execute(
+                    update(models.UserTemplate)
+                    .where(
+                        models.UserTemplate.user_id == user_id,
+                        models.UserTemplate.version == expected_version,
+                    )
+                    .values(data=data, version=expected_version + 1)
+                )
+                if result.rowcount != 1:
+                    raise TemplateVersionConflictError(user_id)
+            await db.session.commit()
+        except IntegrityError:
+            # Someone else saved this user's first version before we could
+            await db.session.rollback()
+            raise TemplateVersionConflictError(user_id)
+        except TemplateVersionConflictError:
+            await db.session.rollback()
+            raise
+        return TemplateDocument(data, expected_version + 1)
+
+
+def create_template_storage() -> TemplateStorage:
+    if os.getenv("TEMPLATE_STORAGE") == "database":
+        return DatabaseTemplateStorage()
+    return FileTemplateStorage(os.getenv("TEMPLATE_STORAGE_DIR") or ".")
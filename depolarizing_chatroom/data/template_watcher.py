@@ -0,0 +1,290 @@
+import asyncio
+import os
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
+
+from ..logger import format_parameterized_log_message, logger
+from .template import (
+    TemplateLoadingError,
+    TemplateManager,
+    load_template_from_from_file,
+)
+from .template_bundle import (
+    TemplateBundle,
+    bundle_compatibility_key,
+    default_bundle_path,
+    read_template_bundle,
+    template_file_hash,
+    write_template_bundle,
+)
+
+try:
+    # watchfiles uses inotify on Linux (and the equivalent elsewhere)
+    from watchfiles import awatch
+except ImportError:
+    awatch = None
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+FileStat = Tuple[int, int]
+
+
+class TemplateDirectoryWatcher:
+    """
+    Watches a directory of template JSON files and reloads the ones that change.
+
+    A reload only happens if every template in the directory loads without errors,
+    and it produces a brand-new dict of templates. Dicts that have already been handed
+    out are never modified, so renders that are in progress keep using the templates
+    they started with.
+    """
+
+    def __init__(
+        self,
+        directory,
+        on_reload: Callable[[Dict[str, TemplateManager]], None],
+        *,
+        poll_interval: float = 2.0,
+    ):
+        self._directory = Path(directory)
+        self._on_reload = on_reload
+        self._poll_interval = poll_interval
+        # The last version of each file that loaded successfully
+        self._loaded: Dict[Path, Tuple[FileStat, TemplateManager]] = {}
+        self._file_stats: Dict[Path, FileStat] = {}
+
+    def _stat_files(self) -> Dict[Path, FileStat]:
+        file_stats = {}
+        for file in self._directory.glob("*.json"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                # Deleted since we listed the directory
+                continue
+            file_stats[file] = (stat.st_mtime_ns, stat.st_size)
+        return file_stats
+
+    def load(self) -> Optional[Dict[str, TemplateManager]]:
+        """
+        Load every template in the directory, reparsing only files that have changed
+        since they were last loaded. Returns None if nothing has changed.
+
+        :raises TemplateLoadingError: if any template fails to load
+        """
+        file_stats = self._stat_files()
+        if file_stats == self._file_stats:
+            return None
+        self._file_stats = file_stats
+
+        templates = {}
+        errors = {}
+        for file, file_stat in file_stats.items():
+            if (loaded := self._loaded.get(file)) and loaded[0] == file_stat:
+                templates[file.stem] = loaded[1]
+                continue
+            try:
+                template = load_template_from_from_file(file)
+            except TemplateLoadingError as e:
+                errors[file.stem] = e.exceptions
+                continue
+            except (OSError, ValueError, KeyError) as e:
+                # Missing files, bad JSON, or JSON without "root" or "templates"
+                errors[file.stem] = repr(e)
+                continue
+            self._loaded[file] = (file_stat, template)
+            templates[file.stem] = template
+
+        for file in self._loaded.keys() - file_stats.keys():
+            del self._loaded[file]
+
+        if errors:
+            raise TemplateLoadingError(errors)
+
+        return templates
+
+    async def _changes(self) -> AsyncIterator[None]:
+        if awatch is not None:
+            async for _ in awatch(self._directory):
+                yield
+        else:
+            while True:
+                await asyncio.sleep(self._poll_interval)
+                yield
+
+    async def _reload(
+        self, load: Optional[Callable[[], Optional[Dict[str, TemplateManager]]]] = None
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            # Parsing templates is CPU-bound, so keep it off the event loop
+            templates = await loop.run_in_executor(None, load or self.load)
+        except TemplateLoadingError:
+            logger.exception(
+                format_parameterized_log_message(
+                    "Failed to reload templates, keeping current templates",
+                    directory=os.fspath(self._directory),
+                )
+            )
+            return
+        except Exception:
+            # We can't have this loop fail
+            logger.exception("Error in template reload loop")
+            return
+
+        if templates is None:
+            return
+
+        self._on_reload(templates)
+        logger.info(
+            format_parameterized_log_message(
+                "Reloaded templates",
+                directory=os.fspath(self._directory),
+                templates=sorted(templates),
+            )
+        )
+
+    async def run(self) -> None:
+        # We already have whatever's in the directory now
+        self._file_stats = self._stat_files()
+        async for _ in self._changes():
+            await self._reload()
+
+
+class HostTemplateWatcher(TemplateDirectoryWatcher):
+    """
+    Keeps every worker on a host up to date with a directory of templates, with only
+    one of them watching and parsing it.
+
+    Whichever worker holds a lock on the template bundle (see template_bundle.py)
+    watches the directory like a TemplateDirectoryWatcher and writes every reload to
+    the bundle. The rest only check whether the bundle has changed, which is one stat
+    call per poll, and load it when it has. If the watching worker exits, its lock is
+    released and the next worker to poll takes over.
+
+    Without a secret key to sign the bundle with, or on platforms without flock,
+    every worker watches the directory itself.
+    """
+
+    def __init__(
+        self,
+        directory,
+        on_reload: Callable[[Dict[str, TemplateManager]], None],
+        secret_key: Optional[str],
+        *,
+        bundle_path=None,
+        poll_interval: float = 2.0,
+    ):
+        super().__init__(directory, on_reload, poll_interval=poll_interval)
+        self._secret_key = secret_key
+        self._bundle_path = Path(bundle_path or default_bundle_path(directory))
+        self._lock_path = self._bundle_path.with_name(self._bundle_path.name + ".lock")
+        self._lock_file = None
+        self._leading = False
+        self._bundle_stat: Optional[FileStat] = None
+        # The file hash and template manager of each template we last loaded from the
+        # bundle, so unchanged templates aren't loaded again
+        self._bundled: Dict[str, Tuple[str, TemplateManager]] = {}
+
+    def _stat_bundle(self) -> Optional[FileStat]:
+        try:
+            stat = self._bundle_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def try_to_lead(self) -> bool:
+        """
+        Take the lock that makes this the worker that watches the directory, if no
+        other worker has it. Returns whether this worker has it now.
+        """
+        if self._lock_file is None:
+            self._lock_file = open(self._lock_path, "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self._leading = True
+        return True
+
+    def load(self) -> Optional[Dict[str, TemplateManager]]:
+        templates = super().load()
+        if templates is None or not self._leading:
+            return templates
+        try:
+            write_template_bundle(
+                self._bundle_path,
+                TemplateBundle(
+                    bundle_compatibility_key(),
+                    {
+                        file.stem: (template_file_hash(file), template.precompiled())
+                        for file, (_, template) in self._loaded.items()
+                    },
+                ),
+                self._secret_key,
+            )
+        except OSError:
+            # This worker still has the new templates; the rest catch up when the
+            # bundle is next written
+            logger.exception(
+                format_parameterized_log_message(
+                    "Failed to write template bundle",
+                    path=os.fspath(self._bundle_path),
+                )
+            )
+        return templates
+
+    def load_bundle(self) -> Optional[Dict[str, TemplateManager]]:
+        """
+        Load the templates in the bundle if they've changed since they were last
+        loaded. Returns None if they haven't, or if the bundle can't be read.
+        """
+        bundle_stat = self._stat_bundle()
+        if bundle_stat is None or bundle_stat == self._bundle_stat:
+            return None
+        self._bundle_stat = bundle_stat
+
+        bundle = read_template_bundle(self._bundle_path, self._secret_key)
+        if bundle is None:
+            return None
+        bundled = {}
+        for name, (file_hash, precompiled) in bundle.templates.items():
+            if (loaded := self._bundled.get(name)) and loaded[0] == file_hash:
+                bundled[name] = loaded
+            else:
+                bundled[name] = (
+                    file_hash,
+                    TemplateManager.from_precompiled(precompiled),
+                )
+        if bundled == self._bundled:
+            # Rewritten without changes, e.g. by a worker taking over watching
+            return None
+        self._bundled = bundled
+        return {name: template for name, (_, template) in bundled.items()}
+
+    async def run(self) -> None:
+        if fcntl is None or not self._secret_key:
+            await super().run()
+            return
+
+        # We already have whatever's in the bundle now
+        self._bundle_stat = self._stat_bundle()
+        took_over = False
+        while not self.try_to_lead():
+            took_over = True
+            await asyncio.sleep(self._poll_interval)
+            await self._reload(self.load_bundle)
+
+        logger.info(
+            format_parameterized_log_message(
+                "Watching templates for this host", directory=os.fspath(self._directory)
+            )
+        )
+        if took_over:
+            # The worker we took over from may have missed changes, or exited before
+            # writing them to the bundle
+            await self._reload()
+        await super().run()
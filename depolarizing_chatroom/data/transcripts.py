@@ -0,0 +1,262 @@
+import asyncio
+import sys
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from ..logger import format_parameterized_log_message, logger
+from ..notifications import NotificationBus
+from .models import UserPosition
+
+TRANSCRIPT_CHANGED = "transcript_changed"
+# Roughly how many bytes a TranscriptMessage takes up besides its body
+MESSAGE_OVERHEAD = 200
+
+
+@dataclass(frozen=True)
+class TranscriptMessage:
+    """
+    What reading chat history needs from a message.
+    """
+
+    id: int
+    seq: int
+    sender_id: int
+    position: UserPosition
+    body: str
+    word_count: int
+    has_rephrasings: bool
+
+    @classmethod
+    def of(cls, message: Any, position: UserPosition) -> "TranscriptMessage":
+        """
+        :param message: a Message, or a row with the same columns
+        """
+        return cls(
+            message.id,
+            message.seq,
+            message.sender_id,
+            position,
+            message.final_body,
+            message.word_count,
+            bool(message.has_rephrasings),
+        )
+
+    @property
+    def size(self) -> int:
+        """
+        Roughly how many bytes the message takes up in memory.
+        """
+        return MESSAGE_OVERHEAD + sys.getsizeof(self.body)
+
+
+@dataclass
+class Transcript:
+    """
+    A chatroom's messages in order (by seq, from 1), and its users' positions.
+    """
+
+    positions: Dict[int, UserPosition]
+    messages: List[TranscriptMessage] = field(default_factory=list)
+
+    @classmethod
+    def of(
+        cls, positions: Dict[int, UserPosition], messages: List[Any]
+    ) -> "Transcript":
+        return cls(
+            positions,
+            [
+                TranscriptMessage.of(message, positions[message.sender_id])
+                for message in messages
+            ],
+        )
+
+    @property
+    def size(self) -> int:
+        return sum(message.size for message in self.messages)
+
+    def write(self, message: Any) -> bool:
+        """
+        Add a new message, or replace one we have. Returns False if it doesn't fit in
+        the transcript (it skips a message we don't have, or is from someone else).
+        """
+        if (position := self.positions.get(message.sender_id)) is None:
+            return False
+        if message.seq == len(self.messages) + 1:
+            self.messages.append(TranscriptMessage.of(message, position))
+        elif 1 <= message.seq <= len(self.messages):
+            self.messages[message.seq - 1] = TranscriptMessage.of(message, position)
+        else:
+            return False
+        return True
+
+
+@dataclass(frozen=True)
+class TranscriptCacheStats:
+    transcripts: int
+    messages: int
+    bytes: int
+    max_bytes: int
+    hits: int
+    misses: int
+    hit_rate: float
+    evictions: int
+    invalidations: int
+
+
+@dataclass(eq=False)
+class _Load:
+    # Whether the transcript changed while it was being loaded
+    stale: bool = False
+
+
+class TranscriptCache:
+    """
+    Transcripts of active chatrooms, for this worker, dropping the least recently used
+    ones to stay under max_bytes. Transcripts are loaded on first read and updated
+    with each committed change to their messages after that.
+
+    Other workers can't update our copies, so with share_changes, each change also
+    tells every other worker to drop its copy. A worker that misses that (say, while
+    it's reconnecting to Redis) keeps a stale copy until its next write to the
+    chatroom doesn't follow on from it, or it's dropped.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._transcripts: "OrderedDict[int, Transcript]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._bytes = 0
+        # Loads in progress, by chatroom ID
+        self._loads: Dict[int, List[_Load]] = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+        # Identifies our changes when they come back from the bus
+        self._id = uuid.uuid4().hex
+        self._bus: Optional[NotificationBus] = None
+        # Keep references to publishing tasks so they aren't garbage collected
+        self._tasks: Set[asyncio.Task] = set()
+
+    def share_changes(self, bus: NotificationBus) -> None:
+        """
+        Tell other workers about changes over the bus, and listen for theirs.
+        """
+        self._bus = bus
+        bus.subscribe(TRANSCRIPT_CHANGED, self._on_transcript_changed)
+
+    async def get(
+        self, chatroom_id: int, load: Callable[[], Awaitable[Transcript]]
+    ) -> Transcript:
+        """
+        The chatroom's transcript, loaded with load if we don't have it. Cached
+        transcripts are shared, so don't change them.
+        """
+        if (transcript := self._transcripts.get(chatroom_id)) is not None:
+            self._transcripts.move_to_end(chatroom_id)
+            self._hits += 1
+            return transcript
+
+        self._misses += 1
+        loading = _Load()
+        self._loads.setdefault(chatroom_id, []).append(loading)
+        try:
+            transcript = await load()
+        finally:
+            loads = self._loads[chatroom_id]
+            loads.remove(loading)
+            if not loads:
+                del self._loads[chatroom_id]
+        # If it changed while we were loading, we might have loaded it from before
+        # the change, so only cache it if it didn't
+        if not loading.stale:
+            self._store(chatroom_id, transcript)
+        return transcript
+
+    def write(self, chatroom_id: int, message: Any) -> None:
+        """
+        Apply a committed change to one of the chatroom's messages (a new message, or
+        a new final body or has_rephrasings).
+        """
+        if (transcript := self._transcripts.get(chatroom_id)) is not None:
+            if transcript.write(message):
+                self._resize(chatroom_id)
+            else:
+                self._drop(chatroom_id)
+        self._mark_loads_stale(chatroom_id)
+        self._publish(chatroom_id)
+
+    def forget(self, chatroom_id: int) -> None:
+        """
+        Drop the chatroom's transcript here and in every other worker, e.g. once no
+        one is reading it anymore.
+        """
+        self._drop(chatroom_id)
+        self._publish(chatroom_id)
+
+    def stats(self) -> TranscriptCacheStats:
+        lookups = self._hits + self._misses
+        return TranscriptCacheStats(
+            len(self._transcripts),
+            sum(len(transcript.messages) for transcript in self._transcripts.values()),
+            self._bytes,
+            self._max_bytes,
+            self._hits,
+            self._misses,
+            self._hits / lookups if lookups else 0.0,
+            self._evictions,
+            self._invalidations,
+        )
+
+    def _store(self, chatroom_id: int, transcript: Transcript) -> None:
+        self._transcripts[chatroom_id] = transcript
+        self._transcripts.move_to_end(chatroom_id)
+        self._resize(chatroom_id)
+
+    def _resize(self, chatroom_id: int) -> None:
+        size = self._transcripts[chatroom_id].size
+        self._bytes += size - self._sizes.get(chatroom_id, 0)
+        self._sizes[chatroom_id] = size
+        # A transcript too big for the whole cache ends up evicting itself
+        while self._bytes > self._max_bytes:
+            self._drop(next(iter(self._transcripts)))
+            self._evictions += 1
+
+    def _drop(self, chatroom_id: int) -> None:
+        if self._transcripts.pop(chatroom_id, None) is not None:
+            self._bytes -= self._sizes.pop(chatroom_id)
+
+    def _mark_loads_stale(self, chatroom_id: int) -> None:
+        for loading in self._loads.get(chatroom_id, ()):
+            loading.stale = True
+
+    def _publish(self, chatroom_id: int) -> None:
+        if self._bus is None:
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._bus.publish(
+                TRANSCRIPT_CHANGED, chatroom_id=chatroom_id, source=self._id
+            )
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._on_published)
+
+    def _on_published(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and (exception := task.exception()) is not None:
+            logger.error(
+                format_parameterized_log_message(
+                    "Error publishing transcript change", error=repr(exception)
+                )
+            )
+
+    async def _on_transcript_changed(self, data: Dict[str, Any]) -> None:
+        if data["source"] == self._id:
+            return
+        chatroom_id = data["chatroom_id"]
+        if chatroom_id in self._transcripts:
+            self._invalidations += 1
+        self._drop(chatroom_id)
+        self._mark_loads_stale(chatroom_id)
@@ -0,0 +1,145 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from .constants import STATS_HISTORY_SIZE, STATS_MAX_UPDATES_PER_SECOND
+from .data import models
+from .data.crud import OnlineUserCounts
+from .data.models import UserPosition
+from .logger import logger
+
+# Stages users go through, named like the fields of the dashboard's stats
+UNMATCHED = "unmatched"
+PRECHAT = "prechat"
+IN_CHATROOM = "inChatroom"
+
+POSITION_FIELDS = {UserPosition.SUPPORT: "supporters", UserPosition.OPPOSE: "opponents"}
+
+Counters = Dict[Tuple[str, str], int]
+
+
+def waiting_room_stage(user: models.User) -> str:
+    # The same split as DataAccess.users_in_waiting_room's matched argument
+    return UNMATCHED if user.found_match_time is None else PRECHAT
+
+
+def nested_stats(counters: Counters) -> Dict[str, Any]:
+    stats = {}
+    for (stage, field), count in counters.items():
+        stats.setdefault(stage, {})[field] = count
+    return stats
+
+
+class LiveStats:
+    """
+    Dashboard stats kept up to date by the waiting room and chatroom sessions as
+    users come and go, so dashboards can be pushed changes instead of polling.
+
+    Changes are coalesced: they're published at most max_updates_per_second times a
+    second, and each update only has the counters that changed since the last one.
+    Every update is also kept as a sample in a fixed-size history.
+
+    Counters are only kept while something is publishing them. Each process only sees
+    its own sessions, so whoever is publishing should also reset them from the
+    database every so often.
+    """
+
+    def __init__(self, max_updates_per_second: float, history_size: int):
+        self._min_update_interval = 1 / max_updates_per_second
+        self._counters: Optional[Counters] = None
+        self._published: Counters = {}
+        self._history: Deque[Dict[str, Any]] = deque(maxlen=history_size)
+        self._publish: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+        self._publish_task: Optional[asyncio.Task] = None
+        self._last_published = float("-inf")
+
+    @property
+    def active(self) -> bool:
+        return self._counters is not None
+
+    def start(
+        self,
+        publish: Callable[[Dict[str, Any]], Awaitable[None]],
+        counts: Dict[UserPosition, OnlineUserCounts],
+    ) -> None:
+        self._publish = publish
+        self.reset(counts)
+
+    def stop(self) -> None:
+        self._counters = None
+        self._published = {}
+        self._publish = None
+        if self._publish_task:
+            self._publish_task.cancel()
+
+    def reset(self, counts: Dict[UserPosition, OnlineUserCounts]) -> None:
+        """
+        Set every counter to the given counts, e.g. ones freshly read from the
+        database.
+        """
+        self._counters = {}
+        for position, position_counts in counts.items():
+            field = POSITION_FIELDS[position]
+            self._counters[UNMATCHED, field] = position_counts.unmatched
+            self._counters[PRECHAT, field] = position_counts.prechat
+            self._counters[IN_CHATROOM, field] = position_counts.in_chatroom
+        self._schedule_publish()
+
+    def adjust(self, stage: str, position: UserPosition, delta: int) -> None:
+        if self._counters is None:
+            # Nobody's watching
+            return
+        self._counters[stage, POSITION_FIELDS[position]] += delta
+        self._schedule_publish()
+
+    def move(self, from_stage: str, to_stage: str, position: UserPosition) -> None:
+        self.adjust(from_stage, position, -1)
+        self.adjust(to_stage, position, 1)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Every counter, in the same shape as the /stats response.
+        """
+        return dict(
+            totalOnline=sum(self._counters.values()), **nested_stats(self._counters)
+        )
+
+    def history(self) -> List[Dict[str, Any]]:
+        return list(self._history)
+
+    def _schedule_publish(self) -> None:
+        if self._publish_task is None or self._publish_task.done():
+            self._publish_task = asyncio.get_running_loop().create_task(
+                self._publish_changes()
+            )
+
+    async def _publish_changes(self) -> None:
+        await asyncio.sleep(
+            self._last_published + self._min_update_interval - time.monotonic()
+        )
+        # Anything that changes from here on has to be published by another task
+        self._publish_task = None
+        self._last_published = time.monotonic()
+        if self._counters is None:
+            return
+
+        changes = {
+            counter: count
+            for counter, count in self._counters.items()
+            if self._published.get(counter) != count
+        }
+        if not changes:
+            return
+        self._published = dict(self._counters)
+        stats = self.stats()
+        self._history.append(dict(time=time.time(), **stats))
+        try:
+            await self._publish(
+                dict(totalOnline=stats["totalOnline"], **nested_stats(changes))
+            )
+        except Exception:
+            logger.exception("Error publishing live stats")
+
+
+live_stats = LiveStats(STATS_MAX_UPDATES_PER_SECOND, STATS_HISTORY_SIZE)
@@ -0,0 +1,84 @@
+from typing import Any, Dict, Iterable
+
+from fastapi_async_sqlalchemy import SQLAlchemyMiddleware, db
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .data.query_stats import query_scope
+
+# What requests that don't match a route are counted as, so arbitrary paths can't
+# each add their own entry
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class PrefixTrie:
+    """
+    Matches strings against a fixed set of prefixes in one pass over the string,
+    however many prefixes there are.
+    """
+
+    # Marks the end of a prefix in a node
+    _END = ""
+
+    def __init__(self, prefixes: Iterable[str]):
+        self._root: Dict[str, Any] = {}
+        for prefix in prefixes:
+            node = self._root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[self._END] = True
+
+    def matches(self, string: str) -> bool:
+        """
+        Whether the string starts with any of the prefixes.
+        """
+        node = self._root
+        if self._END in node:
+            return True
+        for char in string:
+            if (node := node.get(char)) is None:
+                return False
+            if self._END in node:
+                return True
+        return False
+
+
+class DatabaseSessionMiddleware:
+    """
+    Gives every HTTP request its own database session (through
+    fastapi_async_sqlalchemy's db), except for requests to paths starting with any of
+    ignore_prefixes. Sessions are closed once the response starts. This is plain ASGI
+    so requests don't pay for BaseHTTPMiddleware's extra tasks and response
+    streaming.
+
+    Statements run by each request are counted by route (see data/query_stats.py).
+
+    Takes the same engine and session arguments as SQLAlchemyMiddleware.
+    """
+
+    def __init__(self, app: ASGIApp, *, ignore_prefixes: Iterable[str] = (), **kwargs):
+        self._app = app
+        self._ignore_prefixes = PrefixTrie(ignore_prefixes)
+        # This only sets up the session factory that db uses; requests never go
+        # through it
+        SQLAlchemyMiddleware(app, **kwargs)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or self._ignore_prefixes.matches(scope["path"]):
+            await self._app(scope, receive, send)
+            return
+        with query_scope(UNMATCHED_ROUTE) as queries:
+            async with db():
+                session = db.session
+
+                async def send_closing_session(message: Message) -> None:
+                    if message["type"] == "http.response.start":
+                        # Streamed responses shouldn't hold on to a connection while
+                        # they stream
+                        await session.close()
+                    await send(message)
+
+                await self._app(scope, receive, send_closing_session)
+            # The router tells us which route this was, so requests with different
+            # path parameters are counted together
+            if (route := scope.get("route")) is not None:
+                queries.name = f"{scope['method']} {route.path}"
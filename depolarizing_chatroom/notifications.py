@@ -0,0 +1,159 @@
+import asyncio
+import contextvars
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Set, Union
+
+import redis.asyncio as redis
+from sqlalchemy.engine import make_url
+
+from .logger import format_parameterized_log_message, logger
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+NotificationHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Seconds to wait before reconnecting after losing the notification connection
+RECONNECT_DELAY = 1
+
+
+class NotificationBus:
+    """
+    Delivers events to the handlers subscribed to them in every worker. This one only
+    reaches handlers in this process, which is enough with a single worker.
+
+    Handlers run in their own tasks, so publishing never waits for them, and are
+    passed a dict of the keyword arguments the event was published with, which have
+    to be JSON serializable.
+    """
+
+    def __init__(self):
+        self._handlers: Dict[str, List[NotificationHandler]] = {}
+        # Keep references to running handlers so they aren't garbage collected
+        self._tasks: Set[asyncio.Task] = set()
+
+    def subscribe(self, event: str, handler: NotificationHandler) -> None:
+        self._handlers.setdefault(event, []).append(handler)
+
+    async def publish(self, event: str, **data) -> None:
+        self._deliver(event, data)
+
+    async def run(self) -> None:
+        """
+        Receive events published by other workers until cancelled.
+        """
+
+    def _receive(self, payload: Union[str, bytes]) -> None:
+        notification = json.loads(payload)
+        self._deliver(notification["event"], notification["data"])
+
+    def _deliver(self, event: str, data: Dict[str, Any]) -> None:
+        for handler in self._handlers.get(event, ()):
+            # Handlers start from an empty context, not whatever the publisher was in
+            # (like its database session), the same as for other workers' events
+            task = contextvars.Context().run(
+                asyncio.get_running_loop().create_task,
+                self._handle(event, handler, data),
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _handle(
+        event: str, handler: NotificationHandler, data: Dict[str, Any]
+    ) -> None:
+        try:
+            await handler(data)
+        except Exception:
+            logger.exception(
+                format_parameterized_log_message(
+                    "Error handling notification", event=event, data=data
+                )
+            )
+
+
+class PostgresNotificationBus(NotificationBus):
+    """
+    Delivers events to every worker connected to the same Postgres database, with
+    LISTEN/NOTIFY on a connection of its own (which PoolSettings.from_env takes out of
+    the worker's share of connections). A worker misses the events published
+    while its connection is down, so handlers shouldn't be the only way anything
+    happens.
+    """
+
+    def __init__(self, db_url: str, channel: str = "depolarizing_chatroom"):
+        super().__init__()
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is required for Postgres notifications")
+        # asyncpg doesn't understand SQLAlchemy's driver names
+        self._dsn = (
+            make_url(db_url)
+            .set(drivername="postgresql")
+            .render_as_string(hide_password=False)
+        )
+        self._channel = channel
+        self._connection = None
+        # asyncpg connections can only run one query at a time
+        self._lock = asyncio.Lock()
+
+    async def publish(self, event: str, **data) -> None:
+        payload = json.dumps({"event": event, "data": data})
+        async with self._lock:
+            connection = await self._connect()
+            # We get our own notifications back, so handlers here run on delivery
+            await connection.execute("SELECT pg_notify($1, $2)", self._channel, payload)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                closed = asyncio.Event()
+                async with self._lock:
+                    connection = await self._connect()
+                    connection.add_termination_listener(lambda _: closed.set())
+                    await connection.add_listener(self._channel, self._on_notification)
+                await closed.wait()
+                logger.warning("Lost notification connection, reconnecting")
+            except Exception:
+                logger.exception("Error listening for notifications, reconnecting")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _connect(self):
+        if self._connection is None or self._connection.is_closed():
+            self._connection = await asyncpg.connect(self._dsn)
+        return self._connection
+
+    def _on_notification(self, _connection, _pid, _channel, payload: str) -> None:
+        self._receive(payload)
+
+
+class RedisNotificationBus(NotificationBus):
+    """
+    Delivers events to every worker connected to the same Redis server, over pub/sub.
+    Like with Postgres, a worker misses the events published while it's
+    reconnecting.
+    """
+
+    def __init__(self, redis_url: str, channel: str):
+        super().__init__()
+        self._redis = redis.Redis.from_url(redis_url)
+        self._channel = channel
+
+    async def publish(self, event: str, **data) -> None:
+        # We get our own messages back, so handlers here run on delivery
+        await self._redis.publish(
+            self._channel, json.dumps({"event": event, "data": data})
+        )
+
+    async def run(self) -> None:
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self._channel)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._receive(message["data"])
+            except Exception:
+                logger.exception("Error listening for notifications, reconnecting")
+            await asyncio.sleep(RECONNECT_DELAY)
@@ -1,8 +1,8 @@
 import asyncio
 import os
 from collections import defaultdict
-from concurrent.futures import Executor
-from typing import Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 import numpy as np
 import openai
@@ -10,6 +10,9 @@ import openai
 from depolarizing_chatroom.constants import MAX_REPHRASING_ATTEMPTS
 from depolarizing_chatroom.data.template import (
     HorribleConfusingListWrapperThatMakesTemplateAccessPatternWork,
+    PrecompiledTemplateNotLoadedError,
+    TemplateManager,
+    render_precompiled,
 )
 from depolarizing_chatroom.logger import logger
 
@@ -55,8 +58,8 @@ BASE_LOGIT_BIASES = {
 }
 
 
-def rephrasings_generator(prompt, n=1, logit_bias=None, request_logprobs=False):
-    response = openai.Completion.create(
+def completion_args(prompt, n=1, logit_bias=None, request_logprobs=False):
+    return dict(
         engine="text-davinci-002",
         prompt=prompt,
         max_tokens=400,
@@ -67,6 +70,16 @@ def rephrasings_generator(prompt, n=1, logit_bias=None, request_logprobs=False):
         logit_bias=logit_bias or {},
     )
 
+
+def strategy_logit_bias(strategy: Optional[str]) -> Dict[str, float]:
+    return {**(STRATEGY_LOGIT_BIASES.get(strategy, {})), **BASE_LOGIT_BIASES}
+
+
+def rephrasings_generator(prompt, n=1, logit_bias=None, request_logprobs=False):
+    response = openai.Completion.create(
+        **completion_args(prompt, n, logit_bias, request_logprobs)
+    )
+
     response_text = ""
     for item in response:
         response_choice = item.choices[0]
@@ -82,6 +95,50 @@ def rephrasings_generator(prompt, n=1, logit_bias=None, request_logprobs=False):
             yield (response_choice.index, rephrasing)
 
 
+async def async_rephrasings_generator(
+    prompt, n=1, logit_bias=None
+) -> AsyncIterator[Tuple[int, str]]:
+    response = await openai.Completion.acreate(**completion_args(prompt, n, logit_bias))
+    async for item in response:
+        response_choice = item.choices[0]
+        yield response_choice.index, response_choice.text
+
+
+async def stream_strategy_rephrasings(
+    prompt, strategies: List[Optional[str]], n=1
+) -> AsyncIterator[Tuple[Optional[str], int, str]]:
+    """
+    Generate n rephrasings for each strategy at once (None meaning no strategy's
+    logit biases at all), yielding (strategy, index, text) as text comes in.
+    """
+    queue = asyncio.Queue()
+
+    async def generate(strategy: Optional[str]) -> None:
+        logit_bias = strategy_logit_bias(strategy) if strategy else None
+        async for index, text in async_rephrasings_generator(prompt, n, logit_bias):
+            await queue.put((strategy, index, text))
+
+    tasks = [asyncio.create_task(generate(strategy)) for strategy in strategies]
+    # Wake up the loop below whenever a strategy finishes, so we notice failures
+    for task in tasks:
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+
+    try:
+        finished = 0
+        while finished < len(tasks):
+            if (item := await queue.get()) is not None:
+                yield item
+                continue
+            finished += 1
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception():
+                    raise task.exception()
+    finally:
+        # Stop generating if we fail or whoever is streaming from us goes away
+        for task in tasks:
+            task.cancel()
+
+
 def collect_rephrasings(rephrasing_generator):
     rephrasings = defaultdict(list)
     logprobs = defaultdict(list)
@@ -106,10 +163,7 @@ def generate_rephrasing_task(prompt, strategy) -> Tuple[str, str]:
             (response,), _ = collect_rephrasings(
                 rephrasings_generator(
                     prompt,
-                    logit_bias={
-                        **(STRATEGY_LOGIT_BIASES.get(strategy, {})),
-                        **BASE_LOGIT_BIASES,
-                    },
+                    logit_bias=strategy_logit_bias(strategy),
                     n=1,
                 )
             )
@@ -119,13 +173,57 @@ def generate_rephrasing_task(prompt, strategy) -> Tuple[str, str]:
     return strategy, response
 
 
-async def generate_rephrasings(executor: Executor, templates, turns):
-    prompts = {
-        strategy: template.render(
-            HorribleConfusingListWrapperThatMakesTemplateAccessPatternWork(turns)
-        )
-        for (strategy, template) in templates.items()
-    }
+# The key of the precompiled template last sent to render processes, by template
+# name. Once a template's been sent, we try sending just its key.
+_sent_precompiled_keys: Dict[str, str] = {}
+
+
+async def render_in_process(
+    executor: ProcessPoolExecutor, name: str, template: TemplateManager, data
+) -> str:
+    precompiled = template.precompiled()
+    loop = asyncio.get_event_loop()
+    if _sent_precompiled_keys.get(name) == precompiled.key:
+        try:
+            return await loop.run_in_executor(
+                executor, render_precompiled, name, precompiled.key, data
+            )
+        except PrecompiledTemplateNotLoadedError:
+            # This process hasn't loaded it yet
+            pass
+    _sent_precompiled_keys[name] = precompiled.key
+    return await loop.run_in_executor(
+        executor, render_precompiled, name, precompiled.key, data, precompiled
+    )
+
+
+async def render_prompts(
+    executor: Optional[Executor], templates, turns
+) -> Dict[str, str]:
+    data = HorribleConfusingListWrapperThatMakesTemplateAccessPatternWork(turns)
+    loop = asyncio.get_event_loop()
+
+    # Template managers can't be pickled, so render precompiled templates if we're
+    # rendering in other processes
+    if isinstance(executor, ProcessPoolExecutor):
+        render_calls = [
+            render_in_process(executor, name, template, data)
+            for name, template in templates.items()
+        ]
+    else:
+        render_calls = [
+            loop.run_in_executor(executor, template.render, data)
+            for template in templates.values()
+        ]
+
+    return dict(zip(templates.keys(), await asyncio.gather(*render_calls)))
+
+
+async def generate_rephrasings(
+    executor: Executor, templates, turns, render_executor: Optional[Executor] = None
+):
+    # Render in an executor too, so big templates don't block the event loop
+    prompts = await render_prompts(render_executor or executor, templates, turns)
 
     # Run in executor to avoid blocking the event loop
     return dict(
@@ -3,8 +3,9 @@ from typing import Optional
 from fastapi import Depends, HTTPException
 from pydantic import BaseModel
 
+from ..auth_tokens import auth_tokens
 from ..data import models
-from ..data.crud import access
+from ..data.crud import UserIdentity, access
 from ..data.models import UserPosition
 from ..logger import format_parameterized_log_message, logger
 from ..server import app, get_user_from_auth_code
@@ -52,11 +53,14 @@ async def user(
 
 @app.post("/login")
 async def post_login(body: LoginBody) -> dict:
-    async with access.commit_after():
-        if not await access.process_login(body.token):
+    async with access.read_only():
+        if not (user := await access.process_login(body.token)):
             raise HTTPException(status_code=401, detail="Invalid sign in.")
 
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "token": auth_tokens.issue(UserIdentity(user.id, user.position)),
+    }
 
 
 @app.post("/signup")
@@ -76,7 +80,8 @@ async def post_signup(body: SignupBody) -> dict:
             )
         )
         # TODO: Consider handling this with some kind of error
-        return {"status": "ok"}
+        identity = await access.user_identity(body.respondentId)
+        return {"status": "ok", "token": auth_tokens.issue(identity)}
 
     logger.info(
         format_parameterized_log_message(
@@ -86,4 +91,7 @@ async def post_signup(body: SignupBody) -> dict:
             position=body.position.value,
         )
     )
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "token": auth_tokens.issue(UserIdentity(user.id, user.position)),
+    }
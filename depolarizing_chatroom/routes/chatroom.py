@@ -5,8 +5,9 @@ import time
 from datetime import datetime
 from typing import Optional
 
-from fastapi import Depends
+from fastapi import Depends, Query
 from pydantic import BaseModel
+from sqlalchemy import func
 
 from ..constants import (
     MIN_COUNTED_MESSAGE_WORD_COUNT,
@@ -16,14 +17,17 @@ from ..constants import (
     SOCKET_NAMESPACE_CHATROOM,
 )
 from ..data import models
-from ..data.crud import access
+from ..data.crud import UserIdentity, access
+from ..data.snapshots import ChatroomSnapshot
+from ..live_stats import IN_CHATROOM, live_stats
 from ..logger import format_parameterized_log_message, logger
 from ..rephrasings import generate_rephrasings
 from ..server import (
     app,
     executor,
+    get_render_executor,
     get_templates,
-    get_user_from_auth_code,
+    get_user_identity_from_auth_code,
     socket_manager,
 )
 from ..socketio_util import SessionSocketAsyncNamespace, SocketSession
@@ -39,7 +43,15 @@ class InitialViewBody(BaseModel):
 
 
 @app.get("/chatroom")
-async def get_chatroom(user: models.User = Depends(get_user_from_auth_code)):
+async def get_chatroom(
+    identity: UserIdentity = Depends(get_user_identity_from_auth_code),
+    include_messages: bool = Query(False, alias="messages"),
+):
+    """
+    The chatroom's state, and its messages if they're asked for (clients get them
+    over the socket).
+    """
+    user = await access.user(identity.id, select_messages=False)
     if not (chatroom := user.chatroom):
         # If user is not in a chatroom, redirect to waiting room
         logger.warning(
@@ -51,10 +63,11 @@ async def get_chatroom(user: models.User = Depends(get_user_from_auth_code)):
         )
         return {"redirect": "waiting"}
     chatroom_id = chatroom.id
-    async with access.commit_after():
-        # Get all previously sent messages in the chatroom
-        messages = await access.chatroom_messages(chatroom)
-        # Swap first two messages if chatroom.swap_view_messages is true
+    chatroom_messages = None
+    async with access.read_only():
+        if include_messages:
+            # Get all previously sent messages in the chatroom
+            chatroom_messages = await access.chatroom_transcript(chatroom)
         # Get other user in chatroom
         partner = await access.other_user_in_chatroom(chatroom_id, user.id)
     partner_online = partner.finished_chat_time is None
@@ -63,23 +76,26 @@ async def get_chatroom(user: models.User = Depends(get_user_from_auth_code)):
             "GET /chatroom",
             user_id=user.id,
             chatroom_id=chatroom_id,
-            message_count=len(messages),
+            message_count=len(chatroom_messages) if include_messages else None,
             partner_online=partner_online,
         )
     )
-    return {
-        "messages": messages,
+    response = {
         "limitReached": chatroom.limit_reached,
         "partnerOnline": partner.chatroom_session_id is not None,
         "id": chatroom_id,
     }
+    if include_messages:
+        response["messages"] = chatroom_messages
+    return response
 
 
 @app.post("/initial-view")
 async def initial_view(
     body: InitialViewBody,
-    user: models.User = Depends(get_user_from_auth_code),
+    identity: UserIdentity = Depends(get_user_identity_from_auth_code),
 ):
+    user = await access.user(identity.id, select_messages=False)
     if not user.chatroom or user.view:
         logger.warning(
             format_parameterized_log_message(
@@ -96,7 +112,7 @@ async def initial_view(
     chatroom = user.chatroom
     async with access.commit_after():
         user.view = body.view
-        access.add_message(chatroom.id, user.id, body.view)
+        await access.add_message(chatroom.id, user.id, body.view)
         access.save_event(user.id, "set_view")
     logger.info(
         format_parameterized_log_message(
@@ -109,10 +125,6 @@ async def initial_view(
 
 
 class ChatroomSocketSession(SocketSession):
-    def __init__(self, *args, **kwargs) -> None:
-        super().__init__(*args, **kwargs)
-        self._chatroom = self._user.chatroom
-
     async def on_connect(self) -> Optional[bool]:
         if not self._chatroom:
             return False
@@ -126,15 +138,24 @@ class ChatroomSocketSession(SocketSession):
             )
         )
 
+        values = dict(
+            chatroom_session_id=self._session_id,
+            started_chat_time=func.coalesce(
+                models.User.started_chat_time, datetime.now()
+            ),
+            finished_chat_time=None,
+        )
         async with access.commit_after():
-            self._user.chatroom_session_id = self._session_id
-
-            if self._user.started_chat_time is None:
-                self._user.started_chat_time = datetime.now()
-
-            self._user.finished_chat_time = None
-
+            # Users who reconnect before their old connection disconnects are still
+            # connected, and already counted
+            was_connected = not await access.update_user(
+                self._user.id, models.User.chatroom_session_id.is_(None), **values
+            )
+            if was_connected:
+                await access.update_user(self._user.id, **values)
             access.save_event(self._user.id, "join_chatroom", data=self._session_id)
+        if not was_connected:
+            live_stats.adjust(IN_CHATROOM, self._user.position, 1)
 
         self._sio.enter_room(self._session_id, self._user.chatroom_id)
 
@@ -145,17 +166,35 @@ class ChatroomSocketSession(SocketSession):
             skip_sid=self._session_id,
         )
 
-        messages = []
-        for message in await access.chatroom_messages(self._chatroom):
-            messages.append(
+        # Clients that reconnect pass the last sequence number they saw every message
+        # up to, and get the messages after it. A message held back while its sender
+        # picks a rephrasing is only shown once they do, after later messages, so
+        # clients can have seen messages after a gap; they skip the ones they have.
+        # The first two messages (the users' views) can be shown swapped, so clients
+        # that haven't seen both get them all again.
+        last_seq = self._auth.get("last_seq")
+        if isinstance(last_seq, int) and last_seq >= 2:
+            event = "missed_messages"
+            messages = await access.chatroom_transcript(
+                self._chatroom, after_seq=last_seq
+            )
+        else:
+            event = "messages"
+            messages = await access.chatroom_transcript(self._chatroom)
+
+        await self._sio.emit(
+            event,
+            [
                 {
                     "id": message.id,
+                    "seq": message.seq,
                     "user_id": message.sender_id,
-                    "message": message.selected_body,
+                    "message": message.body,
                 }
-            )
-
-        await self._sio.emit("messages", messages, to=self._session_id)
+                for message in messages
+            ],
+            to=self._session_id,
+        )
 
     async def on_disconnect(self) -> None:
         if not self._chatroom:
@@ -166,9 +205,21 @@ class ChatroomSocketSession(SocketSession):
         )
 
         async with access.commit_after():
-            self._user.chatroom_session_id = None
+            # If the user has already reconnected, they're still in the chatroom
+            left = await access.update_user(
+                self._user.id,
+                models.User.chatroom_session_id == self._session_id,
+                chatroom_session_id=None,
+                finished_chat_time=datetime.now(),
+            )
             access.save_event(self._user.id, "leave_chatroom", data=self._session_id)
-            self._user.finished_chat_time = datetime.now()
+        if left:
+            live_stats.adjust(IN_CHATROOM, self._user.position, -1)
+
+        # Nobody's reading the transcript once both users have left
+        async with access.read_only():
+            if not await access.chatroom_has_sessions(self._chatroom.id):
+                access.forget_transcript(self._chatroom.id)
 
         logger.debug(
             format_parameterized_log_message(
@@ -213,6 +264,8 @@ class ChatroomSocketSession(SocketSession):
                 message.accepted_rephrasing_id = rephrasing.id
             elif message.body != message_body:
                 message.edited_body = message_body
+            # Whichever way the message ended up, it's shown as the user sent it back
+            access.set_final_body(message, message_body)
             access.save_event(
                 self._user.id,
                 "rephrasing_response",
@@ -222,8 +275,11 @@ class ChatroomSocketSession(SocketSession):
                     "edited_message": message.body != message_body,
                 },
             )
+        # Our partner's turns have to include the message as it was sent once they
+        # see it
+        await access.commit()
 
-        await self._send_message_to_chatroom(message.selected_body)
+        await self._send_message_to_chatroom(message)
 
         logger.debug(
             format_parameterized_log_message(
@@ -302,9 +358,7 @@ class ChatroomSocketSession(SocketSession):
             )
         )
 
-        chatroom_messages = await access.chatroom_messages(
-            self._chatroom, select_users=True, select_rephrasings=True
-        )
+        chatroom_messages = await access.chatroom_transcript(self._chatroom)
 
         # Count messages, not including anything with fewer than 4 words (just counting
         # by spaces), a turn only happens if one user sends at least one message with at
@@ -325,11 +379,10 @@ class ChatroomSocketSession(SocketSession):
         ) = calculate_turns(
             [
                 {
-                    "position": message.user.position.value,
-                    "body": message.selected_body,
-                    # TODO: Figure out if this is an expensive operation (or maybe it's
-                    #  cached for us?)
-                    "rephrased": len(message.rephrasings) > 0,
+                    "position": message.position.value,
+                    "body": message.body,
+                    "word_count": message.word_count,
+                    "rephrased": message.has_rephrasings,
                 }
                 for message in chatroom_messages
             ],
@@ -377,9 +430,13 @@ class ChatroomSocketSession(SocketSession):
                         in_control_conversation=self._user.in_control_conversation,
                     )
                 )
-                self._chatroom.limit_reached = True
+                await access.update_chatroom(self._chatroom.id, limit_reached=True)
 
-            message = access.add_message(self._chatroom.id, self._user.id, message_body)
+            message = await access.add_message(
+                self._chatroom.id, self._user.id, message_body
+            )
+            # The event needs the message's ID
+            await access.flush()
 
             access.save_event(
                 self._user.id,
@@ -389,6 +446,9 @@ class ChatroomSocketSession(SocketSession):
                     "will_attempt_rephrasings": will_attempt_rephrasings,
                 },
             )
+        # Our partner's turns have to include this message from now on, and we don't
+        # want to keep a transaction open while rephrasings are generated
+        await access.commit()
 
         await self._sio.emit(
             "rephrasings_status",
@@ -406,7 +466,7 @@ class ChatroomSocketSession(SocketSession):
         if will_attempt_rephrasings:
             await self._send_rephrasings(message, turns, user_turn_count)
         else:
-            await self._send_message_to_chatroom(message_body)
+            await self._send_message_to_chatroom(message)
 
     async def _send_rephrasings(self, message, turns, user_turn_count) -> None:
         user_position = self._user.position.value
@@ -424,7 +484,8 @@ class ChatroomSocketSession(SocketSession):
 
         template_rephrasing_message = {
             "position": user_position,
-            "body": message.selected_body,
+            "body": message.final_body,
+            "word_count": message.word_count,
         }
 
         if last_turn_is_user:
@@ -443,7 +504,12 @@ class ChatroomSocketSession(SocketSession):
                 rephrasings = [
                     access.add_rephrasing(message.id, response, strategy)
                     for strategy, response in (
-                        await generate_rephrasings(executor, templates, template_turns)
+                        await generate_rephrasings(
+                            executor,
+                            templates,
+                            template_turns,
+                            render_executor=get_render_executor(),
+                        )
                     ).items()
                 ]
             else:
@@ -459,6 +525,8 @@ class ChatroomSocketSession(SocketSession):
                     access.add_rephrasing(message.id, "rephrasing 2", "strategy 2"),
                     access.add_rephrasing(message.id, "rephrasing 3", "strategy 3"),
                 ]
+            if rephrasings:
+                access.mark_rephrased(message)
             end_time = time.perf_counter()
             logger.debug(
                 format_parameterized_log_message(
@@ -473,6 +541,9 @@ class ChatroomSocketSession(SocketSession):
             access.save_event(
                 self._user.id, "rephrasings_response", data={"message_id": message.id}
             )
+        # The user can pick a rephrasing as soon as we send them, and committing also
+        # gives them their IDs
+        await access.commit()
 
         # We want to present rephrasings in a random order
         random.shuffle(rephrasings)
@@ -499,10 +570,10 @@ class ChatroomSocketSession(SocketSession):
     async def _redirect_to_waiting(self, session_id) -> None:
         await self._sio.emit("redirect", dict(to="waiting"), to=session_id)
 
-    async def _send_message_to_chatroom(self, message_body) -> None:
+    async def _send_message_to_chatroom(self, message: models.Message) -> None:
         await self._sio.emit(
             f"new_message",
-            dict(user_id=self._user.id, message=message_body),
+            dict(user_id=self._user.id, message=message.final_body, seq=message.seq),
             to=self._chatroom.id,
         )
         logger.debug(
@@ -510,9 +581,11 @@ class ChatroomSocketSession(SocketSession):
                 "Broadcasted message to chatroom",
                 user_id=self._user.id,
                 chatroom_id=self._chatroom.id,
-                message_length=len(message_body),
+                message_length=len(message.final_body),
             )
         )
+        # Either user can reach the limit, so check the chatroom as it is now
+        self._chatroom = ChatroomSnapshot.of(await access.chatroom(self._chatroom.id))
         if self._chatroom.limit_reached:
             await self._sio.emit("min_limit_reached", to=self._chatroom.id)
 
@@ -1,8 +1,24 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional, Set
+
+from fastapi_async_sqlalchemy import db
 from pydantic import BaseModel
+from socketio import AsyncNamespace
 
-from ..data.crud import access
+from ..constants import (
+    SOCKET_NAMESPACE_DASHBOARD,
+    STATS_RECONCILE_INTERVAL,
+    STATS_SNAPSHOT_INTERVAL,
+)
+from ..data.crud import OnlineUserCounts, TransactionStats, access
 from ..data.models import UserPosition
-from ..server import app
+from ..data.pool import PoolStats, pool_stats
+from ..data.query_stats import QueryStats, query_stats
+from ..data.transcripts import TranscriptCacheStats
+from ..live_stats import live_stats
+from ..logger import logger
+from ..server import app, engine, replica_engine, socket_manager, writer_engine
 
 
 class StatsByPosition(BaseModel):
@@ -17,49 +33,153 @@ class Stats(BaseModel):
     inChatroom: StatsByPosition
 
 
-@app.get("/stats")
-async def stats() -> Stats:
-    # TODO: Consider a gather call here just because we're awaiting so many things right
-    #  after each other.
-    unmatched_supporter_count = len(
-        await access.users_in_waiting_room(position=UserPosition.SUPPORT, matched=False)
-    )
-    unmatched_opponent_count = len(
-        await access.users_in_waiting_room(position=UserPosition.OPPOSE, matched=False)
-    )
-    pre_chat_supporter_count = len(
-        await access.users_in_waiting_room(position=UserPosition.SUPPORT, matched=True)
-    )
-    pre_chat_opponent_count = len(
-        await access.users_in_waiting_room(position=UserPosition.OPPOSE, matched=True)
-    )
-    in_chatroom_supporter_count = len(
-        await access.users_in_chatroom(position=UserPosition.SUPPORT)
-    )
-    in_chatroom_opponent_count = len(
-        await access.users_in_chatroom(position=UserPosition.OPPOSE)
-    )
-    total_online = (
-        unmatched_supporter_count
-        + unmatched_opponent_count
-        + pre_chat_supporter_count
-        + pre_chat_opponent_count
-        + in_chatroom_supporter_count
-        + in_chatroom_opponent_count
-    )
+async def read_online_user_counts() -> Dict[UserPosition, OnlineUserCounts]:
+    # The dashboard can stand to be a little behind
+    async with access.read_only(replica=True):
+        return await access.online_user_counts()
+
+
+async def compute_stats() -> Stats:
+    counts = await read_online_user_counts()
+    supporters = counts[UserPosition.SUPPORT]
+    opponents = counts[UserPosition.OPPOSE]
 
     return Stats(
-        totalOnline=total_online,
+        totalOnline=supporters.total + opponents.total,
         unmatched=StatsByPosition(
-            supporters=unmatched_supporter_count,
-            opponents=unmatched_opponent_count,
+            supporters=supporters.unmatched,
+            opponents=opponents.unmatched,
         ),
         prechat=StatsByPosition(
-            supporters=pre_chat_supporter_count,
-            opponents=pre_chat_opponent_count,
+            supporters=supporters.prechat,
+            opponents=opponents.prechat,
         ),
         inChatroom=StatsByPosition(
-            supporters=in_chatroom_supporter_count,
-            opponents=in_chatroom_opponent_count,
+            supporters=supporters.in_chatroom,
+            opponents=opponents.in_chatroom,
         ),
     )
+
+
+class StatsSnapshot:
+    """
+    The latest stats, shared by every dashboard polling this process. Stats are
+    recomputed at most once per interval however many dashboards are polling, and
+    callers that arrive while they're being recomputed wait for that rather than
+    running their own query.
+    """
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._stats: Optional[Stats] = None
+        self._computed_at = float("-inf")
+        self._lock = asyncio.Lock()
+
+    def _is_stale(self) -> bool:
+        return time.monotonic() - self._computed_at >= self._interval
+
+    async def get(self) -> Stats:
+        if self._is_stale():
+            async with self._lock:
+                if self._is_stale():
+                    self._stats = await compute_stats()
+                    self._computed_at = time.monotonic()
+        return self._stats
+
+
+stats_snapshot = StatsSnapshot(STATS_SNAPSHOT_INTERVAL)
+
+
+@app.get("/stats")
+async def stats() -> Stats:
+    return await stats_snapshot.get()
+
+
+@app.get("/stats/transactions")
+def transaction_stats() -> TransactionStats:
+    return access.transaction_stats()
+
+
+@app.get("/stats/queries")
+def query_stats_by_scope() -> Dict[str, QueryStats]:
+    """
+    Statements run by each route and socket event, since this process started.
+    """
+    return query_stats.stats()
+
+
+@app.get("/stats/pool")
+def connection_pool_stats() -> Dict[str, Optional[PoolStats]]:
+    """
+    Connection pools for this worker. Pools that aren't instrumented (like SQLite's)
+    are null.
+    """
+    stats = {"primary": pool_stats(engine)}
+    if writer_engine is not None:
+        # SQLite's single writer connection
+        stats["writer"] = pool_stats(writer_engine)
+    if replica_engine is not None:
+        stats["replica"] = pool_stats(replica_engine)
+    return stats
+
+
+@app.get("/stats/transcripts")
+def transcript_cache_stats() -> TranscriptCacheStats:
+    """
+    This worker's cache of chatroom transcripts, and how many reads it's answered.
+    """
+    return access.transcript_stats()
+
+
+class DashboardNamespace(AsyncNamespace):
+    """
+    Pushes live stats to dashboards. Connecting dashboards get every counter and the
+    recent history, then "stats_changed" events with just the counters that changed.
+
+    Each process pushes its own counters to the dashboards connected to it, so
+    updates skip the message queue.
+    """
+
+    def __init__(self, namespace: str):
+        super().__init__(namespace)
+        self._session_ids: Set[str] = set()
+        self._reconcile_task: Optional[asyncio.Task] = None
+
+    async def on_connect(self, session_id, _environ, _auth=None) -> None:
+        self._session_ids.add(session_id)
+        if self._reconcile_task is None:
+            self._reconcile_task = asyncio.get_running_loop().create_task(
+                self._reconcile_loop()
+            )
+        if not live_stats.active:
+            async with db():
+                live_stats.start(self._publish, await read_online_user_counts())
+        await self.emit("stats", live_stats.stats(), to=session_id, ignore_queue=True)
+        await self.emit(
+            "stats_history", live_stats.history(), to=session_id, ignore_queue=True
+        )
+
+    async def on_disconnect(self, session_id, *_) -> None:
+        self._session_ids.discard(session_id)
+        if not self._session_ids and self._reconcile_task is not None:
+            self._reconcile_task.cancel()
+            self._reconcile_task = None
+            live_stats.stop()
+
+    async def _publish(self, changes: Dict[str, Any]) -> None:
+        for session_id in list(self._session_ids):
+            await self.emit("stats_changed", changes, to=session_id, ignore_queue=True)
+
+    async def _reconcile_loop(self) -> None:
+        # Users handled by other processes only show up when we read the counts again
+        while True:
+            await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+            try:
+                async with db():
+                    live_stats.reset(await read_online_user_counts())
+            except Exception:
+                logger.exception("Error reconciling live stats")
+
+
+# noinspection PyProtectedMember
+socket_manager._sio.register_namespace(DashboardNamespace(SOCKET_NAMESPACE_DASHBOARD))
@@ -1,17 +1,25 @@
 import html
 import json
-import re
-from pathlib import Path
-from typing import Any, Dict
+from collections import defaultdict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
+from fastapi import Header, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.requests import Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from .. import rephrasings as sr
+from ..constants import TEMPLATE_COMPLETIONS_MAX_N
 from ..data.template import (
     HorribleConfusingListWrapperThatMakesTemplateAccessPatternWork,
 )
-from ..rephrasings import BASE_LOGIT_BIASES, STRATEGY_LOGIT_BIASES
+from ..data.template_cache import CacheStats, TemplateManagerCache
+from ..data.template_storage import (
+    TemplateVersionConflictError,
+    create_template_storage,
+)
+from ..logger import format_parameterized_log_message, logger
 from ..server import TemplateManager, app
 from ..util import calculate_turns, last_n_turns
 
@@ -21,49 +29,58 @@ class ParseTemplateBody(BaseModel):
     value: str
 
 
-def load_default_template() -> Dict[str, Any]:
-    with open("template.json") as f:
-        template_data = json.load(f)
-
-    return template_data["default"]
-
-
-def user_template_filepath(user_id):
-    filename = re.sub(r"[\W_]+", "", user_id).lower() + ".json"
-    return Path(filename)
+template_storage = create_template_storage()
+# Editors preview on every keystroke, mostly with templates we've seen before
+template_managers = TemplateManagerCache()
 
 
-def load_user_template(user_id: str) -> Dict[str, Any]:
-    user_filepath = user_template_filepath(user_id)
+def parse_if_match(if_match: Optional[str]) -> Optional[int]:
+    if if_match is None:
+        return None
+    try:
+        return int(if_match.strip('W/"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid If-Match header")
 
-    if not user_filepath.exists():
-        return load_default_template()
-
-    with open(user_filepath) as f:
-        return json.load(f)
 
+def set_etag(response: Response, version: int) -> None:
+    response.headers["ETag"] = f'"{version}"'
 
-def save_user_template(user_id: str, data: Dict[str, Any]) -> None:
-    user_filepath = user_template_filepath(user_id)
 
-    with open(user_filepath, "w") as f:
-        json.dump(data, f)
+@app.get("/template/cache/stats")
+def template_cache_stats() -> Dict[str, CacheStats]:
+    return template_managers.stats()
 
 
 @app.get("/template/{user_id}")
-def template(user_id):
-    return load_user_template(user_id)
+async def template(user_id, response: Response):
+    document = await template_storage.get(user_id)
+    set_etag(response, document.version)
+    return document.data
 
 
 @app.patch("/template/{user_id}")
-async def patch_template(user_id, request: Request):
-    user_data = load_user_template(user_id)
+async def patch_template(
+    user_id,
+    request: Request,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+):
     request_body = await request.json()
-    # deeply html.unescape all strings in user_data
-    user_data = html.unescape(json.dumps(user_data))
-    user_data = json.loads(user_data)
-    user_data = {**user_data, **request_body}
-    save_user_template(user_id, user_data)
+
+    def update_data(user_data: Dict[str, Any]) -> Dict[str, Any]:
+        # deeply html.unescape all strings in user_data
+        user_data = html.unescape(json.dumps(user_data))
+        user_data = json.loads(user_data)
+        return {**user_data, **request_body}
+
+    try:
+        document = await template_storage.update(
+            user_id, update_data, expected_version=parse_if_match(if_match)
+        )
+    except TemplateVersionConflictError:
+        raise HTTPException(status_code=409, detail="Template has changed")
+    set_etag(response, document.version)
 
 
 @app.get("/template/example-data")
@@ -73,7 +90,12 @@ def template():
 
 
 def render_template(template_manager: TemplateManager, data: Any) -> str:
-    data = [item for item in data["data"] if item["visible"]]
+    # Example data doesn't come from the database, so count its words here
+    data = [
+        {**item, "word_count": len(item["body"].split())}
+        for item in data["data"]
+        if item["visible"]
+    ]
 
     (
         turn_count,
@@ -91,28 +113,34 @@ def render_template(template_manager: TemplateManager, data: Any) -> str:
 
 
 @app.get("/template/preview/{user_id}")
-def template(user_id):
-    user_data = load_user_template(user_id)
+async def template(user_id):
+    user_data = (await template_storage.get(user_id)).data
 
-    template_manager = TemplateManager(user_data["root"], user_data["templates"])
+    # Parsing and rendering are CPU-bound, so keep them off the event loop
+    template_manager = await run_in_threadpool(
+        template_managers.get, user_data["root"], user_data["templates"]
+    )
 
     if errors := template_manager.errors:
         return {"errors": errors}
 
-    return {"preview": render_template(template_manager, user_data)}
+    return {
+        "preview": await run_in_threadpool(render_template, template_manager, user_data)
+    }
 
 
 @app.post("/template/parse/{user_id}")
-def template(user_id, body: ParseTemplateBody):
-    user_data = load_user_template(user_id)
+async def template(user_id, body: ParseTemplateBody, response: Response):
+    document = await template_storage.get(user_id)
+    user_data = document.data
     is_root = body.template == "root"
     templates = user_data["templates"]
 
     if not is_root:
         templates[body.template] = body.value
 
-    template_manager = TemplateManager(
-        body.value if is_root else user_data["root"], templates
+    template_manager = await run_in_threadpool(
+        template_managers.get, body.value if is_root else user_data["root"], templates
     )
 
     if errors := template_manager.errors:
@@ -120,12 +148,23 @@ def template(user_id, body: ParseTemplateBody):
 
     if is_root:
         template = template_manager.root
-        user_data["root"] = body.value
     else:
         template = template_manager.template(body.template)
-        user_data["templates"][body.template] = body.value
 
-    save_user_template(user_id, user_data)
+    def update_data(user_data: Dict[str, Any]) -> Dict[str, Any]:
+        if is_root:
+            user_data["root"] = body.value
+        else:
+            user_data["templates"][body.template] = body.value
+        return user_data
+
+    # Only this template changes, so there's no harm in applying the change to a
+    # newer version if someone else saved in the meantime
+    try:
+        document = await template_storage.update(user_id, update_data)
+    except TemplateVersionConflictError:
+        raise HTTPException(status_code=409, detail="Template has changed")
+    set_etag(response, document.version)
 
     # TODO: Decide what to do with this—why is this commented out? what does it do?
     # try:
@@ -140,23 +179,82 @@ def template(user_id, body: ParseTemplateBody):
     )
 
 
-@app.get("/template/completions/{user_id}")
-def template(user_id):
-    user_data = load_user_template(user_id)
+async def render_completion_prompt(user_id: str) -> Tuple[Optional[str], Any]:
+    """
+    Returns the prompt for a user's template, or None and the template's errors.
+    """
+    user_data = (await template_storage.get(user_id)).data
 
-    template_manager = TemplateManager(user_data["root"], user_data["templates"])
+    template_manager = await run_in_threadpool(
+        template_managers.get, user_data["root"], user_data["templates"]
+    )
 
     if errors := template_manager.errors:
+        return None, errors
+
+    return await run_in_threadpool(render_template, template_manager, user_data), None
+
+
+@app.get("/template/completions/{user_id}")
+async def template(user_id):
+    prompt, errors = await render_completion_prompt(user_id)
+    if errors:
         return {"errors": errors}
 
-    prompt = render_template(template_manager, user_data)
-    responses, _ = sr.collect_rephrasings(sr.rephrasings_generator(prompt, n=3))
-    sr.rephrasings_generator(
-        prompt,
-        logit_bias={
-            **(STRATEGY_LOGIT_BIASES.get(user_id, {})),
-            **BASE_LOGIT_BIASES,
-        },
-        n=1,
+    completions = defaultdict(list)
+    async for index, text in sr.async_rephrasings_generator(prompt, n=3):
+        completions[index].append(text)
+    return {
+        "completions": [
+            "".join(completion).rstrip('"') for completion in completions.values()
+        ]
+    }
+
+
+def server_sent_event(data: Any, event: Optional[str] = None) -> str:
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+
+
+@app.get("/template/completions/{user_id}/stream")
+async def template_completions_stream(
+    user_id,
+    n: int = Query(3, ge=1, le=TEMPLATE_COMPLETIONS_MAX_N),
+    strategy: Optional[List[str]] = Query(None),
+):
+    """
+    Stream completions as server-sent events as they're generated: one message per
+    piece of text, with the strategy and index of the completion it belongs to. With
+    no strategies, completions are generated without any strategy's logit biases.
+    Ends with a "done" event, or an "errors" event if the template has errors.
+    """
+    prompt, errors = await render_completion_prompt(user_id)
+
+    async def events() -> AsyncIterator[str]:
+        if errors:
+            yield server_sent_event(errors, "errors")
+            return
+        try:
+            async for (
+                completion_strategy,
+                index,
+                text,
+            ) in sr.stream_strategy_rephrasings(prompt, strategy or [None], n):
+                yield server_sent_event(
+                    dict(strategy=completion_strategy, index=index, text=text)
+                )
+        except Exception:
+            logger.exception(
+                format_parameterized_log_message(
+                    "Error streaming completions", user_id=user_id
+                )
+            )
+            yield server_sent_event("Error generating completions", "errors")
+            return
+        yield server_sent_event(None, "done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Don't let proxies hold on to events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    return {"completions": responses}
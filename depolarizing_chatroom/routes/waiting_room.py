@@ -1,27 +1,37 @@
+import asyncio
 import random
 import uuid
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
 
 from fastapi import Depends
 from sqlalchemy import case, insert, tuple_, update
 from sqlalchemy.orm.exc import StaleDataError
 
-from ..constants import SOCKET_NAMESPACE_WAITING_ROOM
+from ..constants import (
+    MATCH_ATTEMPTS,
+    MATCH_RETRY_DELAY,
+    MATCH_SKIP_LOCKED,
+    SOCKET_NAMESPACE_WAITING_ROOM,
+    WAITING_ROOM_TIMEOUT,
+    WAITING_ROOM_TIMEOUT_RETRY_DELAY,
+)
 from ..data import models
 from ..data.crud import access
-from ..data.models import UserTreatment
+from ..data.models import UserPosition, UserTreatment
+from ..data.snapshots import UserSnapshot
+from ..live_stats import PRECHAT, UNMATCHED, live_stats, waiting_room_stage
 from ..logger import format_parameterized_log_message, logger
-from ..server import app, get_user_from_auth_code, socket_manager
+from ..notifications import NotificationBus
+from ..server import app, get_user_from_auth_code, notifications, socket_manager
 from ..socketio_util import SessionSocketAsyncNamespace, SocketSession
 
 
 @app.get("/waiting-status")
 async def get_waiting_status(user: models.User = Depends(get_user_from_auth_code)):
     # Check if user is in chatroom
-    chatroom = user.chatroom
-    if chatroom:
-        other_user = await access.other_user_in_chatroom(chatroom.id, user.id)
+    if chatroom_id := user.chatroom_id:
+        other_user = await access.other_user_in_chatroom(chatroom_id, user.id)
         if not other_user or other_user.waiting_session_id is None:
             partner_status = "offline"
             if not other_user:
@@ -29,7 +39,7 @@ async def get_waiting_status(user: models.User = Depends(get_user_from_auth_code
                     format_parameterized_log_message(
                         "User is in chatroom without partner",
                         user_id=user.id,
-                        chatroom_id=chatroom.id,
+                        chatroom_id=chatroom_id,
                     )
                 )
         else:
@@ -48,12 +58,22 @@ async def get_waiting_status(user: models.User = Depends(get_user_from_auth_code
 
 
 class WaitingRoomSocketSession(SocketSession):
+    async def _refresh_user(self) -> models.User:
+        # Users are matched by their partners' sessions, so what we know about our user
+        # can be out of date
+        user = await access.user(self._user.id, select_messages=False)
+        self._user = UserSnapshot.of(user)
+        return user
+
     async def on_connect(self) -> None:
-        user = self._user
+        user = await self._refresh_user()
+        was_waiting = user.waiting_session_id is not None
 
         async with access.commit_after():
             user.waiting_session_id = self._session_id
             access.save_event(user.id, "join_waiting_room", data=self._session_id)
+        if not was_waiting:
+            live_stats.adjust(waiting_room_stage(user), user.position, 1)
 
         logger.debug(
             format_parameterized_log_message(
@@ -80,12 +100,22 @@ class WaitingRoomSocketSession(SocketSession):
                 )
             )
         try:
-            if (redirect_target := await self._redirect_target()) is not None:
-                await self._redirect(redirect_target)
+            if (redirect_target := await self._redirect_target(user)) is not None:
+                # If we're being redirected to the chatroom—which means both users have
+                # filled out their views—then we should redirect our partner if they're
+                # online too.
+                redirect_partner = redirect_target == "chatroom" and partner
                 async with access.commit_after():
                     access.save_event(
                         user.id, "waiting_room_redirect", data=redirect_target
                     )
+                    if redirect_partner:
+                        access.save_event(user.id, "waiting_room_redirect_partner")
+                # Redirected users leave the waiting room, and whatever handles that
+                # has to see everything we've written
+                await access.commit()
+
+                await self._redirect(redirect_target)
                 logger.debug(
                     format_parameterized_log_message(
                         "Redirected user after joining waiting room",
@@ -93,13 +123,8 @@ class WaitingRoomSocketSession(SocketSession):
                         redirect=redirect_target,
                     )
                 )
-                # If we're being redirected to the chatroom—which means both users have
-                # filled out their views—then we should redirect our partner if they're
-                # online too.
-                if redirect_target == "chatroom" and partner:
+                if redirect_partner:
                     await self._redirect(redirect_target, partner.waiting_session_id)
-                    async with access.commit_after():
-                        access.save_event(user.id, "waiting_room_redirect_partner")
                     logger.debug(
                         format_parameterized_log_message(
                             "Redirected partner to chatroom after joining waiting room",
@@ -117,7 +142,6 @@ class WaitingRoomSocketSession(SocketSession):
             )
             return
 
-        # TODO: Move the rest of this function into something else
         # Not elegant, but we don't want to try rematching if the user is already in a
         # chatroom.
         if user.chatroom_id is not None:
@@ -135,18 +159,76 @@ class WaitingRoomSocketSession(SocketSession):
             async with access.commit_after():
                 user.started_waiting_time = datetime.now()
 
-        # Save user ID for error message if needed
-        user_id = user.id
+        # Other users can only match with us once we're committed
+        await access.commit()
+        waiting_room_watcher.waiting(user.id, user.started_waiting_time)
+        await notifications.publish(
+            "join", user_id=user.id, position=user.position.value
+        )
 
-        # End running transaction to explicitly start a new one
-        await access.session.commit()
+        await self._match(user.id)
+
+    async def _match(self, user_id: int) -> None:
+        """
+        Match the user with the user of the other position who's waited longest, if
+        there is one.
+        """
+        for attempt in range(MATCH_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(random.uniform(0, MATCH_RETRY_DELAY))
+                await access.commit()
+                async with access.transaction():
+                    if not await access.is_waiting_to_match(user_id):
+                        return
+            if not await self._try_match(user_id):
+                return
+        logger.debug(
+            format_parameterized_log_message(
+                "User is already matched or being matched",
+                user_id=user_id,
+            )
+        )
+        # If the other transactions don't match us after all, we'll try again when
+        # someone joins
+        waiting_room_watcher.stalled(user_id, self._user.position)
+
+    async def _try_match(self, user_id: int) -> bool:
+        """
+        Make one attempt at matching the user. Returns whether to try again because
+        users were locked by concurrent matches.
+        """
+        # This ends the running transaction so we can explicitly start a new one
+        await access.commit()
 
         try:
-            async with access.session.begin():
-                # Update user at beginning of this transaction
-                user = await access.user(user_id)
-                # Get first available match by position
-                match_user = await access.random_user_to_match_with(user)
+            async with access.transaction():
+                dialect = access.session.get_bind().dialect.name
+                if MATCH_SKIP_LOCKED and dialect == "postgresql":
+                    # Lock both users as we go, so concurrent matches pass over them
+                    # instead of conflicting at the end. We lock our partner first,
+                    # never waiting for them, then ourselves, only waiting if our ID
+                    # is lower than our partner's. Every transaction that waits then
+                    # waits on a lower ID than the one it holds, so no two can wait on
+                    # each other, and matching can't deadlock.
+                    match_user = await access.claim_user_to_match_with(self._user)
+                    if match_user is None:
+                        # Everyone we could match with may be locked, in which case
+                        # they're likely free again in a moment
+                        return await access.has_user_to_match_with(self._user)
+                    wait = user_id < match_user.id
+                    user = await access.lock_user_to_match(
+                        user_id, skip_locked=not wait
+                    )
+                    if user is None:
+                        # If we waited, whoever had us locked matched us (or we left).
+                        # Otherwise someone is matching us right now, and we try again
+                        # in case they don't.
+                        return not wait
+                else:
+                    # Update user at beginning of this transaction
+                    user = await access.user(user_id)
+                    # Get first available match by position
+                    match_user = await access.random_user_to_match_with(user)
 
                 if match_user is None:
                     # No match found, wait for another user to join
@@ -156,7 +238,7 @@ class WaitingRoomSocketSession(SocketSession):
                             user_id=user.id,
                         )
                     )
-                    return
+                    return False
 
                 # We want to be able to log the matched user's ID but SQLAlchemy will
                 # lock up the database if we try to access it after something goes awry
@@ -170,59 +252,76 @@ class WaitingRoomSocketSession(SocketSession):
                 # ...and their partner
                 partner_treatment = treatment.match_with
 
-                # This is a CTE, or Common Table Expression, which is a temporary table
-                # that can be used in a query. We use it to create a chatroom and
-                # associate it with both users in a single query.
-                create_chatroom_cte = (
-                    insert(models.Chatroom)
-                    .values(swap_view_messages=random.choice([True, False]))
-                    .returning(models.Chatroom.id)
-                    .cte("create_chatroom")
-                )
-
                 # Save these just in case SQLAlchemy does some dynamic attribute lookup
                 # that changes these values before we'd expect
                 user_match_version = user.match_version
                 match_user_match_version = match_user.match_version
 
-                # This horrible query manages to avoid deadlocks by creating the
-                # chatroom and updating both users in a single query.
-                update_users_statement = (
-                    update(models.User)
-                    .where(
-                        # The only reason we're checking this is because it will add
-                        # a FROM create_chatroom clause to the query, which we need
-                        # for chatroom_id=create_chatroom_cte.c.id
-                        # TODO: Figure out how to add a FROM for cte without adding it
-                        #  to where (is this actually unsupported?)
-                        create_chatroom_cte.c.id != -1,
-                        tuple_(models.User.id, models.User.match_version).in_(
-                            [
-                                (user.id, user_match_version),
-                                (match_user.id, match_user_match_version),
-                            ]
-                        ),
+                values = dict(
+                    treatment=case(
+                        [
+                            (models.User.id == user.id, treatment.name),
+                            (
+                                models.User.id == match_user.id,
+                                partner_treatment.name,
+                            ),
+                        ]
+                    ).cast(models.User.treatment.type),
+                    found_match_time=found_match_time,
+                    # This is an implementation of optimistic concurrency control
+                    match_version=uuid.uuid4().hex,
+                )
+                match_versions = tuple_(models.User.id, models.User.match_version).in_(
+                    [
+                        (user.id, user_match_version),
+                        (match_user.id, match_user_match_version),
+                    ]
+                )
+
+                if dialect == "sqlite":
+                    # SQLite can't run an INSERT in a CTE, but its writes are
+                    # serialized (see data/sqlite.py), so creating the chatroom first
+                    # can't deadlock
+                    chatroom = access.create_chatroom()
+                    await access.flush()
+                    chatroom_id = chatroom.id
+                    match_users = await access.session.execute(
+                        update(models.User)
+                        .where(match_versions)
+                        .values(chatroom_id=chatroom_id, **values)
                     )
-                    .values(
-                        treatment=case(
-                            [
-                                (models.User.id == user.id, treatment.name),
-                                (
-                                    models.User.id == match_user.id,
-                                    partner_treatment.name,
-                                ),
-                            ]
-                        ).cast(models.User.treatment.type),
-                        found_match_time=found_match_time,
-                        chatroom_id=create_chatroom_cte.c.id,
-                        # This is an implementation of optimistic concurrency control
-                        match_version=uuid.uuid4().hex,
+                else:
+                    # This is a CTE, or Common Table Expression, which is a temporary
+                    # table that can be used in a query. We use it to create a chatroom
+                    # and associate it with both users in a single query.
+                    create_chatroom_cte = (
+                        insert(models.Chatroom)
+                        .values(swap_view_messages=random.choice([True, False]))
+                        .returning(models.Chatroom.id)
+                        .cte("create_chatroom")
                     )
-                    .returning(create_chatroom_cte.c.id)
-                )
 
-                # Actually run the query
-                match_users = await access.session.execute(update_users_statement)
+                    # This horrible query manages to avoid deadlocks by creating the
+                    # chatroom and updating both users in a single query.
+                    update_users_statement = (
+                        update(models.User)
+                        .where(
+                            # The only reason we're checking this is because it will
+                            # add a FROM create_chatroom clause to the query, which we
+                            # need for chatroom_id=create_chatroom_cte.c.id
+                            # TODO: Figure out how to add a FROM for cte without adding
+                            #  it to where (is this actually unsupported?)
+                            create_chatroom_cte.c.id != -1,
+                            match_versions,
+                        )
+                        .values(chatroom_id=create_chatroom_cte.c.id, **values)
+                        .returning(create_chatroom_cte.c.id)
+                    )
+
+                    # Actually run the query
+                    match_users = await access.session.execute(update_users_statement)
+                    # Get the chatroom ID returned from the query (RETURNING clause)
+                    chatroom_id = match_users.scalar()
 
                 # This will happen if either user's match_version has changed since
                 # we started the transaction because we specify our known match_version
@@ -235,9 +334,6 @@ class WaitingRoomSocketSession(SocketSession):
                         "User concurrently updated while attempting to match"
                     )
 
-                # Get the chatroom ID returned from the query (RETURNING clause)
-                chatroom_id = match_users.scalar()
-
                 access.save_event(user.id, "create_chatroom", data=chatroom_id)
         except StaleDataError:
             logger.warning(
@@ -247,12 +343,20 @@ class WaitingRoomSocketSession(SocketSession):
                     partner_user_id=match_user_id,
                 )
             )
-            return
+            # Whoever is still unmatched can try again straight away, wherever they're
+            # connected
+            await notifications.publish(
+                "match_conflict", user_ids=[user_id, match_user_id]
+            )
+            return False
 
         # Refresh instance objects after committing them because otherwise they'll throw
         # all kinds of errors
         await access.session.refresh(user)
         await access.session.refresh(match_user)
+        for matched_user in (user, match_user):
+            live_stats.move(UNMATCHED, PRECHAT, matched_user.position)
+        await notifications.publish("match", user_ids=[user.id, match_user.id])
 
         # Only log after a successful transaction
         logger.info(
@@ -303,14 +407,18 @@ class WaitingRoomSocketSession(SocketSession):
                     [session_user.id, matched_with.id],
                     to=session_user.waiting_session_id,
                 )
+        return False
 
     async def on_disconnect(self) -> None:
         # Remove user from waiting room pool
-        user = self._user
+        user = await self._refresh_user()
+        if user.waiting_session_id is not None:
+            live_stats.adjust(waiting_room_stage(user), user.position, -1)
         async with access.commit_after():
             user.finished_waiting_time = datetime.now()
             user.waiting_session_id = None
             access.save_event(user.id, "leave_waiting_room", data=self._session_id)
+        await notifications.publish("leave", user_id=user.id)
         logger.debug(
             format_parameterized_log_message(
                 "User disconnected from waiting room",
@@ -335,7 +443,44 @@ class WaitingRoomSocketSession(SocketSession):
                 )
             )
 
-    async def _redirect_target(self) -> Optional[str]:
+    async def rematch(self) -> None:
+        """
+        Try matching again after an earlier attempt was stalled by a concurrent match.
+        """
+        user = await self._refresh_user()
+        if user.waiting_session_id == self._session_id and user.chatroom_id is None:
+            await self._match(user.id)
+
+    async def time_out(self) -> None:
+        """
+        Redirect the user to the no-chat post-chat survey if they've waited for a
+        partner for longer than WAITING_ROOM_TIMEOUT.
+        """
+        user = await self._refresh_user()
+        if (
+            user.waiting_session_id != self._session_id
+            or user.chatroom_id is not None
+            or user.started_waiting_time is None
+        ):
+            return
+        if (
+            user.started_waiting_time + timedelta(seconds=WAITING_ROOM_TIMEOUT)
+            > datetime.now()
+        ):
+            # They started waiting again since we were scheduled
+            waiting_room_watcher.waiting(user.id, user.started_waiting_time)
+            return
+        logger.warning(
+            format_parameterized_log_message(
+                "User timed out in waiting room, redirecting to post-chat survey",
+                user_id=user.id,
+            )
+        )
+        await self._sio.emit("redirect", {"url": user.no_chat_url}, to=self._session_id)
+        async with access.commit_after():
+            access.save_event(user.id, "redirect_no_chat")
+
+    async def _redirect_target(self, user: models.User) -> Optional[str]:
         # TODO: This horrible redirect mess is what I get for not thinking about this
         #  more—seems like a bad approach
 
@@ -347,11 +492,11 @@ class WaitingRoomSocketSession(SocketSession):
 
         # If user is UNMATCHED, the user is right to be in the waiting room, so don't
         # redirect
-        if not self._user.chatroom:
+        if not user.chatroom:
             return None
 
         # If user HAS matched, but HASN'T submitted a view, redirect to view
-        if not self._user.view:
+        if not user.view:
             return "view"
 
         partner = await self._partner()
@@ -367,9 +512,9 @@ class WaitingRoomSocketSession(SocketSession):
             return "waiting"
 
         # Redirect to tutorial if they haven't seen it—this won't happen twice
-        if self._user.needs_tutorial:
+        if user.needs_tutorial:
             async with access.commit_after():
-                self._user.seen_tutorial = True
+                user.seen_tutorial = True
             logger.debug(
                 format_parameterized_log_message(
                     "User is redirecting to tutorial, setting seen_tutorial to True"
@@ -415,7 +560,107 @@ class WaitingRoomSocketSession(SocketSession):
         await self._sio.emit("partner_status", status, partner.waiting_session_id)
 
 
-# noinspection PyProtectedMember
-socket_manager._sio.register_namespace(
-    SessionSocketAsyncNamespace(WaitingRoomSocketSession, SOCKET_NAMESPACE_WAITING_ROOM)
+class WaitingRoomWatcher:
+    """
+    Looks after the users waiting in this process: times them out after
+    WAITING_ROOM_TIMEOUT, and retries matching them when a match they were caught up
+    in fails. Notifications from every worker (see notifications.py) make this
+    immediate, but the session methods it runs check the database themselves, so a
+    missed notification only leaves a user waiting the way they would without it.
+    """
+
+    def __init__(self, namespace: SessionSocketAsyncNamespace):
+        self._namespace = namespace
+        self._timeouts: Dict[int, asyncio.Task] = {}
+        # Positions of users whose last match attempt was stalled by another one
+        self._stalled: Dict[int, UserPosition] = {}
+
+    def subscribe(self, bus: NotificationBus) -> None:
+        bus.subscribe("join", self._on_join)
+        bus.subscribe("leave", self._on_leave)
+        bus.subscribe("match", self._on_match)
+        bus.subscribe("match_conflict", self._on_match_conflict)
+
+    def waiting(self, user_id: int, started_waiting_time: datetime) -> None:
+        """
+        Time out a user who's connected to this process.
+        """
+        self._cancel_timeout(user_id)
+        delay = (
+            started_waiting_time
+            + timedelta(seconds=WAITING_ROOM_TIMEOUT)
+            - datetime.now()
+        ).total_seconds()
+        self._schedule_timeout(user_id, max(delay, 0))
+
+    def stalled(self, user_id: int, position: UserPosition) -> None:
+        """
+        Retry matching a user who's connected to this process when the next user of
+        the other position joins.
+        """
+        self._stalled[user_id] = position
+
+    async def _on_join(self, data: Dict[str, Any]) -> None:
+        position = UserPosition(data["position"])
+        for user_id, stalled_position in list(self._stalled.items()):
+            if stalled_position != position:
+                del self._stalled[user_id]
+                await self._namespace.run_for_user(
+                    user_id, "rematch", WaitingRoomSocketSession.rematch
+                )
+
+    async def _on_leave(self, data: Dict[str, Any]) -> None:
+        # Users can leave one connection after opening another
+        if not self._namespace.has_user(data["user_id"]):
+            self._forget(data["user_id"])
+
+    async def _on_match(self, data: Dict[str, Any]) -> None:
+        for user_id in data["user_ids"]:
+            self._forget(user_id)
+
+    async def _on_match_conflict(self, data: Dict[str, Any]) -> None:
+        for user_id in data["user_ids"]:
+            self._stalled.pop(user_id, None)
+            await self._namespace.run_for_user(
+                user_id, "rematch", WaitingRoomSocketSession.rematch
+            )
+
+    def _schedule_timeout(self, user_id: int, delay: float) -> None:
+        self._timeouts[user_id] = asyncio.get_running_loop().create_task(
+            self._time_out(user_id, delay)
+        )
+
+    async def _time_out(self, user_id: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        del self._timeouts[user_id]
+        try:
+            await self._namespace.run_for_user(
+                user_id, "time_out", WaitingRoomSocketSession.time_out
+            )
+        except Exception:
+            logger.exception(
+                format_parameterized_log_message(
+                    "Error timing out user in waiting room", user_id=user_id
+                )
+            )
+            # Try again while they're still connected here, unless they've been
+            # rescheduled in the meantime
+            if self._namespace.has_user(user_id) and user_id not in self._timeouts:
+                self._schedule_timeout(user_id, WAITING_ROOM_TIMEOUT_RETRY_DELAY)
+
+    def _forget(self, user_id: int) -> None:
+        self._cancel_timeout(user_id)
+        self._stalled.pop(user_id, None)
+
+    def _cancel_timeout(self, user_id: int) -> None:
+        if (task := self._timeouts.pop(user_id, None)) is not None:
+            task.cancel()
+
+
+waiting_room_namespace = SessionSocketAsyncNamespace(
+    WaitingRoomSocketSession, SOCKET_NAMESPACE_WAITING_ROOM
 )
+# noinspection PyProtectedMember
+socket_manager._sio.register_namespace(waiting_room_namespace)
+waiting_room_watcher = WaitingRoomWatcher(waiting_room_namespace)
+waiting_room_watcher.subscribe(notifications)
@@ -1,30 +1,38 @@
 import asyncio
 import os
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timedelta
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from os import path
-from typing import Dict
+from typing import Dict, Optional
 
-import socketio_util
+import socketio
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.requests import Request
 from fastapi.responses import RedirectResponse
 from fastapi.security import APIKeyHeader
-from fastapi_async_sqlalchemy import SQLAlchemyMiddleware, db
 from fastapi_socketio import SocketManager
+from sqlalchemy.ext.asyncio import create_async_engine
 from starlette.middleware.sessions import SessionMiddleware
 
-from .constants import SOCKET_NAMESPACE_WAITING_ROOM, WAITING_ROOM_TIMEOUT
+from .auth_tokens import auth_tokens
 from .data import models
-from .data.crud import access
+from .data.crud import UserIdentity, access
+from .data.pool import PoolSettings
+from .data.sqlite import create_sqlite_engines, is_sqlite_file
 
 # from .data.database import SessionLocal, engine
-from .data.template import TemplateManager, load_templates_from_directory
+from .data.template import TemplateManager
+from .data.template_bundle import load_templates_from_bundle
+from .data.template_watcher import HostTemplateWatcher
 from .exceptions import AuthException
 from .logger import format_parameterized_log_message, logger
-from .socketio_util import RouteIgnoringMiddlewareWrapper, get_all_socketio_sessions
+from .middleware import DatabaseSessionMiddleware
+from .notifications import (
+    NotificationBus,
+    PostgresNotificationBus,
+    RedisNotificationBus,
+)
 
 load_dotenv(path.join(path.dirname(__file__), ".env"))
 
@@ -35,7 +43,56 @@ app.add_middleware(
     SessionMiddleware, secret_key=os.getenv("SECRET_KEY") or "default-secret"
 )
 
-SQLALCHEMY_DATABASE_URL = os.getenv("DB_URI") or "sqlite:///"
+# In memory by default. Set this to an SQLite file for the SQLite mode in
+# data/sqlite.py.
+SQLALCHEMY_DATABASE_URL = os.getenv("DB_URI") or "sqlite+aiosqlite:///"
+# Optional read replica for reads that can lag behind (see DataAccess.read_only)
+SQLALCHEMY_REPLICA_DATABASE_URL = os.getenv("DB_REPLICA_URI")
+
+# Each worker sizes its pool so all of them together stay within the connection
+# budget (see data/pool.py)
+pool_settings = PoolSettings.from_env()
+logger.info(
+    format_parameterized_log_message(
+        "Database pool settings",
+        pool_size=pool_settings.pool_size,
+        max_overflow=pool_settings.max_overflow,
+        timeout=pool_settings.timeout,
+        pre_ping=pool_settings.pre_ping,
+        recycle=pool_settings.recycle,
+    )
+)
+
+session_args = {"autoflush": False, "autocommit": False}
+# Echo
+# engine = create_async_engine(..., echo=True)
+if is_sqlite_file(SQLALCHEMY_DATABASE_URL):
+    # Reads go to engine and writes to writer_engine, one transaction at a time (see
+    # data/sqlite.py)
+    sqlite_engines = create_sqlite_engines(SQLALCHEMY_DATABASE_URL, pool_settings)
+    engine, writer_engine = sqlite_engines.reader, sqlite_engines.writer
+    session_args.update(sqlite_engines.session_args)
+else:
+    engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL, **pool_settings.engine_args(SQLALCHEMY_DATABASE_URL)
+    )
+    writer_engine = None
+replica_engine = None
+
+app.add_middleware(
+    DatabaseSessionMiddleware,
+    # Socket events open their own sessions
+    ignore_prefixes=["/ws/"],
+    custom_engine=engine,
+    session_args=session_args,
+)
+
+if SQLALCHEMY_REPLICA_DATABASE_URL:
+    replica_engine = create_async_engine(
+        SQLALCHEMY_REPLICA_DATABASE_URL,
+        **pool_settings.engine_args(SQLALCHEMY_REPLICA_DATABASE_URL),
+    )
+    access.use_replica(replica_engine)
 
 app.add_middleware(
     CORSMiddleware,
@@ -45,106 +102,93 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Socket.IO's message queue and cached transcript changes go through this server
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
 socket_manager = SocketManager(
-    app=app, cors_allowed_origins=[], client_manager=socketio.AsyncRedisManager()
+    app=app,
+    cors_allowed_origins=[],
+    client_manager=socketio.AsyncRedisManager(REDIS_URL),
 )
 
-templates = load_templates_from_directory(os.getenv("TEMPLATES_DIR"))
+TEMPLATES_DIR = os.getenv("TEMPLATES_DIR")
+# Precompiled templates built by run.sh and signed with SECRET_KEY (see
+# data/template_bundle.py). Defaults to a file in TEMPLATES_DIR.
+TEMPLATES_BUNDLE = os.getenv("TEMPLATES_BUNDLE")
+# Reload templates when they change unless TEMPLATES_RELOAD is set to 0. One worker
+# per host watches the directory and shares what it reloads with the others through
+# the bundle (see data/template_watcher.py).
+TEMPLATES_RELOAD = os.getenv("TEMPLATES_RELOAD", "1") != "0"
+
+templates = load_templates_from_bundle(
+    TEMPLATES_DIR, TEMPLATES_BUNDLE, os.getenv("SECRET_KEY")
+)
+
+# Waiting room events reach every worker through Postgres LISTEN/NOTIFY if
+# DB_NOTIFICATIONS is set to 1, and only this worker otherwise (see notifications.py)
+notifications = (
+    PostgresNotificationBus(SQLALCHEMY_DATABASE_URL)
+    if os.getenv("DB_NOTIFICATIONS") == "1"
+    else NotificationBus()
+)
+# Workers tell each other to drop cached transcripts they've changed
+transcript_notifications = RedisNotificationBus(
+    REDIS_URL, channel="depolarizing_chatroom_transcripts"
+)
+access.share_transcript_changes(transcript_notifications)
 executor = None
+# Process pool for rendering prompts, so renders for many simultaneous rephrasings
+# aren't all competing for this process's GIL. Set TEMPLATE_RENDER_PROCESSES to enable.
+render_executor = None
 
 
 _API_KEY_NAME = "X-AUTH-CODE"
 _api_key_header = APIKeyHeader(name=_API_KEY_NAME, auto_error=False)
 
 
-async def waiting_room_timeout_loop() -> None:
-    # noinspection PyProtectedMember
-    sio = socket_manager._sio
-    while True:
-        async with db():
-            try:
-                socketio_sessions = await get_all_socketio_sessions(
-                    sio, SOCKET_NAMESPACE_WAITING_ROOM
-                )
-                # Get ids
-                ids = [s["id"] for s in socketio_sessions.values() if "id" in s]
-                # Get users in waiting room
-                users = await access.users_in_waiting_room(
-                    filter_ids=ids, matched=False
-                )
-                for user in users:
-                    # Redirect to no-chat post-chat survey if user is:
-                    try:
-                        if (
-                            # - in a waiting room
-                            user.waiting_session_id
-                            # - unmatched
-                            and user.chatroom_id is None
-                            # - for more than WAITING_ROOM_TIMEOUT minutes
-                            and user.started_waiting_time
-                            and user.started_waiting_time
-                            + timedelta(seconds=WAITING_ROOM_TIMEOUT)
-                            < datetime.now()
-                        ):
-                            logger.warning(
-                                format_parameterized_log_message(
-                                    "User timed out in waiting room, redirecting to "
-                                    "post-chat survey",
-                                    user_id=user.id,
-                                )
-                            )
-                            await sio.emit(
-                                "redirect",
-                                {"url": user.no_chat_url},
-                                to=user.waiting_session_id,
-                                namespace=SOCKET_NAMESPACE_WAITING_ROOM,
-                            )
-                            async with access.commit_after():
-                                access.save_event(user.id, "redirect_no_chat")
-                    except Exception:
-                        logger.exception(
-                            format_parameterized_log_message(
-                                "Error while checking user in waiting room timeout",
-                                user_id=user.id if hasattr(user, "id") else None,
-                            )
-                        )
-                await asyncio.sleep(1)
-            except Exception:
-                # We can't have this loop fail
-                logger.exception("Error in waiting room timeout loop")
-
-
 @app.on_event("startup")
 async def startup_event() -> None:
     # TODO: This should be moved to a contextvar
-    global executor
-    app.add_middleware(
-        RouteIgnoringMiddlewareWrapper,
-        wrapped_middleware_class=SQLAlchemyMiddleware,
-        ignore_routes=["/ws/"],
-        db_url=SQLALCHEMY_DATABASE_URL,
-        # Echo
-        # engine_args={"echo": True},
-        # By default we get 100 connections from Postgres, so keep the max overflow low
-        engine_args={"max_overflow": 4},
-        session_args={"autoflush": False, "autocommit": False},
-    )
+    global executor, render_executor
     executor = ThreadPoolExecutor()
-    asyncio.get_running_loop().create_task(waiting_room_timeout_loop())
+    if render_processes := os.getenv("TEMPLATE_RENDER_PROCESSES"):
+        render_executor = ProcessPoolExecutor(max_workers=int(render_processes))
+    asyncio.get_running_loop().create_task(notifications.run())
+    asyncio.get_running_loop().create_task(transcript_notifications.run())
+    if TEMPLATES_RELOAD:
+        asyncio.get_running_loop().create_task(
+            HostTemplateWatcher(
+                TEMPLATES_DIR,
+                set_templates,
+                os.getenv("SECRET_KEY"),
+                bundle_path=TEMPLATES_BUNDLE,
+            ).run()
+        )
 
 
 def get_templates() -> Dict[str, TemplateManager]:
     return templates
 
 
+def set_templates(new_templates: Dict[str, TemplateManager]) -> None:
+    # Swap in a whole new dict rather than updating the current one so that anything
+    # that already called get_templates() keeps a consistent set of templates
+    global templates
+    templates = new_templates
+
+
+def get_render_executor() -> Optional[Executor]:
+    return render_executor
+
+
 def very_insecure_session_auth_we_know_the_risks(request: Request):
     if not request.session.get("user"):
         raise AuthException()
 
 
-async def get_user_from_auth_code(
+async def get_user_identity_from_auth_code(
     header_key: str = Depends(_api_key_header),
-) -> models.User:
+) -> UserIdentity:
     """
     Based on the example at
     https://fastapi.tiangolo.com/advanced/security/http-basic-auth/#check-the-username
@@ -156,13 +200,30 @@ async def get_user_from_auth_code(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated"
         )
 
-    async with access.commit_after():
-        user = await access.user_by_response_id(header_key)
-    if user is None:
+    # Clients that logged in before we issued tokens may still send raw response IDs
+    identity = auth_tokens.verify(header_key)
+    if identity is None and auth_tokens.accepts_response_ids():
+        identity = await access.user_identity(header_key)
+    if identity is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated"
         )
 
+    return identity
+
+
+async def get_user_from_auth_code(
+    identity: UserIdentity = Depends(get_user_identity_from_auth_code),
+) -> models.User:
+    """
+    The authenticated user, without any relationships loaded. Routes that need those
+    should use get_user_identity_from_auth_code and load the user themselves.
+    """
+    user = await access.user(identity.id, select_chatroom=False, select_messages=False)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated"
+        )
     return user
 
 
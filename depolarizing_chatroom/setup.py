@@ -1,6 +1,6 @@
 import asyncio
 
-from .data.crud import build_prod_database
+from .data.crud import build_prod_database, migrate_database
 
 if __name__ == "__main__":
     import argparse
@@ -11,6 +11,14 @@ if __name__ == "__main__":
         action="store_true",
         help="Force rebuild of production database",
     )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Add missing tables, columns and indexes to an existing database",
+    )
     args = parser.parse_args()
 
-    asyncio.run(build_prod_database(args.force))
+    if args.migrate:
+        asyncio.run(migrate_database())
+    else:
+        asyncio.run(build_prod_database(args.force))
@@ -1,42 +1,33 @@
-from typing import Any, Callable, Dict, List, Optional, Type
+import inspect
+from typing import Any, Callable, Dict, Optional, Type
 
-# TODO: Rename this file to socketio_util
-import socketio_util
+import socketio
 from fastapi_async_sqlalchemy import db
-from socketio_util import AsyncNamespace
-from starlette.middleware.base import BaseHTTPMiddleware
+from socketio import AsyncNamespace
 
+from .auth_tokens import auth_tokens
 from .data import models
-from .data.crud import access
+from .data.crud import UnitOfWork, access
+from .data.query_stats import query_scope
+from .data.snapshots import ChatroomSnapshot, UserSnapshot
 from .logger import format_parameterized_log_message, logger
 
 
-class RouteIgnoringMiddlewareWrapper(BaseHTTPMiddleware):
-    def __init__(
-        self,
-        app,
-        wrapped_middleware_class: Type[BaseHTTPMiddleware],
-        *,
-        ignore_routes: List[str],
-        **kwargs,
-    ):
-        super().__init__(app)
-        self._middleware = wrapped_middleware_class(app, **kwargs)
-        self._ignore_routes = ignore_routes
-
-    async def dispatch(self, request, call_next):
-        if any(request.url.path.startswith(route) for route in self._ignore_routes):
-            return await call_next(request)
-        return await self._middleware.dispatch(request, call_next)
-
-
 async def check_socket_auth(auth: Dict[Any, str]) -> Optional[models.User]:
     try:
-        response_id = auth["token"]
+        token = auth["token"]
     except KeyError:
         return
 
-    return await access.user_by_response_id(response_id)
+    # Signed tokens are checked without a query. Clients that logged in before we
+    # issued tokens may still send raw response IDs.
+    identity = auth_tokens.verify(token)
+    if identity is None and auth_tokens.accepts_response_ids():
+        identity = await access.user_identity(token)
+    if identity is None:
+        return None
+    # Socket sessions use the user's chatroom but never their messages
+    return await access.user(identity.id, select_messages=False)
 
 
 async def get_socket_session_user(session: Dict[str, Any]) -> Optional[models.User]:
@@ -48,89 +39,103 @@ async def get_socket_session_user(session: Dict[str, Any]) -> Optional[models.Us
     return await access.user(response_id)
 
 
-async def get_all_socketio_sessions(
-    server: socketio.AsyncServer, namespace: str
-) -> Dict[str, Dict[str, Any]]:
-    try:
-        return {
-            sid: (await server.eio.get_session(sid))[namespace]
-            for sid in server.manager.rooms[namespace][None].values()
-        }
-    except KeyError:
-        return {}
-
-
 class SocketSession:
+    """
+    State for one socket connection. A session is created when its connection
+    connects and lives until it disconnects, and only holds detached snapshots of
+    database state. Handlers that need current state have to refresh it.
+    """
+
     def __init__(
         self,
         session_id: str,
         auth: Dict[str, Any],
-        user: models.User,
+        user: UserSnapshot,
+        chatroom: Optional[ChatroomSnapshot],
         sio: socketio.AsyncNamespace,
     ):
         self._session_id = session_id
         self._auth = auth
         self._user = user
+        self._chatroom = chatroom
         self._sio = sio
 
+    @property
+    def user_id(self) -> int:
+        return self._user.id
+
 
 class SessionSocketAsyncNamespace(AsyncNamespace):
+    """
+    Dispatches events to the SocketSession of the connection that sent them. Each
+    on_<event> coroutine method of the session class handles <event>, in its own
+    database session and unit of work (see DataAccess.unit_of_work).
+    """
+
     def __init__(self, session_class: Type[SocketSession], namespace: str):
         super().__init__(namespace)
         self._session_class = session_class
+        # Live sessions in this process, by socket session ID
+        self._sessions: Dict[str, SocketSession] = {}
+        self._handlers: Dict[str, Callable] = {
+            name[len("on_") :]: handler
+            for name, handler in inspect.getmembers(
+                session_class, inspect.iscoroutinefunction
+            )
+            if name.startswith("on_") and name != "on_connect"
+        }
 
-    def __getattr__(self, name, default=None) -> Callable:
-        if not name.startswith("on_") or not hasattr(self._session_class, name):
-            return getattr(super(), name, default)
-
-        return self._make_handler(name)
-
-    def _make_handler(self, name) -> Callable:
-        async def handler(session_id, *args, **kwargs) -> None:
-            async with db():
-                # TODO: Unclear that we need this?
-                session = await self.get_session(session_id)
-                if not session:
-                    logger.warning(
-                        format_parameterized_log_message(
-                            "Received message from unknown session",
-                            session_id=session_id,
-                        )
-                    )
-                    return
-                if (response_id := session.get("id")) is None:
-                    logger.warning(
-                        format_parameterized_log_message(
-                            "Received message from session without user response id",
-                            session_id=session_id,
-                        )
-                    )
-                    return
-                if (user := await access.user(session["id"])) is None:
-                    logger.warning(
-                        format_parameterized_log_message(
-                            "Received message from session with an invalid user id",
-                            session_id=session_id,
-                            # It could be a security issue to print things like this,
-                            # but we'd have bigger problems if someone really wanted to
-                            # hack us.
-                            user_id=response_id,
-                        )
-                    )
-                    return
-                if (auth := session.get("auth")) is None:
-                    logger.warning(
-                        format_parameterized_log_message(
-                            "Received message from session without auth",
-                            session_id=session_id,
-                        )
-                    )
-                    return
-
-                session = self._session_class(session_id, auth, user, self)
-                return await getattr(session, name)(*args, **kwargs)
-
-        return handler
+    async def trigger_event(self, event, *args) -> Any:
+        if event == "connect":
+            with query_scope(f"{self.namespace} connect"):
+                return await self.on_connect(*args)
+        if (handler := self._handlers.get(event)) is None:
+            if event == "disconnect":
+                self._sessions.pop(args[0], None)
+            return None
+
+        session_id, *args = args
+        if event == "disconnect":
+            # Newer versions of python-socketio pass a reason, which we don't use
+            args = []
+            session = self._sessions.pop(session_id, None)
+        else:
+            session = self._sessions.get(session_id)
+        if session is None:
+            logger.warning(
+                format_parameterized_log_message(
+                    "Received message from unknown session",
+                    session_id=session_id,
+                    event=event,
+                )
+            )
+            return None
+
+        return await self._run_handler(event, session_id, session, handler, *args)
+
+    async def run_for_user(self, user_id: int, event: str, handler: Callable) -> None:
+        """
+        Run handler, a method of the session class, for each of the user's connections
+        to this process, the same way as a handler for an event they sent.
+        """
+        for session_id, session in list(self._sessions.items()):
+            if session.user_id == user_id:
+                await self._run_handler(event, session_id, session, handler)
+
+    def has_user(self, user_id: int) -> bool:
+        """
+        Whether the user is connected to this process.
+        """
+        return any(session.user_id == user_id for session in self._sessions.values())
+
+    async def _run_handler(
+        self, event: str, session_id: str, session: SocketSession, handler, *args
+    ) -> Any:
+        with query_scope(f"{self.namespace} {event}"):
+            async with db(), access.unit_of_work() as unit:
+                result = await handler(session, *args)
+        self._log_commits(event, session_id, unit)
+        return result
 
     async def on_connect(self, session_id, _environ, auth) -> False:
         if (response_id := auth.get("token")) is None:
@@ -142,8 +147,8 @@ class SessionSocketAsyncNamespace(AsyncNamespace):
             )
             return False
 
-        async with db():
-            if not (user := await access.user_by_response_id(response_id)):
+        async with db(), access.unit_of_work() as unit:
+            if not (user := await check_socket_auth(auth)):
                 logger.warning(
                     format_parameterized_log_message(
                         "Received message from session with an invalid user id",
@@ -155,8 +160,29 @@ class SessionSocketAsyncNamespace(AsyncNamespace):
                     )
                 )
                 return False
+            # Other processes find out who's connected from here
             await self.save_session(session_id, {"id": user.id, "auth": auth})
-            session = self._session_class(session_id, auth, user, self)
+            session = self._session_class(
+                session_id,
+                auth,
+                UserSnapshot.of(user),
+                ChatroomSnapshot.of(user.chatroom) if user.chatroom else None,
+                self,
+            )
 
             if hasattr(session, "on_connect"):
-                return await session.on_connect()
+                if await session.on_connect() is False:
+                    return False
+            self._sessions[session_id] = session
+        self._log_commits("connect", session_id, unit)
+
+    @staticmethod
+    def _log_commits(event: str, session_id: str, unit: UnitOfWork) -> None:
+        logger.debug(
+            format_parameterized_log_message(
+                "Handled socket event",
+                event=event,
+                session_id=session_id,
+                commits=unit.commits,
+            )
+        )
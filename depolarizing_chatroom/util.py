@@ -5,6 +5,7 @@ from .constants import MIN_COUNTED_MESSAGE_WORD_COUNT
 
 class Message(TypedDict):
     body: str
+    word_count: int
     position: str
     rephrased: bool
 
@@ -30,7 +31,7 @@ def calculate_turns(
             turn_has_counted_message = False
             last_message_position = message_position
         if not turn_has_counted_message and (
-            len(message["body"].split()) >= MIN_COUNTED_MESSAGE_WORD_COUNT
+            message["word_count"] >= MIN_COUNTED_MESSAGE_WORD_COUNT
             # Also count a message as part of a turn if it was the result of a
             # rephrasing, regardless of whether it was the original message or a
             # rephrasing, because it means that the user recieved a rephrasing
@@ -61,8 +62,7 @@ def last_n_turns(
         if counted_turn_count >= n:
             break
         if any(
-            len(message["body"].split()) >= MIN_COUNTED_MESSAGE_WORD_COUNT
-            for message in turn
+            message["word_count"] >= MIN_COUNTED_MESSAGE_WORD_COUNT for message in turn
         ):
             counted_turn_count += 1
         n_turns.append(turn)
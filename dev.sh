@@ -0,0 +1,10 @@
+# Development server: a single worker that reloads code when it changes (templates
+# reload everywhere). Needs the same environment as run.sh.
+source ./venv/bin/activate
+TEMPLATES_DIR=./templates \
+PYTHONUNBUFFERED=TRUE \
+python3 -muvicorn \
+--port ${1:-8000} \
+--reload \
+--log-config uvicorn-log-config.yml \
+depolarizing_chatroom.server:app
@@ -3,12 +3,21 @@
 # - NO_CHAT_URL
 # - POST_CHAT_URL
 # These are provided in run-all.sh. Ask @vinhowe if you need help with these.
+# Before rolling out auth tokens, set ACCEPT_RESPONSE_IDS_UNTIL to a fixed date a
+# couple of days out: clients that logged in earlier still send raw response IDs,
+# which are otherwise only accepted for two days after each (re)start.
 source ./venv/bin/activate
+# Precompile templates so workers don't each have to parse them at startup. Workers
+# only read the bundle if it's signed with their SECRET_KEY. While running, one
+# worker rewrites it whenever templates change, and the others reload from it.
+python3 -m depolarizing_chatroom.data.template_bundle ./templates
+# gunicorn starts WEB_CONCURRENCY workers, and database pools are sized by it too
+# (see data/pool.py)
 TEMPLATES_DIR=./templates \
 PYTHONUNBUFFERED=TRUE \
+WEB_CONCURRENCY=${WORKERS:-1} \
 python3 -mgunicorn \
 --bind 0.0.0.0:$1 \
 --worker-class uvicorn.workers.UvicornWorker \
 --log-config gunicorn-log-config.conf \
--w 1 \
 depolarizing_chatroom.server:app
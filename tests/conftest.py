@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+import pytest_asyncio
+from fastapi_async_sqlalchemy import SQLAlchemyMiddleware, db
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from depolarizing_chatroom.data import models
+from depolarizing_chatroom.data.crud import access, create_missing_schema
+from depolarizing_chatroom.data.models import UserPosition
+
+
+@pytest_asyncio.fixture(name="engine")
+async def fixture_engine(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+    async with engine.begin() as connection:
+        await connection.run_sync(create_missing_schema)
+    SQLAlchemyMiddleware(None, custom_engine=engine)
+
+    start = datetime(2022, 10, 1)
+    async with db():
+        for i in range(200):
+            chatroom = None
+            if i % 4 == 3:
+                chatroom = access.create_chatroom()
+            access.add(
+                user := models.User(
+                    response_id=f"response-{i}",
+                    position=list(UserPosition)[i % 2],
+                    waiting_session_id=f"waiting-{i}" if i % 4 else None,
+                    started_waiting_time=start + timedelta(seconds=i),
+                    found_match_time=start if i % 4 > 1 else None,
+                    chatroom=chatroom,
+                    chatroom_session_id=f"chatroom-{i}" if chatroom else None,
+                )
+            )
+            await access.session.flush()
+            access.save_event(user.id, "join", time=start + timedelta(seconds=i))
+            if chatroom:
+                message = await access.add_message(chatroom.id, user.id, "Hello")
+                await access.session.flush()
+                access.add_rephrasing(message.id, "Hi", "polite")
+        await access.session.commit()
+
+    yield engine
+    await engine.dispose()
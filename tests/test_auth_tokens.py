@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta, timezone
+
+from depolarizing_chatroom.auth_tokens import (
+    AuthTokenService,
+    response_ids_accepted_until_from_env,
+)
+from depolarizing_chatroom.data.crud import UserIdentity
+from depolarizing_chatroom.data.models import UserPosition
+
+
+def test_tokens_survive_key_rotation() -> None:
+    identity = UserIdentity(7, UserPosition.SUPPORT)
+    old_token = AuthTokenService(["old"], max_age=60).issue(identity)
+
+    rotated = AuthTokenService(["old", "new"], max_age=60)
+    assert rotated.verify(old_token) == identity
+    assert rotated.verify(rotated.issue(identity)) == identity
+    # Tokens are only accepted while their key is
+    assert AuthTokenService(["new"], max_age=60).verify(old_token) is None
+
+
+def test_invalid_tokens_are_rejected() -> None:
+    service = AuthTokenService(["secret"], max_age=60)
+    token = service.issue(UserIdentity(7, UserPosition.OPPOSE))
+
+    # The last characters of the signature can include padding bits, so tamper with
+    # the payload instead
+    assert service.verify(("B" if token[0] != "B" else "C") + token[1:]) is None
+    # Raw response IDs from clients that logged in before tokens
+    assert service.verify("R_1234567890") is None
+
+    # Expired (timestamps are in whole seconds, so this expires immediately)
+    assert AuthTokenService(["secret"], max_age=-1).verify(token) is None
+
+
+def test_response_ids_are_only_accepted_until_the_deadline() -> None:
+    now = datetime.now(timezone.utc)
+    assert not AuthTokenService(["secret"], max_age=60).accepts_response_ids()
+    assert AuthTokenService(
+        ["secret"], max_age=60, response_ids_accepted_until=now + timedelta(days=1)
+    ).accepts_response_ids()
+    assert not AuthTokenService(
+        ["secret"], max_age=60, response_ids_accepted_until=now - timedelta(days=1)
+    ).accepts_response_ids()
+
+
+def test_response_ids_are_accepted_for_a_grace_period_by_default(monkeypatch) -> None:
+    monkeypatch.delenv("ACCEPT_RESPONSE_IDS_UNTIL", raising=False)
+    until = response_ids_accepted_until_from_env()
+    assert until > datetime.now(timezone.utc) + timedelta(days=1)
+
+    monkeypatch.setenv("ACCEPT_RESPONSE_IDS_UNTIL", "2023-01-01")
+    assert response_ids_accepted_until_from_env() == datetime(
+        2023, 1, 1, tzinfo=timezone.utc
+    )
@@ -183,12 +183,12 @@ class TestUserPage(str, enum.Enum):
 
 
 async def post_signup(url, session, position) -> str:
-    token = uuid.uuid4().hex
     response = await session.post(
-        url + "signup", json={"respondentId": token, "position": position.value}
+        url + "signup",
+        json={"respondentId": uuid.uuid4().hex, "position": position.value},
     )
     assert response.status == 200
-    return token
+    return (await response.json())["token"]
 
 
 async def post_initial_view(url, session, token, view) -> None:
@@ -385,10 +385,11 @@ async def test_signup_user(single_mock_server, client_session) -> None:
         single_mock_server + "signup", json=signup_body
     ) as response:
         assert response.status == 200, "Signup failed"
+        token = (await response.json())["token"]
 
     # Test that user is seen in server 1
     async with client_session.get(
-        single_mock_server + "user", headers={"X-AUTH-CODE": respondent_id}
+        single_mock_server + "user", headers={"X-AUTH-CODE": token}
     ) as response:
         # Get response body
         response_body = await response.json()
@@ -421,11 +422,85 @@ async def test_signup_user(single_mock_server, client_session) -> None:
     async with client_session.put(
         single_mock_server + "user",
         json=leave_body,
-        headers={"X-AUTH-CODE": respondent_id},
+        headers={"X-AUTH-CODE": token},
     ) as response:
         assert response.status == 200, "Setting leave reason failed"
 
 
+@pytest.mark.asyncio
+async def test_users_joining_at_once_match_each_other(_mock_db, monkeypatch) -> None:
+    from fastapi_async_sqlalchemy import SQLAlchemyMiddleware, db
+    from sqlalchemy import select, update
+
+    from depolarizing_chatroom.auth_tokens import auth_tokens
+    from depolarizing_chatroom.data.crud import UserIdentity, access
+    from depolarizing_chatroom.routes.waiting_room import waiting_room_namespace
+
+    engine = create_async_engine(SQLALCHEMY_DATABASE_URL)
+    SQLAlchemyMiddleware(None, custom_engine=engine)
+
+    async def save_session(*_args, **_kwargs) -> None:
+        pass
+
+    async def emit(*_args, **_kwargs) -> None:
+        pass
+
+    monkeypatch.setattr(waiting_room_namespace, "save_session", save_session)
+    monkeypatch.setattr(waiting_room_namespace, "emit", emit)
+
+    # Both users claim each other before either locks themselves, so each finds
+    # themselves locked by the other
+    claim_user_to_match_with = access.claim_user_to_match_with
+    claims = 0
+    both_claimed = asyncio.Event()
+
+    async def claim_and_wait_for_both(user):
+        nonlocal claims
+        match_user = await claim_user_to_match_with(user)
+        claims += 1
+        if claims == 2:
+            both_claimed.set()
+        await asyncio.wait_for(both_claimed.wait(), 10)
+        return match_user
+
+    monkeypatch.setattr(access, "claim_user_to_match_with", claim_and_wait_for_both)
+
+    user_ids = []
+    tokens = []
+    async with db():
+        async with access.commit_after():
+            # Leave nobody from earlier tests to match with
+            await db.session.execute(
+                update(models.User)
+                .where(models.User.found_match_time.is_(None))
+                .values(waiting_session_id=None)
+            )
+            for position in models.UserPosition:
+                user = await access.process_signup(uuid.uuid4().hex, position)
+                await access.flush()
+                user_ids.append(user.id)
+                tokens.append(auth_tokens.issue(UserIdentity(user.id, position)))
+
+    await asyncio.gather(
+        *[
+            waiting_room_namespace.trigger_event(
+                "connect", uuid.uuid4().hex, {}, {"token": token, "page": "waiting"}
+            )
+            for token in tokens
+        ]
+    )
+
+    async with db():
+        chatroom_ids = (
+            await db.session.execute(
+                select(models.User.chatroom_id).where(models.User.id.in_(user_ids))
+            )
+        ).scalars()
+        chatroom_ids = set(chatroom_ids)
+    await engine.dispose()
+    assert len(chatroom_ids) == 1 and None not in chatroom_ids
+
+
 @pytest.mark.asyncio
 async def test_match_users(mock_servers, client_session) -> None:
     user_positions = [models.UserPosition.SUPPORT, models.UserPosition.OPPOSE] * (
@@ -0,0 +1,204 @@
+import pytest
+from fastapi_async_sqlalchemy import db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from depolarizing_chatroom.data import models
+from depolarizing_chatroom.data.crud import (
+    DataAccess,
+    UserIdentity,
+    UserIdentityCache,
+    backfill_final_bodies,
+    backfill_message_seqs,
+    create_missing_schema,
+)
+from depolarizing_chatroom.data.models import UserPosition
+
+
+@pytest.mark.asyncio
+async def test_read_only_blocks_skip_commits_and_reject_changes(engine) -> None:
+    access = DataAccess()
+    async with db():
+        async with access.read_only():
+            user = await access.user_by_response_id("response-7")
+        assert db.session.in_transaction()
+
+        async with access.read_only(replica=True):
+            # Without a replica, this is the same session
+            assert await access.user(user.id) is user
+
+        with pytest.raises(RuntimeError):
+            async with access.read_only():
+                user.view = "Changed"
+
+        async with access.commit_after():
+            pass
+
+    stats = access.transaction_stats()
+    assert (stats.commits, stats.commits_avoided) == (1, 2)
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_commits_once_unless_told_to(engine) -> None:
+    access = DataAccess()
+    async with db():
+        user = await access.user_by_response_id("response-7")
+        async with access.unit_of_work() as unit:
+            async with access.commit_after():
+                access.save_event(user.id, "typing")
+            async with access.commit_after():
+                await access.update_user(user.id, seen_tutorial=True)
+            message = await access.add_message(user.chatroom_id, user.id, "Hi")
+            await access.flush()
+            assert message.id is not None
+            assert unit.commits == 0
+        assert unit.commits == 1
+
+        async with access.unit_of_work() as unit:
+            await access.user(user.id)
+            access.save_event(user.id, "typing")
+            await access.commit()
+        assert unit.commits == 1
+
+        with pytest.raises(ValueError):
+            async with access.unit_of_work() as unit:
+                access.save_event(user.id, "typing")
+                raise ValueError
+        assert unit.commits == 0
+        await access.session.rollback()
+
+        # Nothing to commit
+        async with access.commit_after():
+            pass
+    assert access.transaction_stats().commits == 2
+
+
+@pytest.mark.asyncio
+async def test_migrating_adds_and_fills_in_message_columns(tmp_path) -> None:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+    try:
+        async with engine.begin() as connection:
+            # Messages as they were before final bodies and sequence numbers were
+            # stored
+            await connection.run_sync(models.Base.metadata.create_all)
+            await connection.exec_driver_sql("DROP INDEX ix_messages_chatroom_id_seq")
+            for column in ("final_body", "word_count", "has_rephrasings", "seq"):
+                await connection.exec_driver_sql(
+                    f"ALTER TABLE messages DROP COLUMN {column}"
+                )
+            await connection.exec_driver_sql(
+                "ALTER TABLE chatrooms DROP COLUMN message_seq"
+            )
+            await connection.exec_driver_sql("INSERT INTO chatrooms (id) VALUES (1)")
+            await connection.exec_driver_sql(
+                "INSERT INTO messages (id, chatroom_id, body, edited_body, send_time, "
+                "accepted_rephrasing_id) VALUES "
+                "(1, 1, 'Hello there', NULL, '2022-10-02', NULL), "
+                "(2, 1, 'Hi', 'Hi you all', '2022-10-01', NULL), "
+                "(3, 1, 'Go away', NULL, '2022-10-03', 1)"
+            )
+            await connection.exec_driver_sql(
+                "INSERT INTO rephrasings (id, message_id, body) VALUES "
+                "(1, 3, 'Please leave'), (2, 1, 'Hey')"
+            )
+
+            await connection.run_sync(create_missing_schema)
+            await connection.run_sync(backfill_final_bodies)
+            await connection.run_sync(backfill_message_seqs)
+            rows = await connection.execute(
+                select(
+                    models.Message.seq,
+                    models.Message.final_body,
+                    models.Message.word_count,
+                    models.Message.has_rephrasings,
+                ).order_by(models.Message.id)
+            )
+            assert rows.all() == [
+                (2, "Hello there", 2, True),
+                (1, "Hi you all", 3, False),
+                (3, "Please leave", 2, True),
+            ]
+            message_seq = await connection.execute(select(models.Chatroom.message_seq))
+            assert message_seq.scalar_one() == 3
+    finally:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_messages_are_numbered_per_chatroom(engine) -> None:
+    access = DataAccess()
+    async with db():
+        user = await access.user_by_response_id("response-7")
+        chatroom = await access.chatroom(user.chatroom_id)
+        async with access.commit_after():
+            for body in ("One", "Two", "Three"):
+                await access.add_message(chatroom.id, user.id, body)
+
+        messages = await access.chatroom_messages(chatroom)
+        # The first two can be swapped (Chatroom.swap_view_messages)
+        assert {message.seq for message in messages[:2]} == {1, 2}
+        assert [message.seq for message in messages[2:]] == [3, 4]
+        missed = await access.chatroom_messages(chatroom, after_seq=2)
+        assert [message.final_body for message in missed] == ["Two", "Three"]
+
+
+@pytest.mark.asyncio
+async def test_reconnects_get_messages_held_back_for_rephrasing(engine) -> None:
+    access = DataAccess()
+    async with db():
+        user = await access.user_by_response_id("response-7")
+        chatroom = await access.chatroom(user.chatroom_id)
+        async with access.commit_after():
+            await access.add_message(chatroom.id, user.id, "View")
+            held = await access.add_message(chatroom.id, user.id, "You're all wrong")
+            await access.flush()
+            access.add_rephrasing(held.id, "I see it differently", "polite")
+            access.mark_rephrased(held)
+        # Sent and shown while the held back message waits for its sender
+        async with access.commit_after():
+            await access.add_message(chatroom.id, user.id, "Anyone there?")
+
+        # A client that saw everything but the held back message has seen every
+        # message up to the one before it
+        missed = await access.chatroom_transcript(chatroom, after_seq=held.seq - 1)
+        assert [message.seq for message in missed] == [held.seq, held.seq + 1]
+
+        async with access.commit_after():
+            access.set_final_body(held, "I see it differently")
+        missed = await access.chatroom_transcript(chatroom, after_seq=held.seq - 1)
+        assert missed[0].body == "I see it differently"
+
+
+@pytest.mark.asyncio
+async def test_users_are_only_updated_if_they_meet_the_conditions(engine) -> None:
+    access = DataAccess()
+    async with db():
+        user = await access.user_by_response_id("response-7")
+        async with access.commit_after():
+            # Reconnecting before the old connection has disconnected
+            assert not await access.update_user(
+                user.id,
+                models.User.chatroom_session_id.is_(None),
+                chatroom_session_id="new",
+            )
+            assert await access.update_user(user.id, chatroom_session_id="new")
+            # The old connection disconnecting afterwards doesn't leave
+            assert not await access.update_user(
+                user.id,
+                models.User.chatroom_session_id == "chatroom-7",
+                chatroom_session_id=None,
+            )
+            assert await access.update_user(
+                user.id,
+                models.User.chatroom_session_id == "new",
+                chatroom_session_id=None,
+            )
+
+
+def test_user_identity_cache_is_bounded() -> None:
+    cache = UserIdentityCache(ttl=60, maxsize=2)
+    for user_id in range(3):
+        cache.set(f"R_{user_id}", UserIdentity(user_id, UserPosition.SUPPORT))
+
+    assert cache.get("R_0") is None
+    assert cache.get("R_2") == UserIdentity(2, UserPosition.SUPPORT)
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from depolarizing_chatroom.data.crud import OnlineUserCounts
+from depolarizing_chatroom.data.models import UserPosition
+from depolarizing_chatroom.live_stats import (
+    IN_CHATROOM,
+    PRECHAT,
+    UNMATCHED,
+    LiveStats,
+)
+
+
+@pytest.mark.asyncio
+async def test_changes_are_coalesced_and_only_include_changed_counters() -> None:
+    published = []
+
+    async def publish(changes) -> None:
+        published.append(changes)
+
+    stats = LiveStats(max_updates_per_second=20, history_size=2)
+    stats.start(
+        publish,
+        {
+            UserPosition.SUPPORT: OnlineUserCounts(1, 0, 2),
+            UserPosition.OPPOSE: OnlineUserCounts(0, 0, 0),
+        },
+    )
+    await asyncio.sleep(0.01)
+    assert len(published) == 1
+
+    stats.adjust(UNMATCHED, UserPosition.OPPOSE, 1)
+    stats.move(UNMATCHED, PRECHAT, UserPosition.OPPOSE)
+    stats.move(UNMATCHED, PRECHAT, UserPosition.SUPPORT)
+    stats.adjust(IN_CHATROOM, UserPosition.SUPPORT, 1)
+    stats.adjust(IN_CHATROOM, UserPosition.SUPPORT, -1)
+    await asyncio.sleep(0.1)
+
+    assert published[1:] == [
+        {
+            "totalOnline": 4,
+            "unmatched": {"supporters": 0},
+            "prechat": {"supporters": 1, "opponents": 1},
+        }
+    ]
+    assert stats.stats()["unmatched"] == {"supporters": 0, "opponents": 0}
+    assert [sample["totalOnline"] for sample in stats.history()] == [3, 4]
+
+    stats.stop()
+    stats.adjust(UNMATCHED, UserPosition.OPPOSE, 1)
+    assert not stats.active
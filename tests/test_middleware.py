@@ -0,0 +1,49 @@
+import pytest
+from fastapi_async_sqlalchemy import db
+from fastapi_async_sqlalchemy.exceptions import MissingSessionError
+
+from depolarizing_chatroom.data.query_stats import query_stats
+from depolarizing_chatroom.middleware import (
+    UNMATCHED_ROUTE,
+    DatabaseSessionMiddleware,
+    PrefixTrie,
+)
+
+
+def test_prefix_trie_matches_prefixes() -> None:
+    trie = PrefixTrie(["/ws/", "/static", "/w"])
+    assert trie.matches("/ws/socket.io")
+    assert trie.matches("/static/app.js")
+    assert trie.matches("/waiting-status")
+    assert not trie.matches("/stats")
+    assert not trie.matches("")
+    assert PrefixTrie([""]).matches("/anything")
+    assert not PrefixTrie([]).matches("/anything")
+
+
+@pytest.mark.asyncio
+async def test_only_requests_outside_ignored_prefixes_get_sessions(engine) -> None:
+    sessions = {}
+
+    async def app(scope, _receive, send) -> None:
+        try:
+            sessions[scope["path"]] = db.session
+        except MissingSessionError:
+            sessions[scope["path"]] = None
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(_message) -> None:
+        pass
+
+    middleware = DatabaseSessionMiddleware(
+        app, ignore_prefixes=["/ws/"], custom_engine=engine
+    )
+    for path in ("/stats", "/ws/socket.io"):
+        await middleware({"type": "http", "path": path}, None, send)
+
+    assert sessions["/stats"] is not None
+    assert sessions["/ws/socket.io"] is None
+    # Paths that don't match a route are counted together
+    assert "/stats" not in query_stats.stats()
+    assert UNMATCHED_ROUTE in query_stats.stats()
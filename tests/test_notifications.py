@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from depolarizing_chatroom.notifications import NotificationBus
+
+
+@pytest.mark.asyncio
+async def test_published_events_reach_their_handlers() -> None:
+    bus = NotificationBus()
+    received = []
+
+    async def on_match(data) -> None:
+        received.append(data)
+
+    async def broken(_data) -> None:
+        raise RuntimeError
+
+    bus.subscribe("match", broken)
+    bus.subscribe("match", on_match)
+    await bus.publish("match", user_ids=[1, 2])
+    await bus.publish("leave", user_id=3)
+    # noinspection PyProtectedMember
+    await asyncio.gather(*bus._tasks)
+
+    # One handler failing doesn't stop the others
+    assert received == [{"user_ids": [1, 2]}]
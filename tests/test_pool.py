@@ -0,0 +1,52 @@
+import pytest
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from depolarizing_chatroom.data.pool import (
+    InstrumentedQueuePool,
+    PoolSettings,
+    pool_stats,
+)
+
+
+def test_pool_settings_split_the_connection_budget() -> None:
+    settings = PoolSettings.for_workers(4, 90)
+    assert (settings.pool_size, settings.max_overflow) == (18, 4)
+    assert 4 * (settings.pool_size + settings.max_overflow) <= 90
+
+    with pytest.raises(ValueError):
+        PoolSettings.for_workers(4, 3)
+
+    # Connections opened outside the pool, like for notifications, count too
+    settings = PoolSettings.for_workers(4, 90, extra_connections=1)
+    assert 4 * (settings.pool_size + settings.max_overflow + 1) <= 90
+    with pytest.raises(ValueError):
+        PoolSettings.for_workers(4, 4, extra_connections=1)
+
+
+@pytest.mark.asyncio
+async def test_pool_stats_count_checkouts_and_timeouts(tmp_path) -> None:
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'test.db'}",
+        poolclass=InstrumentedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.01,
+    )
+    try:
+        async with engine.connect():
+            stats = pool_stats(engine)
+            assert (stats.checked_out, stats.checkouts) == (1, 1)
+            with pytest.raises(exc.TimeoutError):
+                async with engine.connect():
+                    pass
+
+        stats = pool_stats(engine)
+        assert (stats.checked_out, stats.checkouts, stats.checkout_timeouts) == (
+            0,
+            2,
+            1,
+        )
+        assert stats.max_checkout_seconds >= 0.01
+    finally:
+        await engine.dispose()
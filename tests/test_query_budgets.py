@@ -0,0 +1,47 @@
+import pytest
+from fastapi_async_sqlalchemy import db
+
+from depolarizing_chatroom.data.crud import access
+from depolarizing_chatroom.data.query_stats import (
+    QueryBudgetExceededError,
+    query_budget,
+    query_scope,
+)
+from depolarizing_chatroom.socketio_util import (
+    SessionSocketAsyncNamespace,
+    SocketSession,
+)
+
+
+@pytest.mark.asyncio
+async def test_socket_connect_stays_within_query_budget(engine) -> None:
+    namespace = SessionSocketAsyncNamespace(SocketSession, "/test")
+
+    async def save_session(*_) -> None:
+        pass
+
+    namespace.save_session = save_session
+
+    # Look up the identity, then load the user and their chatroom
+    with query_budget(3, max_repeats=1):
+        await namespace.trigger_event("connect", "sid", {}, {"token": "response-3"})
+
+
+@pytest.mark.asyncio
+async def test_repeated_statements_are_flagged(engine) -> None:
+    async with db():
+        user = await access.user_by_response_id("response-7")
+        with query_budget(3):
+            await access.user(user.id)
+
+        with query_scope("messages", record=False) as scope:
+            for message in user.messages:
+                await access.message(message.id)
+            for id in range(1, 6):
+                await access.rephrasing(id)
+        assert list(scope.repeated_statements().values()) == [5]
+
+        with pytest.raises(QueryBudgetExceededError):
+            with query_budget(10, max_repeats=1):
+                for id in range(1, 3):
+                    await access.rephrasing(id)
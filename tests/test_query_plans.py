@@ -0,0 +1,66 @@
+import re
+
+import pytest
+from fastapi_async_sqlalchemy import db
+from sqlalchemy import event
+
+from depolarizing_chatroom.data.crud import access
+from depolarizing_chatroom.data.models import UserPosition
+
+# SQLite's EXPLAIN QUERY PLAN says "SCAN <table>" for a full table scan and "SCAN
+# <table> USING [COVERING] INDEX <index>" for a scan over an index
+SEQUENTIAL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+
+async def run_data_access_queries() -> None:
+    await access.user_identity("response-6")
+    user = await access.user_by_response_id("response-7")
+    await access.user(user.id)
+    await access.other_user_in_chatroom(user.chatroom_id, user.id)
+    await access.chatroom_messages(
+        user.chatroom, select_users=True, select_rephrasings=True
+    )
+    await access.chatroom_messages(user.chatroom, after_seq=1)
+    await access.message(user.messages[0].id)
+    await access.rephrasing(1)
+    for position in UserPosition:
+        await access.users_in_waiting_room(position=position, matched=False)
+        await access.users_in_waiting_room(position=position, matched=True)
+        await access.users_in_chatroom(position=position)
+    await access.users_in_waiting_room(filter_ids=[1, 2, 3], matched=False)
+    await access.online_user_counts()
+    await access.random_user_to_match_with(await access.user(2))
+    # SQLite leaves out FOR UPDATE SKIP LOCKED, but the rest of the queries are the same
+    await access.claim_user_to_match_with(await access.lock_user_to_match(2))
+    await access.is_waiting_to_match(2)
+
+
+@pytest.mark.asyncio
+async def test_data_access_queries_do_not_scan_tables(engine) -> None:
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record_statement)
+    async with db():
+        await run_data_access_queries()
+    event.remove(engine.sync_engine, "before_cursor_execute", record_statement)
+    assert statements
+
+    scans = []
+    async with engine.connect() as connection:
+        for statement, parameters in statements:
+            plan = await connection.exec_driver_sql(
+                "EXPLAIN QUERY PLAN " + statement, parameters
+            )
+            scans.extend(
+                (match.group(1), statement)
+                for *_, detail in plan
+                if (match := SEQUENTIAL_SCAN.match(detail))
+            )
+
+    assert not scans, "Sequential scans:\n" + "\n\n".join(
+        f"{table}: {statement}" for table, statement in scans
+    )
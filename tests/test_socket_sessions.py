@@ -0,0 +1,66 @@
+import pytest
+from fastapi_async_sqlalchemy import db
+
+from depolarizing_chatroom.auth_tokens import auth_tokens
+from depolarizing_chatroom.data.crud import access
+from depolarizing_chatroom.socketio_util import (
+    SessionSocketAsyncNamespace,
+    SocketSession,
+)
+
+
+class RecordingSocketSession(SocketSession):
+    events = []
+
+    async def on_connect(self) -> None:
+        self.events.append(("connect", self))
+
+    async def on_typing(self) -> None:
+        self.events.append(("typing", self))
+
+    async def on_message(self, body) -> None:
+        self.events.append(("message", self, body))
+
+    async def on_disconnect(self) -> None:
+        self.events.append(("disconnect", self))
+
+
+@pytest.mark.asyncio
+async def test_events_are_dispatched_to_the_connections_session(engine) -> None:
+    namespace = SessionSocketAsyncNamespace(RecordingSocketSession, "/test")
+
+    async def save_session(*_) -> None:
+        pass
+
+    namespace.save_session = save_session
+    RecordingSocketSession.events = []
+    async with db():
+        token = auth_tokens.issue(await access.user_identity("response-7"))
+
+    assert await namespace.trigger_event("connect", "sid", {}, {"token": token}) is None
+    await namespace.trigger_event("typing", "sid")
+    await namespace.trigger_event("message", "sid", {"body": "Hi"})
+    await namespace.trigger_event("unknown", "sid")
+    await namespace.trigger_event("disconnect", "sid", "client disconnect")
+    # The session is gone once its connection disconnects
+    await namespace.trigger_event("typing", "sid")
+
+    events = RecordingSocketSession.events
+    assert [event[0] for event in events] == [
+        "connect",
+        "typing",
+        "message",
+        "disconnect",
+    ]
+    assert all(event[1] is events[0][1] for event in events)
+    assert events[2][2] == {"body": "Hi"}
+
+
+@pytest.mark.asyncio
+async def test_unknown_users_cannot_connect(engine) -> None:
+    namespace = SessionSocketAsyncNamespace(RecordingSocketSession, "/test")
+    assert (
+        await namespace.trigger_event("connect", "sid", {}, {"token": "nobody"})
+        is False
+    )
+    assert await namespace.trigger_event("typing", "sid") is None
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from fastapi_async_sqlalchemy import SQLAlchemyMiddleware, db
+from sqlalchemy import func, select
+
+from depolarizing_chatroom.data import models
+from depolarizing_chatroom.data.crud import DataAccess, create_missing_schema
+from depolarizing_chatroom.data.models import UserPosition
+from depolarizing_chatroom.data.pool import PoolSettings, pool_stats
+from depolarizing_chatroom.data.sqlite import create_sqlite_engines, is_sqlite_file
+
+
+def test_only_sqlite_files_use_sqlite_mode() -> None:
+    assert is_sqlite_file("sqlite+aiosqlite:////tmp/chatroom.db")
+    assert not is_sqlite_file("sqlite+aiosqlite://")
+    assert not is_sqlite_file("sqlite:///:memory:")
+    assert not is_sqlite_file("postgresql+asyncpg://localhost/chatroom")
+
+
+@pytest.mark.asyncio
+async def test_concurrent_writes_take_turns_on_the_writer(tmp_path) -> None:
+    engines = create_sqlite_engines(
+        f"sqlite+aiosqlite:///{tmp_path / 'test.db'}", PoolSettings.for_workers(1, 10)
+    )
+    try:
+        async with engines.writer.begin() as connection:
+            await connection.run_sync(create_missing_schema)
+            journal_mode = await connection.exec_driver_sql("PRAGMA journal_mode")
+            assert journal_mode.scalar() == "wal"
+        SQLAlchemyMiddleware(
+            None, custom_engine=engines.reader, session_args=engines.session_args
+        )
+        access = DataAccess()
+
+        async def sign_up(i: int) -> None:
+            async with db():
+                async with access.commit_after():
+                    await access.process_signup(f"response-{i}", UserPosition.SUPPORT)
+                await access.update_user(1, view="Same for everyone")
+                await access.commit()
+
+        # Without a single writer, these fail with "database is locked"
+        await asyncio.gather(*[sign_up(i) for i in range(50)])
+
+        async with db():
+            count = await db.session.execute(select(func.count(models.User.id)))
+            assert count.scalar() == 50
+        # One for the schema, then a signup and an update for every user
+        assert pool_stats(engines.writer).checkouts == 101
+    finally:
+        await engines.dispose()
@@ -0,0 +1,22 @@
+import pytest
+from fastapi_async_sqlalchemy import db
+
+from depolarizing_chatroom.data.crud import access
+from depolarizing_chatroom.data.models import UserPosition
+
+
+@pytest.mark.asyncio
+async def test_online_user_counts_match_user_lists(engine) -> None:
+    async with db():
+        counts = await access.online_user_counts()
+        for position in UserPosition:
+            assert counts[position].unmatched == len(
+                await access.users_in_waiting_room(position=position, matched=False)
+            )
+            assert counts[position].prechat == len(
+                await access.users_in_waiting_room(position=position, matched=True)
+            )
+            assert counts[position].in_chatroom == len(
+                await access.users_in_chatroom(position=position)
+            )
+            assert counts[position].total > 0
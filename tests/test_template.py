@@ -0,0 +1,252 @@
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from depolarizing_chatroom.data.template import (
+    HorribleConfusingListWrapperThatMakesTemplateAccessPatternWork,
+    PrecompiledTemplateNotLoadedError,
+    TemplateManager,
+    load_templates_from_directory,
+    render_precompiled,
+)
+from depolarizing_chatroom.data.template_bundle import (
+    build_template_bundle,
+    load_templates_from_bundle,
+    read_template_bundle,
+    template_file_hash,
+    write_template_bundle,
+)
+from depolarizing_chatroom.data.template_cache import TemplateManagerCache
+
+REPO_ROOT = Path(__file__).parent.parent
+
+TURNS = [
+    [{"position": "support", "body": "We need stricter background checks."}],
+    [{"position": "oppose", "body": "Criminals don't follow gun laws anyway."}],
+    [{"position": "support", "body": "Then why make it easy for them?"}],
+]
+
+
+def template_data(turns=TURNS):
+    return HorribleConfusingListWrapperThatMakesTemplateAccessPatternWork(turns)
+
+
+def test_data_independent_segments_are_prerendered() -> None:
+    template_manager = TemplateManager(
+        'Intro &amp; {{ "examples"|upper }}\n{{ data[-1][-1]|message }}\nOutro',
+        {
+            "message": '{{ position }}: "{{ data.body }}"',
+            "position": "{{ data.position }}",
+        },
+    )
+    assert not template_manager.errors
+
+    segments = template_manager.root.segments
+    assert [segment.data_independent for segment in segments] == [True, False, True]
+    assert segments[0].text == "Intro & EXAMPLES\n"
+    assert segments[1].text is None
+    assert segments[2].text == "\nOutro"
+
+    assert template_manager.render(template_data()) == (
+        'Intro & EXAMPLES\nsupport: "Then why make it easy for them?"\nOutro'
+    )
+
+
+def test_sub_templates_used_as_filters_on_constants_are_prerendered() -> None:
+    template_manager = TemplateManager(
+        '{{ "support"|describe }} says {{ data[-1][-1].body }}',
+        {"describe": '{{ {"support": "Supporter"}[data] }}'},
+    )
+    assert not template_manager.errors
+    assert template_manager.root.segments[0].text == "Supporter says "
+
+
+def test_assignments_disable_segment_splitting() -> None:
+    template_manager = TemplateManager(
+        "{% set last = data[-1][-1] %}Static text {{ last.body }}", {}
+    )
+    assert not template_manager.errors
+    assert len(template_manager.root.segments) == 1
+    assert template_manager.render(template_data()).endswith(
+        "Then why make it easy for them?"
+    )
+
+
+def test_nondeterministic_output_is_not_prerendered() -> None:
+    template_manager = TemplateManager("{{ [1, 2, 3]|random }}", {})
+    assert not template_manager.errors
+    assert template_manager.root.segments[0].text is None
+
+
+def test_unknown_filters_are_reported_at_load() -> None:
+    template_manager = TemplateManager("{{ data|missing }}", {})
+    assert "root" in template_manager.errors
+
+
+@pytest.mark.parametrize(
+    "template_name", [path.stem for path in (REPO_ROOT / "templates").glob("*.json")]
+)
+def test_strategy_templates_match_unsegmented_render(template_name) -> None:
+    template_manager = load_templates_from_directory(REPO_ROOT / "templates")[
+        template_name
+    ]
+    with open(REPO_ROOT / "templates" / f"{template_name}.json") as f:
+        template_json = json.load(f)
+
+    # A template whose root is a single segment renders the same way templates did
+    # before they were split up
+    unsegmented = TemplateManager(
+        "{% set data = data %}" + template_json["root"], template_json["templates"]
+    )
+    assert len(unsegmented.root.segments) == 1
+
+    assert template_manager.render(template_data()) == unsegmented.render(
+        template_data()
+    )
+
+
+def test_precompiled_templates_render_in_other_processes() -> None:
+    template_manager = load_templates_from_directory(REPO_ROOT / "templates")["polite"]
+    precompiled = template_manager.precompiled()
+
+    # Loading a precompiled manager doesn't need anything that can't be pickled
+    assert pickle.loads(pickle.dumps(precompiled)) == precompiled
+
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        with pytest.raises(PrecompiledTemplateNotLoadedError):
+            executor.submit(
+                render_precompiled, "polite", precompiled.key, template_data()
+            ).result()
+        executor.submit(
+            render_precompiled, "polite", precompiled.key, template_data(), precompiled
+        ).result()
+        # Once it's loaded, the key is enough
+        rendered = executor.submit(
+            render_precompiled, "polite", precompiled.key, template_data()
+        ).result()
+
+    assert rendered == template_manager.render(template_data())
+
+
+def test_dependency_cycles_are_reported_at_load() -> None:
+    template_manager = TemplateManager(
+        "{{ a }}", {"a": "{{ b }}", "b": "{{ data|c }}", "c": "{{ a }}"}
+    )
+    assert any("cycle" in error for error in template_manager.errors.values())
+
+
+def test_undefined_template_names_are_reported_at_load() -> None:
+    template_manager = TemplateManager("{{ message }} {{ data|turn }}", {})
+    assert "message" in template_manager.errors["root"]
+    assert "turn" in template_manager.errors["root"]
+
+
+def test_templates_used_by_name_are_rendered_once_in_dependency_order() -> None:
+    template_manager = TemplateManager(
+        "{{ greeting }} {{ body }}",
+        {
+            "body": "{{ greeting|lower }}, {{ data[-1][-1].body }}",
+            "greeting": "{{ name }}!",
+            "name": "{{ data[-1][-1].position|title }}",
+        },
+    )
+    assert not template_manager.errors
+    assert template_manager.root.render_plan == ["name", "greeting", "body"]
+    assert template_manager.render(template_data()) == (
+        "Support! support!, Then why make it easy for them?"
+    )
+
+
+def test_data_independent_templates_are_constant() -> None:
+    template_manager = TemplateManager(
+        "{{ header }}\n{{ data[-1][-1].body }}",
+        {"header": "{{ heading|upper }}", "heading": "Conversation"},
+    )
+    assert not template_manager.errors
+    assert template_manager.template("header").data_independent
+    assert template_manager.root.render_plan == []
+    assert template_manager.root.segments[0].text == "CONVERSATION\n"
+
+
+def test_bundled_templates_render_like_parsed_templates(tmp_path) -> None:
+    bundle_path = tmp_path / "templates.bundle"
+    parsed = load_templates_from_directory(REPO_ROOT / "templates")
+
+    write_template_bundle(
+        bundle_path, build_template_bundle(REPO_ROOT / "templates"), "secret"
+    )
+    bundled = load_templates_from_bundle(REPO_ROOT / "templates", bundle_path, "secret")
+
+    assert bundled.keys() == parsed.keys()
+    for name, template_manager in bundled.items():
+        assert template_manager.root.template is None, "Template wasn't bundled"
+        assert template_manager.render(template_data()) == parsed[name].render(
+            template_data()
+        )
+
+
+def test_changed_or_unsigned_bundles_are_not_used(tmp_path) -> None:
+    bundle_path = tmp_path / "templates.bundle"
+    template_path = tmp_path / "polite.json"
+    template_path.write_text(json.dumps({"root": "Polite {{ data }}", "templates": {}}))
+    write_template_bundle(bundle_path, build_template_bundle(tmp_path), "secret")
+
+    for secret_key in ("other-secret", None):
+        template_manager = load_templates_from_bundle(
+            tmp_path, bundle_path, secret_key
+        )["polite"]
+        assert template_manager.root.template is not None
+
+    template_path.write_text(
+        json.dumps({"root": "Be polite {{ data }}", "templates": {}})
+    )
+    template_manager = load_templates_from_bundle(tmp_path, bundle_path, "secret")[
+        "polite"
+    ]
+    assert template_manager.root.template is not None
+    assert template_manager.render("x") == "Be polite x"
+    # Workers never write the bundle
+    assert read_template_bundle(bundle_path, "secret").templates["polite"][0] != (
+        template_file_hash(template_path)
+    )
+
+
+def test_cached_managers_only_parse_changed_templates() -> None:
+    cache = TemplateManagerCache()
+    root = '{{ "hi"|shout }} {{ data }}'
+    first = cache.get(root, {"shout": "{{ data|upper }}!"})
+    assert cache.get(root, {"shout": "{{ data|upper }}!"}) is first
+
+    # Constant folding calls filters while compiling, so this would render with the
+    # first manager's filter if the managers shared a parsed root
+    second = cache.get(root, {"shout": "{{ data }}?"})
+    assert first.render("x") == "HI! x"
+    assert second.render("x") == "hi? x"
+
+    stats = cache.stats()
+    assert (stats["managers"].hits, stats["managers"].misses) == (1, 2)
+    assert (stats["parsed_templates"].hits, stats["parsed_templates"].misses) == (1, 3)
+
+
+def test_cached_managers_only_compile_changed_segments() -> None:
+    cache = TemplateManagerCache()
+    root = "{{ data|calm }} and {{ data|shout }}"
+    first = cache.get(root, {"calm": "{{ data }}.", "shout": "{{ data|upper }}!"})
+    second = cache.get(root, {"calm": "{{ data }}.", "shout": "{{ data }}?!"})
+    assert second.render("x") == "x. and x?!"
+
+    # Segments that don't use the changed template are shared
+    first_segments, second_segments = first.root.segments, second.root.segments
+    assert second_segments[0].code is first_segments[0].code
+    assert second_segments[2].code is not first_segments[2].code
+    assert second.template("calm").segments[0].code is (
+        first.template("calm").segments[0].code
+    )
+
+    # Shared code is only marshalled when a manager is precompiled
+    assert TemplateManager.from_precompiled(second.precompiled()).render("x") == (
+        "x. and x?!"
+    )
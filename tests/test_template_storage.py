@@ -0,0 +1,89 @@
+import json
+import os
+
+import pytest
+
+from depolarizing_chatroom.data.template_storage import (
+    FileTemplateStorage,
+    TemplateVersionConflictError,
+)
+
+
+@pytest.fixture(name="storage")
+def fixture_storage(tmp_path) -> FileTemplateStorage:
+    default_template_path = tmp_path / "template.json"
+    with open(default_template_path, "w") as f:
+        json.dump({"default": {"root": "{{ data }}", "templates": {}}}, f)
+    return FileTemplateStorage(
+        tmp_path / "users", default_template_path=default_template_path
+    )
+
+
+@pytest.mark.asyncio
+async def test_saves_are_versioned(storage, tmp_path) -> None:
+    document = await storage.get("user-1")
+    assert document.version == 0
+    assert document.data["root"] == "{{ data }}"
+
+    document.data["root"] = "Hi {{ data }}"
+    saved = await storage.save("user-1", document.data, expected_version=0)
+    assert saved.version == 1
+    assert (await storage.get("user-1")) == saved
+
+    # Saving on top of a version we haven't seen loses
+    with pytest.raises(TemplateVersionConflictError):
+        await storage.save("user-1", {"root": "", "templates": {}}, expected_version=0)
+
+    # Other storage instances (like ones in other processes) see our saves
+    other_storage = FileTemplateStorage(tmp_path / "users")
+    assert (await other_storage.get("user-1")).version == 1
+    await other_storage.save("user-1", document.data, expected_version=1)
+    assert (await storage.get("user-1")).version == 2
+
+
+@pytest.mark.asyncio
+async def test_update_retries_lost_races(storage, tmp_path) -> None:
+    other_storage = FileTemplateStorage(tmp_path / "users")
+    raced = False
+
+    def update_data(data):
+        nonlocal raced
+        if not raced:
+            raced = True
+            with open(tmp_path / "users" / "user1.json", "w") as f:
+                json.dump({"version": 1, "template": {"root": "", "templates": {}}}, f)
+        data["templates"]["greeting"] = "Hi"
+        return data
+
+    document = await storage.update("user-1", update_data)
+    assert document.version == 2
+    assert (await other_storage.get("user-1")).data == {
+        "root": "",
+        "templates": {"greeting": "Hi"},
+    }
+
+    with pytest.raises(TemplateVersionConflictError):
+        await storage.update("user-1", update_data, expected_version=1)
+
+
+@pytest.mark.asyncio
+async def test_saves_check_the_version_on_disk(storage, tmp_path) -> None:
+    document = await storage.save(
+        "user-1", {"root": "a", "templates": {}}, expected_version=0
+    )
+    filepath = tmp_path / "users" / "user1.json"
+    file_stat = os.stat(filepath)
+
+    other_storage = FileTemplateStorage(tmp_path / "users")
+    await other_storage.save(
+        "user-1", {"root": "b", "templates": {}}, expected_version=1
+    )
+    # Make the other save look unchanged to anything that only checks mtime and size
+    os.utime(filepath, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+    assert os.stat(filepath).st_size == file_stat.st_size
+
+    with pytest.raises(TemplateVersionConflictError):
+        await storage.save(
+            "user-1", {"root": "c", "templates": {}}, expected_version=document.version
+        )
+    assert json.loads(filepath.read_text())["template"]["root"] == "b"
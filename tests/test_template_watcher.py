@@ -0,0 +1,86 @@
+import json
+import os
+
+import pytest
+
+from depolarizing_chatroom.data.template import TemplateLoadingError
+from depolarizing_chatroom.data.template_watcher import (
+    HostTemplateWatcher,
+    TemplateDirectoryWatcher,
+)
+
+
+def write_template(path, root, templates=None) -> None:
+    with open(path, "w") as f:
+        json.dump({"root": root, "templates": templates or {}}, f)
+    # Make sure the watcher sees a change even on filesystems with coarse mtimes
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_only_changed_templates_are_reloaded(tmp_path) -> None:
+    write_template(tmp_path / "polite.json", "Polite {{ data }}")
+    write_template(tmp_path / "restate.json", "Restate {{ data }}")
+    watcher = TemplateDirectoryWatcher(tmp_path, lambda _: None)
+
+    first = watcher.load()
+    assert first["polite"].render("x") == "Polite x"
+    assert watcher.load() is None
+
+    write_template(tmp_path / "polite.json", "Be polite {{ data }}")
+    second = watcher.load()
+    assert second["polite"].render("x") == "Be polite x"
+    assert second["restate"] is first["restate"]
+    # Old dicts are never modified
+    assert first["polite"].render("x") == "Polite x"
+
+
+def test_failed_reloads_keep_current_templates(tmp_path) -> None:
+    write_template(tmp_path / "polite.json", "Polite {{ data }}")
+    write_template(tmp_path / "restate.json", "Restate {{ data }}")
+    watcher = TemplateDirectoryWatcher(tmp_path, lambda _: None)
+    watcher.load()
+
+    write_template(tmp_path / "polite.json", "Polite {{ data|missing }}")
+    with pytest.raises(TemplateLoadingError):
+        watcher.load()
+
+    # A broken file keeps failing until it's fixed, even if other files change
+    write_template(tmp_path / "restate.json", "Restate again {{ data }}")
+    with pytest.raises(TemplateLoadingError):
+        watcher.load()
+
+    write_template(tmp_path / "polite.json", "Polite again {{ data }}")
+    templates = watcher.load()
+    assert templates["polite"].render("x") == "Polite again x"
+    assert templates["restate"].render("x") == "Restate again x"
+
+
+def test_deleted_templates_are_removed(tmp_path) -> None:
+    write_template(tmp_path / "polite.json", "Polite {{ data }}")
+    write_template(tmp_path / "restate.json", "Restate {{ data }}")
+    watcher = TemplateDirectoryWatcher(tmp_path, lambda _: None)
+    watcher.load()
+
+    (tmp_path / "restate.json").unlink()
+    assert set(watcher.load()) == {"polite"}
+
+
+def test_one_worker_per_host_watches_and_the_rest_load_the_bundle(tmp_path) -> None:
+    write_template(tmp_path / "polite.json", "Polite {{ data }}")
+    write_template(tmp_path / "restate.json", "Restate {{ data }}")
+    leader = HostTemplateWatcher(tmp_path, lambda _: None, "secret")
+    follower = HostTemplateWatcher(tmp_path, lambda _: None, "secret")
+    assert leader.try_to_lead()
+    assert not follower.try_to_lead()
+
+    leader.load()
+    first = follower.load_bundle()
+    assert first["polite"].render("x") == "Polite x"
+    assert follower.load_bundle() is None
+
+    write_template(tmp_path / "polite.json", "Be polite {{ data }}")
+    leader.load()
+    second = follower.load_bundle()
+    assert second["polite"].render("x") == "Be polite x"
+    assert second["restate"] is first["restate"]
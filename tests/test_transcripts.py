@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+from fastapi_async_sqlalchemy import db
+
+from depolarizing_chatroom.data.crud import DataAccess
+from depolarizing_chatroom.data.models import UserPosition
+from depolarizing_chatroom.data.snapshots import ChatroomSnapshot
+from depolarizing_chatroom.data.transcripts import Transcript, TranscriptCache
+from depolarizing_chatroom.notifications import NotificationBus
+
+
+@pytest.mark.asyncio
+async def test_transcripts_are_cached_and_written_through(engine) -> None:
+    access = DataAccess()
+    async with db():
+        user = await access.user_by_response_id("response-7")
+        chatroom = ChatroomSnapshot.of(await access.chatroom(user.chatroom_id))
+        assert [m.body for m in await access.chatroom_transcript(chatroom)] == ["Hello"]
+
+        async with access.commit_after():
+            message = await access.add_message(chatroom.id, user.id, "Hi there")
+        async with access.commit_after():
+            access.set_final_body(message, "Hi there, friend")
+        # Not committed, so not cached
+        await access.add_message(chatroom.id, user.id, "Never mind")
+        await access.session.rollback()
+
+        transcript = await access.chatroom_transcript(chatroom, after_seq=1)
+        assert [(m.seq, m.body, m.word_count) for m in transcript] == [
+            (2, "Hi there, friend", 3)
+        ]
+
+    stats = access.transcript_stats()
+    assert (stats.transcripts, stats.messages, stats.hits, stats.misses) == (1, 2, 1, 1)
+    assert 0 < stats.bytes <= stats.max_bytes
+
+
+class Row:
+    def __init__(self, seq: int, body: str):
+        self.id = seq
+        self.seq = seq
+        self.sender_id = 1
+        self.final_body = body
+        self.word_count = len(body.split())
+        self.has_rephrasings = False
+
+
+def transcript(*bodies: str) -> Transcript:
+    return Transcript.of(
+        {1: UserPosition.SUPPORT},
+        [Row(seq, body) for seq, body in enumerate(bodies, start=1)],
+    )
+
+
+@pytest.mark.asyncio
+async def test_transcript_cache_stays_under_its_size_and_drops_stale_copies() -> None:
+    size = transcript("Hello").size
+    cache = TranscriptCache(max_bytes=size * 2)
+
+    async def load(*bodies: str) -> Transcript:
+        return transcript(*bodies)
+
+    for chatroom_id in range(3):
+        await cache.get(chatroom_id, lambda: load("Hello"))
+    stats = cache.stats()
+    assert (stats.transcripts, stats.bytes, stats.evictions) == (2, size * 2, 1)
+
+    # A write that skips a message we don't have drops our copy
+    cache.write(2, Row(3, "Hello"))
+    assert cache.stats().transcripts == 1
+
+    # Another worker's change drops our copy
+    bus = NotificationBus()
+    cache.share_changes(bus)
+    await bus.publish("transcript_changed", chatroom_id=1, source="other")
+    # noinspection PyProtectedMember
+    await asyncio.gather(*bus._tasks)
+    assert cache.stats().transcripts == 0
+
+    # A change while loading might not be in what we loaded
+    async def load_during_change() -> Transcript:
+        cache.write(3, Row(2, "Hi"))
+        return transcript("Hello")
+
+    await cache.get(3, load_during_change)
+    assert cache.stats().transcripts == 0
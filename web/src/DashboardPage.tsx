@@ -1,6 +1,7 @@
 import PageWidth from "./common/PageWidth";
 import { useEffect, useState } from "react";
-import { getEndpointUrl } from "./api/apiUtils";
+import { io, Socket } from "socket.io-client";
+import { BASE_URL, getEndpointUrl } from "./api/apiUtils";
 import LoadingPage from "./common/LoadingPage";
 
 interface StatsByPosition {
@@ -15,43 +16,134 @@ interface Stats {
   inChatroom: StatsByPosition;
 }
 
+type StatsSample = Stats & { time: number };
+
+// Only the counters that changed
+type StatsChanges = Partial<{
+  [K in keyof Stats]: Stats[K] extends StatsByPosition
+    ? Partial<StatsByPosition>
+    : Stats[K];
+}>;
+
+// Should match STATS_HISTORY_SIZE on the server
+const HISTORY_SIZE = 600;
+
+const applyChanges = (stats: Stats, changes: StatsChanges): Stats => ({
+  totalOnline: changes.totalOnline ?? stats.totalOnline,
+  unmatched: { ...stats.unmatched, ...changes.unmatched },
+  prechat: { ...stats.prechat, ...changes.prechat },
+  inChatroom: { ...stats.inChatroom, ...changes.inChatroom },
+});
+
+function Sparkline({ values }: { values: number[] }) {
+  if (values.length < 2) {
+    return null;
+  }
+  const width = 200;
+  const height = 32;
+  const max = Math.max(...values, 1);
+  const points = values
+    .map(
+      (value, index) =>
+        `${(index / (values.length - 1)) * width},${
+          height - (value / max) * height
+        }`
+    )
+    .join(" ");
+  return (
+    <svg width={width} height={height} className="inline-block ml-2">
+      <polyline points={points} fill="none" stroke="currentColor" />
+    </svg>
+  );
+}
+
 function DashboardPage() {
-  // Every 5s, query the server for the latest user data
+  // The server pushes every counter when we connect, then only changed counters
   const [stats, setStats] = useState<Stats | undefined>();
+  const [history, setHistory] = useState<StatsSample[]>([]);
 
   useEffect(() => {
-    const interval = setInterval(async () => {
-      const response = await fetch(getEndpointUrl("stats"), {
-        headers: {
-          "Content-Type": "application/json",
-        },
-      });
-      const data = await response.json();
-      setStats(data);
-    }, 800);
-    return () => clearInterval(interval);
-  });
+    const socket: Socket = io(
+      getEndpointUrl("dashboard").replace("/api", ""),
+      {
+        path: BASE_URL.endsWith("/api/")
+          ? "/api/ws/socket.io"
+          : "/ws/socket.io",
+        reconnection: true,
+        reconnectionDelay: 1000,
+        reconnectionDelayMax: 5000,
+        reconnectionAttempts: Infinity,
+      }
+    );
+    socket.on("stats", (stats: Stats) => setStats(stats));
+    socket.on("stats_history", (history: StatsSample[]) =>
+      setHistory(history)
+    );
+    socket.on("stats_changed", (changes: StatsChanges) =>
+      setStats((stats) => {
+        if (!stats) {
+          return stats;
+        }
+        const newStats = applyChanges(stats, changes);
+        setHistory((history) =>
+          [...history, { ...newStats, time: Date.now() / 1000 }].slice(
+            -HISTORY_SIZE
+          )
+        );
+        return newStats;
+      })
+    );
+    return () => {
+      socket.disconnect();
+    };
+  }, []);
 
   if (!stats) {
     return <LoadingPage />;
   }
 
+  const sparkline = (value: (sample: Stats) => number) => (
+    <Sparkline values={history.map(value)} />
+  );
+
   return (
     <PageWidth>
-      <h2 className="text-3xl mb-4">Unmatched (waiting)</h2>
+      <h2 className="text-3xl mb-4">
+        Online: {stats.totalOnline}
+        {sparkline((sample) => sample.totalOnline)}
+      </h2>
+      <h2 className="text-3xl my-4">Unmatched (waiting)</h2>
       <div>
-        <p>Opponents: {stats.unmatched.opponents}</p>
-        <p>Supporters: {stats.unmatched.supporters}</p>
+        <p>
+          Opponents: {stats.unmatched.opponents}
+          {sparkline((sample) => sample.unmatched.opponents)}
+        </p>
+        <p>
+          Supporters: {stats.unmatched.supporters}
+          {sparkline((sample) => sample.unmatched.supporters)}
+        </p>
       </div>
       <h2 className="text-3xl my-4">Pre-chat</h2>
       <div>
-        <p>Opponents: {stats.prechat.opponents}</p>
-        <p>Supporters: {stats.prechat.supporters}</p>
+        <p>
+          Opponents: {stats.prechat.opponents}
+          {sparkline((sample) => sample.prechat.opponents)}
+        </p>
+        <p>
+          Supporters: {stats.prechat.supporters}
+          {sparkline((sample) => sample.prechat.supporters)}
+        </p>
       </div>
       <h2 className="text-3xl my-4">In chatroom</h2>
       <div>
-        <p>Opponents: {stats.inChatroom.opponents}</p>
-        <p>Supporters: {stats.inChatroom.supporters}</p>
+        <p>
+          Opponents: {stats.inChatroom.opponents}
+          {sparkline((sample) => sample.inChatroom.opponents)}
+        </p>
+        <p>
+          Supporters: {stats.inChatroom.supporters}
+          {sparkline((sample) => sample.inChatroom.supporters)}
+        </p>
       </div>
     </PageWidth>
   );
@@ -94,8 +94,10 @@ function LoginRoute() {
       throw new Error(fetchResponse.statusText);
     }
 
-    await setAuthCode(token);
-    return fetchResponse.json();
+    const data = await fetchResponse.json();
+    // Fall back to the raw token for servers that don't issue auth tokens
+    await setAuthCode(data.token ?? token);
+    return data;
   });
 
   // If mutation is successful, navigate to chatroom
@@ -152,8 +154,9 @@ function StartRoute() {
       throw new Error(fetchResponse.statusText);
     }
 
-    await setAuthCode(respondentId);
-    return fetchResponse.json();
+    const data = await fetchResponse.json();
+    await setAuthCode(data.token ?? respondentId);
+    return data;
   });
 
   // If mutation is successful, navigate to chatroom
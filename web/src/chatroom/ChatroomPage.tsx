@@ -29,6 +29,36 @@ const MemoizedChatMessageList = memo(ChatMessageList);
 const THROTTLED_TYPING_INTERVAL = 6000;
 const PARTNER_OFFLINE_TIMEOUT = 60_000;
 
+// The highest sequence number we've seen every message up to
+function lastContiguousSeq(seenSeqs: Set<number>): number {
+  let seq = 0;
+  while (seenSeqs.has(seq + 1)) {
+    seq++;
+  }
+  return seq;
+}
+
+// Add messages we haven't seen and update ones we have, e.g. a message we were
+// sent while its sender was still picking a rephrasing
+function mergeMessages(
+  messages: Message[],
+  newMessages: Message[]
+): Message[] {
+  const merged = [...messages];
+  for (const message of newMessages) {
+    const index =
+      message.seq !== undefined
+        ? merged.findIndex((existing) => existing.seq === message.seq)
+        : -1;
+    if (index === -1) {
+      merged.push(message);
+    } else {
+      merged[index] = { ...merged[index], body: message.body };
+    }
+  }
+  return merged;
+}
+
 function ChatroomPage() {
   const user = useUser();
   const chatroom = useChatroom();
@@ -68,6 +98,10 @@ function ChatroomPage() {
 
   // Local state of all messages in the chatroom
   const [messages, setMessages] = useState<Message[]>([]);
+  // Sequence numbers of the messages we've seen, so when we reconnect the server
+  // only sends us the ones we missed. Messages held back for rephrasing are sent
+  // after later ones, so this can have gaps.
+  const seenSeqsRef = useRef<Set<number>>(new Set());
 
   // Pushed from server: whether users have typed enough messages to go to
   // post-survey and get paid
@@ -205,14 +239,17 @@ function ChatroomPage() {
         // Also hide the typing bubble
         setShowingTypingBubble(false);
       }
-      setMessages((messages) => [
-        ...messages,
-        {
-          body: message.message,
-          time: Date.now(),
-          state: message.user_id === user.data.id ? "sender" : "received",
-        },
-      ]);
+      setMessages((messages) =>
+        mergeMessages(messages, [
+          {
+            body: message.message,
+            time: Date.now(),
+            state: message.user_id === user.data.id ? "sender" : "received",
+            seq: message.seq,
+          },
+        ])
+      );
+      seenSeqsRef.current.add(message.seq);
     },
     [user.data, handlePartnerStatusChange]
   );
@@ -300,7 +337,16 @@ function ChatroomPage() {
         path: BASE_URL.endsWith("/api/")
           ? "/api/ws/socket.io"
           : "/ws/socket.io",
-        auth: { token: getAuthCode() },
+        // A function, so each reconnect sends the messages we've seen as they are
+        // then. We've seen every message up to last_seq, and the server sends us
+        // everything after it.
+        auth: (cb) =>
+          cb({
+            token: getAuthCode(),
+            last_seq: seenSeqsRef.current.size
+              ? lastContiguousSeq(seenSeqsRef.current)
+              : undefined,
+          }),
         reconnection: true,
         reconnectionDelay: 1000,
         reconnectionDelayMax: 5000,
@@ -342,14 +388,40 @@ function ChatroomPage() {
       if (!user?.data?.id) {
         return;
       }
+      seenSeqsRef.current = new Set(
+        messages.map((message: any) => message.seq)
+      );
       setMessages(
         messages.map((message: any) => ({
           body: message.message,
           state: message.user_id === user.data.id ? "sender" : "received",
+          seq: message.seq,
         }))
       );
     });
-    localSocket.on("clear", () => setMessages([]));
+    localSocket.on("missed_messages", (messages: any) => {
+      if (!user?.data?.id) {
+        return;
+      }
+      // We've seen some of these already if we had gaps
+      setMessages((existingMessages) =>
+        mergeMessages(
+          existingMessages,
+          messages.map((message: any) => ({
+            body: message.message,
+            state: message.user_id === user.data.id ? "sender" : "received",
+            seq: message.seq,
+          }))
+        )
+      );
+      for (const message of messages) {
+        seenSeqsRef.current.add(message.seq);
+      }
+    });
+    localSocket.on("clear", () => {
+      seenSeqsRef.current = new Set();
+      setMessages([]);
+    });
     localSocket.on("redirect", ({ to }: { to: string }) => {
       if (to === "waiting") {
         navigate("/waiting");
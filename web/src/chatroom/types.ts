@@ -4,4 +4,7 @@ export interface Message {
   body: string;
   time?: number;
   state: ChatMessageState;
+  // Position in the chatroom, which can be out of order: a message held back
+  // while its sender picks a rephrasing keeps the number it was sent with
+  seq?: number;
 }
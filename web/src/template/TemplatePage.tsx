@@ -3,6 +3,7 @@ import React, {
   FormEvent,
   useCallback,
   useEffect,
+  useRef,
   useState,
 } from "react";
 import TemplateEditor from "./TemplateEditor";
@@ -89,9 +90,32 @@ async function getPreview(username: string) {
   return (await response.json()).preview;
 }
 
-async function getCompletions(username: string) {
-  const response = await fetch(API_URL + "template/completions/" + username);
-  return (await response.json()).completions;
+function streamCompletions(
+  username: string,
+  onCompletions: (completions: string[]) => void,
+  onDone: () => void
+) {
+  const source = new EventSource(
+    API_URL + "template/completions/" + username + "/stream"
+  );
+  const completions: string[] = [];
+  const finish = () => {
+    source.close();
+    onCompletions(
+      completions.map((completion) => completion.replace(/"+$/, ""))
+    );
+    onDone();
+  };
+  source.onmessage = (event) => {
+    const { index, text } = JSON.parse(event.data);
+    completions[index] = (completions[index] || "") + text;
+    onCompletions([...completions]);
+  };
+  source.addEventListener("done", finish);
+  source.addEventListener("errors", finish);
+  // Connection errors
+  source.onerror = finish;
+  return source;
 }
 
 async function checkTemplate(
@@ -133,7 +157,8 @@ function TemplatePage() {
     []
   );
   const [loadingCompletions, setLoadingCompletions] = useState(false);
-  const [completions, setCompletions] = useState([]);
+  const [completions, setCompletions] = useState<string[]>([]);
+  const completionsSource = useRef<EventSource>();
   const [preview, setPreview] = useState<string | undefined>(undefined);
   const [showingPreview, setShowingPreview] = useState(false);
 
@@ -238,12 +263,18 @@ function TemplatePage() {
     if (username === undefined) {
       return;
     }
+    completionsSource.current?.close();
+    setCompletions([]);
     setLoadingCompletions(true);
-    getCompletions(username)
-      .then((data) => setCompletions(data))
-      .then(() => setLoadingCompletions(false));
+    completionsSource.current = streamCompletions(
+      username,
+      (data) => setCompletions(data),
+      () => setLoadingCompletions(false)
+    );
   }, [username]);
 
+  useEffect(() => () => completionsSource.current?.close(), []);
+
   return (
     <div className="h-full flex flex-row">
       <div className="w-1/4 border-r flex flex-col">
@@ -275,7 +306,7 @@ function TemplatePage() {
             </div>
           </div>
           <div className="overflow-scroll">
-            {loadingCompletions ? (
+            {loadingCompletions && !completions.length ? (
               <div className="text-center py-10">
                 <svg
                   role="status"